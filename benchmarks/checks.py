@@ -0,0 +1,696 @@
+#!/usr/bin/python3
+# File name: checks.py
+# This file is part of: mmutils
+#
+# LICENSE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# FEEDBACK & QUESTIONS
+#
+# For feedback and questions about mmutils please e-mail one of the
+# authors named in the AUTHORS file.
+########################################################################
+"""
+Check behaviour which the benchmarks do not observe.
+
+Each check builds what it needs in a temporary directory and raises
+:class:`CheckFailed` if the result is not as expected. transcoder.py is run
+with the stubs from ``stubs/``, except for opusenc and flac, which are
+replaced by this script (see :func:`stub_opusenc` and :func:`stub_flac`) so
+that the outputs are Ogg Opus files whose tags can be read and rewritten
+and the loudness of the sources can be measured. Some checks replace other
+programs with failing stubs (see :func:`write_stub`).
+"""
+
+import contextlib
+import logging
+import math
+import os
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(BENCHMARK_DIR)
+STUB_DIR = os.path.join(BENCHMARK_DIR, "stubs")
+TRANSCODER = os.path.join(REPOSITORY_DIR, "transcoder.py")
+
+sys.path.insert(0, REPOSITORY_DIR)
+
+import flacmeta
+import mkcorpus
+import oggtags
+import transcoder
+
+class CheckFailed(Exception):
+    pass
+
+def ogg_opus_file(comments, audio_packets=4, vendor="stub"):
+    """
+    Return the content of a minimal Ogg Opus file with the ``(key, value)``
+    pairs *comments* and *audio_packets* packets of silence.
+    """
+    serial = 0x4d4d
+    head = b"OpusHead" + bytes([1, 2]) + (312).to_bytes(2, "little") + \
+        (48000).to_bytes(4, "little") + bytes(3)
+    tags = b"OpusTags" + flacmeta.build_vorbis_comment(vendor, comments)
+    pages = oggtags.paginate([head], serial, 0)
+    pages[0].flags |= oggtags.FLAG_BOS
+    pages.extend(oggtags.paginate([tags], serial, len(pages)))
+    for i in range(audio_packets):
+        pages.extend(oggtags.paginate(
+            [b"\xfc\xff\xfe"], serial, len(pages), granule=960 * (i + 1)))
+    pages[-1].flags |= oggtags.FLAG_EOS
+    return b"".join(page.to_bytes() for page in pages)
+
+def ogg_vorbis_file(comments, setup_size=3000, audio_packets=4):
+    """
+    Return the content of an Ogg Vorbis file with the ``(key, value)`` pairs
+    *comments*, whose setup header of *setup_size* bytes shares the page of
+    the comment header, followed by *audio_packets* packets.
+    """
+    serial = 0x564f
+    ident = b"\x01vorbis" + bytes(23)
+    tags = b"\x03vorbis" + \
+        flacmeta.build_vorbis_comment("stub", comments) + b"\x01"
+    setup = b"\x05vorbis" + bytes(range(256)) * (setup_size // 256)
+    pages = oggtags.paginate([ident], serial, 0)
+    pages[0].flags |= oggtags.FLAG_BOS
+    pages.extend(oggtags.paginate([tags, setup], serial, len(pages)))
+    for i in range(audio_packets):
+        pages.extend(oggtags.paginate(
+            [bytes([i]) * 300], serial, len(pages), granule=1024 * (i + 1)))
+    pages[-1].flags |= oggtags.FLAG_EOS
+    return b"".join(page.to_bytes() for page in pages)
+
+def stub_opusenc(args):
+    """
+    Stand in for ``opusenc [OPTIONS] - OUTFILE``: consume stdin and write
+    :func:`ogg_opus_file` with the ``--comment`` options to OUTFILE. Each
+    run is logged to the file named by ``$CHECK_ENCODER_LOG``.
+    """
+    comments = [
+        tuple(value.split("=", 1))
+        for option, value in zip(args, args[1:])
+        if option == "--comment"
+    ]
+    sys.stdin.buffer.read()
+    with open(args[-1], "wb") as f:
+        f.write(ogg_opus_file(comments))
+    with open(os.environ["CHECK_ENCODER_LOG"], "a") as f:
+        print(args[-1], file=f)
+
+def stub_flac(args):
+    """
+    Stand in for ``flac -dc FILE``: write a WAVE stream of one second of a
+    tone to stdout, whose level depends on the size of FILE, so that the
+    loudness of the tracks can be measured.
+    """
+    rate = 48000
+    amplitude = 1000 + os.path.getsize(args[-1]) % 8000
+    samples = b"".join(
+        int(amplitude * math.sin(2 * math.pi * 440 * i / rate)).to_bytes(
+            2, "little", signed=True) * 2
+        for i in range(rate))
+    fmt = (1).to_bytes(2, "little") + (2).to_bytes(2, "little") + \
+        rate.to_bytes(4, "little") + (rate * 4).to_bytes(4, "little") + \
+        (4).to_bytes(2, "little") + (16).to_bytes(2, "little")
+    sys.stdout.buffer.write(
+        b"RIFF" + (36 + len(samples)).to_bytes(4, "little") + b"WAVE" +
+        b"fmt " + len(fmt).to_bytes(4, "little") + fmt +
+        b"data" + len(samples).to_bytes(4, "little") + samples)
+
+def set_flac_comment(path, key, value):
+    """
+    Replace the comments with *key* in the FLAC file at *path* with *value*,
+    rewriting the file in place like a tag editor.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 4
+    blocks = []
+    while True:
+        last = data[offset] & 0x80
+        block_type = data[offset] & 0x7f
+        length = int.from_bytes(data[offset+1:offset+4], "big")
+        blocks.append([block_type, data[offset+4:offset+4+length]])
+        offset += 4 + length
+        if last:
+            break
+    for block in blocks:
+        if block[0] == flacmeta.BLOCK_VORBIS_COMMENT:
+            vendor, comments, rest = flacmeta.split_vorbis_comment(block[1])
+            comments = [
+                (k, v) for k, v in comments
+                if k.upper() != key.upper()
+            ] + [(key, value)]
+            block[1] = flacmeta.build_vorbis_comment(vendor, comments) + rest
+    result = bytearray(data[:4])
+    for i, (block_type, block) in enumerate(blocks):
+        if i == len(blocks) - 1:
+            block_type |= 0x80
+        result.append(block_type)
+        result += len(block).to_bytes(3, "big") + block
+    with open(path, "wb") as f:
+        f.write(result + data[offset:])
+
+def write_stub(bin_dir, name, script):
+    """
+    Write the shell *script* to the program *name* in *bin_dir*.
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, name)
+    with open(path, "w") as f:
+        f.write("#!/bin/sh\n" + script + "\n")
+    os.chmod(path, 0o755)
+
+def stub_bin_dir(work_dir):
+    """
+    Create a directory in *work_dir* with an opusenc running
+    :func:`stub_opusenc` and a flac running :func:`stub_flac`, and return
+    the environment for running transcoder.py with it, logging the encoder
+    runs to ``encoder.log``.
+    """
+    bin_dir = os.path.join(work_dir, "bin")
+    for name in ["opusenc", "flac"]:
+        write_stub(bin_dir, name, 'exec "{}" "{}" --stub-{} "$@"'.format(
+            sys.executable, os.path.abspath(__file__), name))
+    env = dict(os.environ)
+    env["PATH"] = os.pathsep.join([bin_dir, STUB_DIR, env.get("PATH", "")])
+    env["CHECK_ENCODER_LOG"] = os.path.join(work_dir, "encoder.log")
+    return env
+
+def encoder_runs(work_dir):
+    """
+    Return the outputs encoded by :func:`stub_opusenc` so far, in order,
+    under their final names.
+    """
+    try:
+        with open(os.path.join(work_dir, "encoder.log")) as f:
+            runs = f.read().splitlines()
+    except FileNotFoundError:
+        return []
+    return [
+        path[:-len(".part")] if path.endswith(".part") else path
+        for path in runs
+    ]
+
+def setup_library(work_dir, options, albums=1, tracks=2, duration=0.2):
+    """
+    Make *work_dir* the current directory and generate a library of *albums*
+    albums with *tracks* tracks of *duration* seconds in it, together with
+    the stubs (see :func:`stub_bin_dir`).
+
+    Return the paths of the tracks, the environment with the stubs and the
+    command running transcoder.py with *options* and an opus encoder writing
+    to ``out`` for the library.
+    """
+    os.chdir(work_dir)
+    paths = mkcorpus.generate(
+        "library", artists=1, albums=albums, tracks=tracks,
+        min_duration=duration, max_duration=duration)
+    env = stub_bin_dir(work_dir)
+    command = [sys.executable, TRANSCODER] + list(options) + \
+        ["-x", "opus", "out", "library"]
+    return paths, env, command
+
+def output_file(path, suffix="opus"):
+    """
+    Return the output built from the source at *path* in ``out``.
+    """
+    return transcoder.EncoderHandle._get_output_file(path, "out", suffix)
+
+def wait_for(condition, timeout, what):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise CheckFailed("timed out waiting for " + what)
+        time.sleep(0.05)
+
+def output_comment(path, key):
+    try:
+        vendor, comments = oggtags.read_comments(path)
+    except (OSError, oggtags.OggFormatError):
+        return None
+    return dict((k.upper(), v) for k, v in comments).get(key)
+
+def indexed_outputs(path):
+    """
+    Return the number of outputs committed to the index at *path*.
+    """
+    with contextlib.closing(sqlite3.connect(path)) as db:
+        return db.execute("SELECT COUNT(*) FROM outputs").fetchone()[0]
+
+def read_stream(path):
+    """
+    Read all pages of the Ogg file at *path*, checking their checksums and
+    numbering, and return its packets and the granule positions of its
+    pages.
+    """
+    packets = []
+    granules = []
+    current = bytearray()
+    with open(path, "rb") as f:
+        while True:
+            page = oggtags.Page.read_from(f)
+            if page is None:
+                break
+            if page.sequence != len(granules):
+                raise CheckFailed("page {} has sequence number {}".format(
+                    len(granules), page.sequence))
+            if bool(page.flags & oggtags.FLAG_CONTINUED) != bool(current):
+                raise CheckFailed("wrong continuation flag on page {}".format(
+                    page.sequence))
+            granules.append(page.granule)
+            offset = 0
+            for length in page.lacing:
+                current += page.data[offset:offset+length]
+                offset += length
+                if length < 255:
+                    packets.append(bytes(current))
+                    current = bytearray()
+    if current:
+        raise CheckFailed("unfinished packet at the end")
+    return packets, granules
+
+def check_dag(work_dir):
+    """
+    Build a library with the replay gain filter, which fails for one album,
+    and check that only the tracks of that album are not encoded.
+    """
+    paths, env, command = setup_library(
+        work_dir, ["-f", "replay-gain"], albums=3)
+    failing = os.path.dirname(paths[0])
+    write_stub(os.path.join(work_dir, "bin"), "metaflac",
+               'case "$*" in *"{}"*) exit 1;; esac'.format(failing))
+
+    subprocess.run(command, env=env, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, check=True)
+    expected = sorted(
+        output_file(path)
+        for path in paths
+        if os.path.dirname(path) != failing)
+    if sorted(encoder_runs(work_dir)) != expected:
+        raise CheckFailed("expected {!r} to be encoded, got {!r}".format(
+            expected, sorted(encoder_runs(work_dir))))
+
+def check_dedupe(work_dir):
+    """
+    Build copies of a track with other tags, in the same run as the track
+    and in a later one, and check that their outputs are copied from the
+    output of the track with their own tags instead of being encoded.
+    """
+    paths, env, command = setup_library(work_dir, ["-i", "--dedupe"])
+    album_dir = os.path.dirname(paths[0])
+
+    for run, name in enumerate(["10 Copy.flac", "11 Copy.flac"]):
+        copy = os.path.join(album_dir, name)
+        shutil.copyfile(paths[0], copy)
+        set_flac_comment(copy, "TITLE", "copy {}".format(run))
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL,
+                       check=True)
+        encoded = encoder_runs(work_dir)
+        if len(encoded) != len(paths):
+            raise CheckFailed("expected {} encoder runs after run {}, got "
+                              "{}".format(len(paths), run + 1, len(encoded)))
+        output, original = output_file(copy), output_file(paths[0])
+        if output_comment(output, "TITLE") != "copy {}".format(run):
+            raise CheckFailed("title of {} is {!r}".format(
+                output, output_comment(output, "TITLE")))
+        if read_stream(output)[0][2:] != read_stream(original)[0][2:]:
+            raise CheckFailed("audio of {} differs from {}".format(
+                output, original))
+
+def check_distributed(work_dir):
+    """
+    Build a library with a coordinator and two local workers, one of which
+    is killed while it is encoding, and check that all outputs are built
+    and that the tasks of the killed worker have been requeued.
+    """
+    paths, env, command = setup_library(
+        work_dir, ["-v", "--listen", "unix:coordinator.sock"], tracks=6)
+    # slow enough for the worker to be killed while it is encoding
+    started_file = os.path.join(work_dir, "started")
+    write_stub(os.path.join(work_dir, "bin"), "opusenc",
+               'echo >> "{}"\nsleep 0.5\nexec "{}" "{}" --stub-opusenc "$@"'
+               .format(started_file, sys.executable,
+                       os.path.abspath(__file__)))
+    worker_command = [sys.executable, TRANSCODER,
+                      "--worker", "unix:coordinator.sock", "-j", "2"]
+    # the killed worker leaves its temporary directory behind
+    worker_env = dict(env, TMPDIR=work_dir)
+
+    def start_worker():
+        # in a process group of its own, to kill its encoders with it
+        workers.append(subprocess.Popen(
+            worker_command, env=worker_env, start_new_session=True))
+
+    coordinator = subprocess.Popen(
+        command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    workers = []
+    try:
+        wait_for(lambda: os.path.exists("coordinator.sock"), 30,
+                 "the coordinator to listen")
+        start_worker()
+        wait_for(lambda: os.path.exists(started_file), 30,
+                 "the first worker to start encoding")
+        start_worker()
+        os.killpg(workers[0].pid, signal.SIGKILL)
+        workers[0].wait()
+        try:
+            stderr = coordinator.communicate(timeout=60)[1]
+        except subprocess.TimeoutExpired:
+            raise CheckFailed("the coordinator has not finished")
+        for worker in workers[1:]:
+            if worker.wait(30) != 0:
+                raise CheckFailed("worker exited with status {}".format(
+                    worker.returncode))
+    finally:
+        if coordinator.poll() is None:
+            coordinator.kill()
+            coordinator.wait()
+        for worker in workers:
+            if worker.poll() is None:
+                os.killpg(worker.pid, signal.SIGKILL)
+                worker.wait()
+
+    if "lost worker" not in stderr:
+        raise CheckFailed("the killed worker has not been noticed")
+    missing = [
+        output_file(path)
+        for path in paths
+        if not os.path.isfile(output_file(path))
+    ]
+    if missing:
+        raise CheckFailed("outputs missing: {!r}".format(missing))
+
+def check_fanout(work_dir):
+    """
+    Encode a track to opus and vorbis with a single decoder in this process,
+    once with a vorbis encoder which fails without reading its input and once
+    with a decoder which fails half way, and check that only the outputs of
+    the failed encoders are removed, without partial files left behind.
+    This is done with the decoder output duplicated in the kernel, if
+    possible, and copied through userspace.
+    """
+    paths, env, command = setup_library(work_dir, [], tracks=1)
+    source = paths[0]
+    modes = ["userspace"]
+    if hasattr(os, "splice") and transcoder._load_tee():
+        modes.insert(0, "kernel")
+    scenarios = [
+        ("oggenc", "exit 1", [True, False]),
+        ("flac", "head -c 1000000 /dev/zero; exit 1", [False, False]),
+    ]
+    pipe_tee = transcoder._pipe_tee
+    tee_calls = []
+
+    def counting_tee(*args):
+        tee_calls.append(args)
+        return pipe_tee(*args)
+
+    saved_environ = dict(os.environ)
+    transcoder._pipe_tee = counting_tee
+    # the failing decoder is logged
+    logging.disable(logging.ERROR)
+    try:
+        for mode in modes:
+            transcoder._tee = None if mode == "kernel" else False
+            for failing, script, expected in scenarios:
+                what = "{} copy with failing {}".format(mode, failing)
+                bin_dir = os.path.join(work_dir, "failing-" + failing)
+                write_stub(bin_dir, failing, script)
+                os.environ.clear()
+                os.environ.update(env)
+                os.environ["PATH"] = os.pathsep.join([bin_dir, env["PATH"]])
+                output_dir = "out-{}-{}".format(mode, failing)
+                del tee_calls[:]
+
+                handle = transcoder.MultiEncoder([
+                    transcoder.OpusEncoder(source, output_dir),
+                    transcoder.VorbisEncoder(source, output_dir),
+                ])()
+                handle.wait()
+                if bool(tee_calls) != (mode == "kernel"):
+                    raise CheckFailed("{}: tee(2) called {} times".format(
+                        what, len(tee_calls)))
+                if handle.results != expected:
+                    raise CheckFailed("{}: results are {!r}".format(
+                        what, handle.results))
+                for suffix, built in zip(["opus", "ogg"], expected):
+                    output = transcoder.EncoderHandle._get_output_file(
+                        source, output_dir, suffix)
+                    if os.path.exists(output) != built:
+                        raise CheckFailed("{}: {} {}".format(
+                            what, output,
+                            "is missing" if built else "has been kept"))
+                    partial_file = \
+                        transcoder.EncoderHandle._get_partial_file(output)
+                    if os.path.exists(partial_file):
+                        raise CheckFailed("{}: {} has been left behind"
+                                          .format(what, partial_file))
+    finally:
+        logging.disable(logging.NOTSET)
+        transcoder._pipe_tee = pipe_tee
+        transcoder._tee = None
+        os.environ.clear()
+        os.environ.update(saved_environ)
+
+def check_gain(work_dir):
+    """
+    Build an album with gain tags, change the tags of one track and build it
+    again, and check that only that track is encoded again while the gain
+    tags of all tracks are written again.
+    """
+    paths, env, command = setup_library(
+        work_dir, ["-i", "--gain-tags"], tracks=3, duration=0.5)
+    outputs = [output_file(path) for path in paths]
+
+    subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+    if len(encoder_runs(work_dir)) != len(paths):
+        raise CheckFailed("expected {} encoder runs for the first build, "
+                          "got {}".format(len(paths),
+                                          len(encoder_runs(work_dir))))
+    album_gain = output_comment(outputs[1], "R128_ALBUM_GAIN")
+    if album_gain is None:
+        raise CheckFailed("no album gain in {}".format(outputs[1]))
+    for output in outputs:
+        # removed from the unchanged outputs, to see them written again
+        oggtags.set_comments(output, [], delete=["R128_ALBUM_GAIN"])
+
+    set_flac_comment(paths[0], "TITLE", "changed")
+    subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+    encoded = encoder_runs(work_dir)[len(paths):]
+    if encoded != [outputs[0]]:
+        raise CheckFailed("expected only {} to be encoded again, got "
+                          "{!r}".format(outputs[0], encoded))
+    for output in outputs:
+        if output_comment(output, "R128_ALBUM_GAIN") != album_gain:
+            raise CheckFailed("album gain of {} is {!r} instead of {!r}"
+                              .format(output,
+                                      output_comment(output,
+                                                     "R128_ALBUM_GAIN"),
+                                      album_gain))
+
+def check_journal(work_dir):
+    """
+    Resume a run from its journal after a source has been added and another
+    one has vanished, leaving a partial output behind, and check that only
+    the new source is encoded and the partial output is removed. Then check
+    that a changed source is encoded again once the run has been completed.
+    """
+    paths, env, command = setup_library(
+        work_dir, ["--journal", "journal"], albums=2)
+    subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+
+    # as if the run had been killed while encoding the vanished source
+    vanished = paths.pop()
+    partial_file = transcoder.EncoderHandle._get_partial_file(
+        output_file(vanished))
+    with open(partial_file, "wb") as f:
+        f.write(b"truncated")
+    os.unlink(vanished)
+    entries = []
+    with open("journal") as f:
+        for line in f:
+            if '"completed"' in line:
+                continue
+            if vanished not in line or '"queued"' in line:
+                entries.append(line)
+    with open("journal", "w") as f:
+        f.writelines(entries)
+    added = os.path.join(os.path.dirname(paths[0]), "10 Added.flac")
+    shutil.copyfile(paths[0], added)
+
+    subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+    encoded = encoder_runs(work_dir)[len(paths) + 1:]
+    expected = output_file(added)
+    if encoded != [expected]:
+        raise CheckFailed("expected only {} to be encoded, got {!r}".format(
+            expected, encoded))
+    if os.path.exists(partial_file):
+        raise CheckFailed("{} has not been removed".format(partial_file))
+
+    # the run has been completed: a changed source is not masked by the
+    # journal in the next one
+    with open(paths[0], "ab") as f:
+        f.write(b"\0")
+    runs = len(encoder_runs(work_dir))
+    subprocess.run(command, env=env, stdout=subprocess.DEVNULL, check=True)
+    if output_file(paths[0]) not in encoder_runs(work_dir)[runs:]:
+        raise CheckFailed("{} has not been encoded again after the run has "
+                          "been completed".format(paths[0]))
+
+def check_oggtags(work_dir):
+    """
+    Rewrite the comments of Ogg Vorbis and Opus files so that the comment
+    packet grows across a page boundary and shrinks back, in place and into
+    another file, and check that the other packets and the granule
+    positions of the audio pages are unchanged.
+    """
+    long_value = "x" * 70000
+    files = {
+        "vorbis.ogg": ogg_vorbis_file([("TITLE", "short")]),
+        "opus.opus": ogg_opus_file([("TITLE", "short")]),
+    }
+    for name, data in files.items():
+        path = os.path.join(work_dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        original_packets, original_granules = read_stream(path)
+        audio_pages = sum(
+            1 for granule in original_granules if granule > 0)
+
+        steps = [
+            (path, None, [("TITLE", "short"), ("LYRICS", long_value)]),
+            (path, None, [("TITLE", "short")]),
+            (path + ".copy", path, [("TITLE", "other"), ("X", long_value)]),
+            (path, path + ".copy", [("TITLE", "other")]),
+        ]
+        for target, source, comments in steps:
+            keys = [key for key, value in comments]
+            oggtags.set_comments(
+                target, comments,
+                delete=["LYRICS", "X"], source=source)
+            packets, granules = read_stream(target)
+            vendor, actual = oggtags.read_comments(target)
+            what = "{} with {}".format(name, ", ".join(keys))
+            if actual != comments:
+                raise CheckFailed("{}: comments are {!r}".format(
+                    what, [key for key, value in actual]))
+            if packets[:1] + packets[2:] != \
+                    original_packets[:1] + original_packets[2:]:
+                raise CheckFailed("{}: packets changed".format(what))
+            if granules[-audio_pages:] != original_granules[-audio_pages:]:
+                raise CheckFailed("{}: granule positions changed".format(
+                    what))
+            if (len(granules) > len(original_granules)) != \
+                    (long_value in dict(comments).values()):
+                raise CheckFailed("{}: {} pages instead of {}".format(
+                    what, len(granules), len(original_granules)))
+
+def check_watch(work_dir):
+    """
+    Edit the tags of a file twice while transcoder.py watches its library,
+    and check that the output follows both edits without being encoded
+    again, that the index is committed while transcoder.py is idle and that
+    it stops on SIGTERM.
+    """
+    paths, env, command = setup_library(
+        work_dir, ["-i", "--watch", "--watch-delay", "0.2"])
+    outputs = [output_file(path) for path in paths]
+
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+    try:
+        wait_for(lambda: all(map(os.path.isfile, outputs)), 30,
+                 "the initial outputs")
+        # the same length, so that only the contents of the file change
+        for title in ["edit one", "edit two"]:
+            set_flac_comment(paths[0], "TITLE", title)
+            wait_for(lambda: output_comment(outputs[0], "TITLE") == title, 30,
+                     "the title {!r} in the output".format(title))
+        index = os.path.join("out", transcoder.BuildIndex.filename)
+        wait_for(lambda: indexed_outputs(index) == len(paths), 30,
+                 "the index to be committed")
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            raise CheckFailed("transcoder.py has not stopped on SIGTERM")
+
+    encoded = encoder_runs(work_dir)
+    if len(encoded) != len(paths):
+        raise CheckFailed("expected {} encoder runs, got {}".format(
+            len(paths), len(encoded)))
+
+CHECKS = {
+    "dag": check_dag,
+    "dedupe": check_dedupe,
+    "distributed": check_distributed,
+    "fanout": check_fanout,
+    "gain": check_gain,
+    "journal": check_journal,
+    "oggtags": check_oggtags,
+    "watch": check_watch,
+}
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--stub-opusenc"]:
+        stub_opusenc(sys.argv[2:])
+        sys.exit(0)
+    if sys.argv[1:2] == ["--stub-flac"]:
+        stub_flac(sys.argv[2:])
+        sys.exit(0)
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Check behaviour of transcoder.py and oggtags.py which "
+                    "the benchmarks do not observe.")
+    parser.add_argument(
+        "checks",
+        nargs="*",
+        metavar="CHECK",
+        help="Checks to run (default all: {})".format(
+            ", ".join(sorted(CHECKS))),
+    )
+    args = parser.parse_args()
+    for name in args.checks:
+        if name not in CHECKS:
+            parser.error("unknown check: {}".format(name))
+
+    failed = 0
+    for name in args.checks or sorted(CHECKS):
+        work_dir = tempfile.mkdtemp(prefix="mmutils-check-")
+        cwd = os.getcwd()
+        try:
+            CHECKS[name](work_dir)
+        except CheckFailed as err:
+            print("{}: FAILED: {}".format(name, err))
+            failed += 1
+        else:
+            print("{}: ok".format(name))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(work_dir)
+    sys.exit(1 if failed else 0)
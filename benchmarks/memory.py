@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+# File name: memory.py
+# This file is part of: mmutils
+#
+# LICENSE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# FEEDBACK & QUESTIONS
+#
+# For feedback and questions about mmutils please e-mail one of the
+# authors named in the AUTHORS file.
+########################################################################
+"""
+Measure the memory held by queued tasks.
+
+A library is generated with :mod:`mkcorpus` (or an existing one is used),
+and the tasks for all of its files are created and queued in a
+:class:`transcoder.Scheduler` without starting any of them, as happens with
+a lookahead larger than the library. The memory allocated while doing so is
+measured with :mod:`tracemalloc` and reported per queued task and per file.
+Nothing is spawned, so no encoders are needed.
+"""
+
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(BENCHMARK_DIR)
+
+sys.path.insert(0, REPOSITORY_DIR)
+
+import mkcorpus
+import transcoder
+
+from run import git_revision
+
+def list_flac_files(root):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if transcoder.is_flac(filename):
+                paths.append(os.path.join(dirpath, filename))
+    return paths
+
+def measure(root, encoder_names, output_root, shared_decoder):
+    """
+    Queue the tasks for all files below *root* and return the results as
+    dictionary.
+    """
+    generator = transcoder.task_generator(
+        [
+            (transcoder.encoders[name], os.path.join(output_root, name))
+            for name in encoder_names
+        ],
+        shared_decoder=shared_decoder)
+    scheduler = transcoder.Scheduler(1)
+    # the walk itself is not part of what is measured
+    paths = list_flac_files(root)
+
+    gc.collect()
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for path in paths:
+        for task in generator(path):
+            scheduler.schedule(task)
+    elapsed = time.perf_counter() - started_at
+    gc.collect()
+    allocated = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    tasks = len(scheduler.pending_tasks)
+    return {
+        "encoders": encoder_names,
+        "shared_decoder": shared_decoder,
+        "files": len(paths),
+        "tasks": tasks,
+        "bytes": allocated,
+        "bytes_per_task": allocated / tasks if tasks else None,
+        "bytes_per_file": allocated / len(paths) if paths else None,
+        "seconds": elapsed,
+    }
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Measure the memory per queued task of transcoder.py.")
+    parser.add_argument(
+        "--corpus",
+        metavar="DIR",
+        default=None,
+        help="Use the library in DIR instead of generating one",
+    )
+    parser.add_argument(
+        "-x", "--encoder",
+        choices=sorted(transcoder.encoders),
+        action="append",
+        default=None,
+        help="Encoder to queue tasks for; can be given several times "
+             "(default opus, vorbis and mp3)",
+    )
+    parser.add_argument(
+        "--output",
+        metavar="FILE",
+        default=None,
+        help="Write the results to FILE instead of stdout",
+    )
+    corpus_group = parser.add_argument_group(
+        "library generation",
+        "Options for the generated library (ignored with --corpus)")
+    mkcorpus.add_arguments(corpus_group)
+    # many short files; the audio does not matter here
+    parser.set_defaults(
+        artists=20,
+        albums=10,
+        tracks=12,
+        min_duration=0.1,
+        max_duration=0.2,
+        extra_tags=8)
+    args = parser.parse_args()
+
+    encoder_names = args.encoder or ["opus", "vorbis", "mp3"]
+
+    work_dir = tempfile.mkdtemp(prefix="mmutils-benchmark-")
+    try:
+        if args.corpus is None:
+            root = os.path.join(work_dir, "corpus")
+            print("generating library in {}".format(root), file=sys.stderr)
+            mkcorpus.generate_from_args(root, args)
+        else:
+            root = os.path.abspath(args.corpus)
+
+        output_root = os.path.join(work_dir, "output")
+        runs = [
+            measure(root, encoder_names, output_root, shared_decoder)
+            for shared_decoder in [False, True]
+        ]
+
+        results = {
+            "revision": git_revision(),
+            "timestamp": time.time(),
+            "python": sys.version.split()[0],
+            "runs": runs,
+        }
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
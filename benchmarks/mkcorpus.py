@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+# File name: mkcorpus.py
+# This file is part of: mmutils
+#
+# LICENSE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# FEEDBACK & QUESTIONS
+#
+# For feedback and questions about mmutils please e-mail one of the
+# authors named in the AUTHORS file.
+########################################################################
+"""
+Generate a synthetic library of FLAC files for benchmarking.
+
+The files are laid out as ``Artist NN/Album NN/NN Track NN.flac`` and
+contain low-level noise from a seeded random number generator, so the same
+arguments always produce the same library. The audio is stored in VERBATIM
+subframes, which needs no actual compression but yields valid FLAC streams
+which the reference decoder accepts.
+"""
+
+import array
+import hashlib
+import os
+import random
+import struct
+import sys
+
+BLOCK_SIZE = 4096
+BITS_PER_SAMPLE = 16
+
+_SAMPLE_RATE_CODES = {
+    88200: 1,
+    176400: 2,
+    192000: 3,
+    8000: 4,
+    16000: 5,
+    22050: 6,
+    24000: 7,
+    32000: 8,
+    44100: 9,
+    48000: 10,
+    96000: 11,
+}
+
+def _crc_table(polynomial, width):
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    table = []
+    for byte in range(256):
+        crc = byte << (width - 8)
+        for i in range(8):
+            crc = ((crc << 1) ^ polynomial) if crc & top else (crc << 1)
+        table.append(crc & mask)
+    return table
+
+_CRC8_TABLE = _crc_table(0x07, 8)
+_CRC16_TABLE = _crc_table(0x8005, 16)
+
+def crc8(data):
+    crc = 0
+    table = _CRC8_TABLE
+    for byte in data:
+        crc = table[crc ^ byte]
+    return crc
+
+def crc16(data):
+    crc = 0
+    table = _CRC16_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xffff) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+def _utf8_number(value):
+    """
+    Encode *value* with the extended UTF-8 scheme used for frame numbers.
+    """
+    if value < 0x80:
+        return bytes([value])
+    payload = []
+    while True:
+        payload.insert(0, 0x80 | (value & 0x3f))
+        value >>= 6
+        # the lead byte has 6 - len(payload) bits left for the value
+        if value < (1 << (6 - len(payload))):
+            break
+    lead = (0xff00 >> (len(payload) + 1)) & 0xff | value
+    return bytes([lead] + payload)
+
+def _metadata_block(block_type, data, last=False):
+    return bytes([block_type | (0x80 if last else 0)]) + \
+        len(data).to_bytes(3, "big") + data
+
+def _vorbis_comment(tags):
+    vendor = b"mmutils benchmark corpus"
+    parts = [struct.pack("<I", len(vendor)), vendor,
+             struct.pack("<I", len(tags))]
+    for key, value in tags:
+        entry = "{}={}".format(key, value).encode("utf-8")
+        parts.append(struct.pack("<I", len(entry)))
+        parts.append(entry)
+    return b"".join(parts)
+
+def _picture(data):
+    mime = b"image/jpeg"
+    return b"".join([
+        struct.pack(">II", 3, len(mime)), mime,
+        struct.pack(">I", 0),
+        struct.pack(">IIIII", 500, 500, 24, 0, len(data)), data,
+    ])
+
+def _noise(rng, length, amplitude_bits=12):
+    """
+    Return *length* bytes of 16-bit little-endian noise with samples in
+    ``[-2**amplitude_bits, 2**amplitude_bits)``.
+    """
+    pcm = bytearray(rng.randbytes(length))
+    high_bits = amplitude_bits - 8
+    keep = (1 << high_bits) - 1
+    sign_fill = 0xff & ~keep
+    # sign-extend the high byte of each sample from high_bits + 1 bits
+    table = bytes(
+        (byte & keep) | (sign_fill if byte & 0x80 else 0)
+        for byte in range(256))
+    pcm[1::2] = pcm[1::2].translate(table)
+    return bytes(pcm)
+
+def _frame(number, samples, channels, sample_rate):
+    block_size = len(samples) // channels
+    header = bytearray(b"\xff\xf8")
+    header.append((7 << 4) | _SAMPLE_RATE_CODES.get(sample_rate, 0))
+    header.append(((channels - 1) << 4) | (4 << 1))
+    header += _utf8_number(number)
+    header += (block_size - 1).to_bytes(2, "big")
+    header.append(crc8(header))
+
+    frame = header
+    for channel in range(channels):
+        channel_samples = samples[channel::channels]
+        # VERBATIM samples are stored big-endian
+        if sys.byteorder == "little":
+            channel_samples.byteswap()
+        # subframe header: VERBATIM, no wasted bits
+        frame.append(0x02)
+        frame += channel_samples.tobytes()
+    frame += crc16(frame).to_bytes(2, "big")
+    return bytes(frame)
+
+def write_flac(path, duration, tags=(),
+        sample_rate=44100,
+        channels=2,
+        picture_size=0,
+        seed=0):
+    """
+    Write a FLAC file with *duration* seconds of noise and the given *tags*
+    (a sequence of ``(key, value)`` pairs) to *path*.
+
+    If *picture_size* is non-zero, a PICTURE block with that many bytes of
+    (junk) image data is added, as found in many ripped libraries.
+    """
+    rng = random.Random(seed)
+    total_samples = int(duration * sample_rate)
+    bytes_per_sample = BITS_PER_SAMPLE // 8
+    pcm = _noise(rng, total_samples * channels * bytes_per_sample)
+
+    packed = (sample_rate << 44) | ((channels - 1) << 41) | \
+        ((BITS_PER_SAMPLE - 1) << 36) | total_samples
+    streaminfo = struct.pack(
+        ">HH3s3sQ16s",
+        BLOCK_SIZE, BLOCK_SIZE,
+        b"\0\0\0", b"\0\0\0",
+        packed,
+        hashlib.md5(pcm).digest())
+
+    blocks = [
+        (0, streaminfo),
+        (4, _vorbis_comment(tags)),
+    ]
+    if picture_size:
+        blocks.append((6, _picture(rng.randbytes(picture_size))))
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"fLaC")
+        for i, (block_type, data) in enumerate(blocks):
+            f.write(_metadata_block(block_type, data,
+                                    last=(i == len(blocks) - 1)))
+        samples = array.array("h", pcm)
+        if sys.byteorder == "big":
+            samples.byteswap()
+        step = BLOCK_SIZE * channels
+        for number, start in enumerate(range(0, len(samples), step)):
+            f.write(_frame(number, samples[start:start+step],
+                           channels, sample_rate))
+
+def generate(root,
+        artists=4,
+        albums=3,
+        tracks=10,
+        min_duration=1.0,
+        max_duration=4.0,
+        extra_tags=0,
+        picture_size=0,
+        seed=0):
+    """
+    Generate a library below *root* and return the list of file paths.
+
+    Track durations are drawn uniformly from [*min_duration*,
+    *max_duration*]. Each file gets the usual ARTIST, ALBUM, TITLE,
+    TRACKNUMBER, DISCNUMBER and DATE tags plus *extra_tags* COMMENT entries.
+    """
+    rng = random.Random(seed)
+    paths = []
+    for artist in range(artists):
+        for album in range(albums):
+            directory = os.path.join(
+                root,
+                "Artist {:02d}".format(artist),
+                "Album {:02d}".format(album))
+            for track in range(tracks):
+                path = os.path.join(
+                    directory,
+                    "{:02d} Track {:02d}.flac".format(track + 1, track + 1))
+                tags = [
+                    ("ARTIST", "Artist {}".format(artist)),
+                    ("ALBUM", "Album {}".format(album)),
+                    ("TITLE", "Track {}".format(track + 1)),
+                    ("TRACKNUMBER", str(track + 1)),
+                    ("DISCNUMBER", "1"),
+                    ("DATE", str(1970 + artist)),
+                ]
+                tags.extend(
+                    ("COMMENT", "comment {} of track {}".format(i, track + 1))
+                    for i in range(extra_tags))
+                write_flac(
+                    path,
+                    rng.uniform(min_duration, max_duration),
+                    tags,
+                    picture_size=picture_size,
+                    seed=rng.getrandbits(32))
+                paths.append(path)
+    return paths
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--artists",
+        type=int,
+        default=4,
+        help="Number of artist directories (default 4)",
+    )
+    parser.add_argument(
+        "--albums",
+        type=int,
+        default=3,
+        help="Number of albums per artist (default 3)",
+    )
+    parser.add_argument(
+        "--tracks",
+        type=int,
+        default=10,
+        help="Number of tracks per album (default 10)",
+    )
+    parser.add_argument(
+        "--min-duration",
+        metavar="SECONDS",
+        type=float,
+        default=1.0,
+        help="Minimum track duration (default 1)",
+    )
+    parser.add_argument(
+        "--max-duration",
+        metavar="SECONDS",
+        type=float,
+        default=4.0,
+        help="Maximum track duration (default 4)",
+    )
+    parser.add_argument(
+        "--extra-tags",
+        metavar="COUNT",
+        type=int,
+        default=0,
+        help="Number of additional COMMENT tags per file (default 0)",
+    )
+    parser.add_argument(
+        "--picture-size",
+        metavar="BYTES",
+        type=int,
+        default=0,
+        help="Add a PICTURE block of this size to each file (default none)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for durations and audio (default 0)",
+    )
+
+def generate_from_args(root, args):
+    return generate(
+        root,
+        artists=args.artists,
+        albums=args.albums,
+        tracks=args.tracks,
+        min_duration=args.min_duration,
+        max_duration=args.max_duration,
+        extra_tags=args.extra_tags,
+        picture_size=args.picture_size,
+        seed=args.seed)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic FLAC library for benchmarks.")
+    add_arguments(parser)
+    parser.add_argument(
+        "root",
+        help="Directory to create the library in",
+    )
+    args = parser.parse_args()
+
+    paths = generate_from_args(args.root, args)
+    print("generated {} files below {}".format(len(paths), args.root))
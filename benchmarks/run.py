@@ -0,0 +1,324 @@
+#!/usr/bin/python3
+# File name: run.py
+# This file is part of: mmutils
+#
+# LICENSE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# FEEDBACK & QUESTIONS
+#
+# For feedback and questions about mmutils please e-mail one of the
+# authors named in the AUTHORS file.
+########################################################################
+"""
+Benchmark transcoder.py on a synthetic library.
+
+The library is generated with :mod:`mkcorpus` (or an existing one is used)
+and transcoder.py is run on it, with the stub executables from ``stubs/``
+first on PATH and/or with the real encoders. The stubs copy data around
+instead of decoding and encoding it, so the stub runs measure the overhead
+of the coordinating process (scanning, scheduling, spawning) rather than
+the speed of the encoders.
+
+Each run reports tasks per second, the idle time of the slots (slot-seconds
+during which no task was running, including the startup of the process and
+the scan) and the peak RSS. The directory scan is also timed on its own, in
+this process. The results are written as JSON, to be compared between
+commits.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(BENCHMARK_DIR)
+STUB_DIR = os.path.join(BENCHMARK_DIR, "stubs")
+TRANSCODER = os.path.join(REPOSITORY_DIR, "transcoder.py")
+
+sys.path.insert(0, REPOSITORY_DIR)
+
+import mkcorpus
+import transcoder
+
+# executables needed by the encoders when running for real
+REQUIRED_PROGRAMS = {
+    "opus": "opusenc",
+    "vorbis": "oggenc",
+    "ogg": "oggenc",
+    "ogg+vorbis": "oggenc",
+    "mp3": "lame",
+}
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPOSITORY_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def describe_corpus(root):
+    files = 0
+    size = 0
+    audio_seconds = 0.0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if not transcoder.is_flac(filename):
+                continue
+            path = os.path.join(dirpath, filename)
+            files += 1
+            size += os.path.getsize(path)
+            streaminfo = transcoder.flacmeta.read_metadata(
+                path,
+                blocks={transcoder.flacmeta.BLOCK_STREAMINFO}).streaminfo
+            audio_seconds += streaminfo.duration or 0
+    return {
+        "path": root,
+        "files": files,
+        "bytes": size,
+        "audio_seconds": audio_seconds,
+    }
+
+def benchmark_scan(root, encoder_names, output_root):
+    """
+    Time scanning *root* and creating the tasks, including reading the
+    STREAMINFO block for the task weight as the scheduler does.
+    """
+    generator = transcoder.task_generator([
+        (transcoder.encoders[name], os.path.join(output_root, name))
+        for name in encoder_names
+    ])
+    started_at = time.perf_counter()
+    tasks = 0
+    audio_seconds = 0.0
+    for task in transcoder.scan_dir(root, lambda: None, generator):
+        audio_seconds += task.weight
+        tasks += 1
+    elapsed = time.perf_counter() - started_at
+    files = sum(
+        sum(map(transcoder.is_flac, filenames))
+        for dirpath, dirnames, filenames in os.walk(root))
+    return {
+        "files": files,
+        "tasks": tasks,
+        "audio_seconds": audio_seconds,
+        "seconds": elapsed,
+        "files_per_second": files / elapsed if elapsed > 0 else None,
+    }
+
+def read_events(path):
+    events = []
+    with open(path) as f:
+        for line in f:
+            events.append(json.loads(line))
+    return events
+
+def benchmark_run(root, mode, parallel, encoder_names, extra_args, work_dir):
+    """
+    Run transcoder.py once on *root* and return the results as dictionary.
+    """
+    result = {
+        "mode": mode,
+        "parallel": parallel,
+        "encoders": encoder_names,
+        "args": extra_args,
+    }
+
+    env = dict(os.environ)
+    if mode == "stub":
+        env["PATH"] = STUB_DIR + os.pathsep + env.get("PATH", "")
+    else:
+        missing = [
+            program
+            for program in ["flac"] + [
+                REQUIRED_PROGRAMS[name] for name in encoder_names]
+            if shutil.which(program) is None
+        ]
+        if missing:
+            result["skipped"] = "not found: " + ", ".join(sorted(set(missing)))
+            return result
+
+    run_dir = tempfile.mkdtemp(dir=work_dir)
+    events_path = os.path.join(run_dir, "events.jsonl")
+    command = [
+        sys.executable, TRANSCODER,
+        "-j", str(parallel),
+        "--progress-format", "jsonl",
+        "--progress-output", events_path,
+        "--progress-interval", "1",
+    ]
+    for name in encoder_names:
+        command.extend(["-x", name, os.path.join(run_dir, name)])
+    command.extend(extra_args)
+    command.append(root)
+
+    wall_started_at = time.time()
+    started_at = time.perf_counter()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+    pid, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.perf_counter() - started_at
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    events = read_events(events_path)
+    finished = [
+        event for event in events
+        if event["event"] in ("finish", "fail")
+    ]
+    starts = [event["time"] for event in events if event["event"] == "start"]
+    busy_time = sum(event["wall_time"] for event in finished)
+    idle_time = max(parallel * wall_time - busy_time, 0.0)
+
+    result.update({
+        "returncode": process.returncode,
+        "wall_time": wall_time,
+        "tasks": len(finished),
+        "tasks_failed": sum(
+            1 for event in finished if event["event"] == "fail"),
+        "tasks_per_second": len(finished) / wall_time,
+        "time_to_first_task": \
+            min(starts) - wall_started_at if starts else None,
+        "slot_busy_time": busy_time,
+        "slot_idle_time": idle_time,
+        "slot_idle_fraction": idle_time / (parallel * wall_time),
+        # the peak of the process and of its children, which are forked
+        # from it
+        "peak_rss_kib": rusage.ru_maxrss,
+        "user_time": rusage.ru_utime,
+        "system_time": rusage.ru_stime,
+    })
+    shutil.rmtree(run_dir)
+    return result
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark transcoder.py on a synthetic FLAC library.")
+    parser.add_argument(
+        "--corpus",
+        metavar="DIR",
+        default=None,
+        help="Use the library in DIR instead of generating one",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["stub", "real", "both"],
+        default="stub",
+        help="Run with the stub executables, the real encoders or both "
+             "(default stub)",
+    )
+    parser.add_argument(
+        "-j", "--parallel",
+        metavar="COUNT",
+        type=int,
+        action="append",
+        default=None,
+        help="Number of parallel tasks; can be given several times "
+             "(default 1 and 4)",
+    )
+    parser.add_argument(
+        "-x", "--encoder",
+        choices=sorted(REQUIRED_PROGRAMS),
+        action="append",
+        default=None,
+        help="Encoder to run; can be given several times (default opus)",
+    )
+    parser.add_argument(
+        "--repeat",
+        metavar="COUNT",
+        type=int,
+        default=1,
+        help="Number of runs per configuration (default 1)",
+    )
+    parser.add_argument(
+        "--output",
+        metavar="FILE",
+        default=None,
+        help="Write the results to FILE instead of stdout",
+    )
+    parser.add_argument(
+        "transcoder_args",
+        nargs="*",
+        help="Additional arguments for transcoder.py (after --)",
+    )
+    corpus_group = parser.add_argument_group(
+        "library generation",
+        "Options for the generated library (ignored with --corpus)")
+    mkcorpus.add_arguments(corpus_group)
+    args = parser.parse_args()
+
+    parallel_counts = args.parallel or [1, 4]
+    encoder_names = args.encoder or ["opus"]
+    modes = ["stub", "real"] if args.mode == "both" else [args.mode]
+
+    work_dir = tempfile.mkdtemp(prefix="mmutils-benchmark-")
+    try:
+        if args.corpus is None:
+            root = os.path.join(work_dir, "corpus")
+            print("generating library in {}".format(root), file=sys.stderr)
+            mkcorpus.generate_from_args(root, args)
+            generated = {
+                key: getattr(args, key)
+                for key in ["artists", "albums", "tracks", "min_duration",
+                            "max_duration", "extra_tags", "picture_size",
+                            "seed"]
+            }
+        else:
+            root = os.path.abspath(args.corpus)
+            generated = None
+
+        corpus = describe_corpus(root)
+        corpus["generated"] = generated
+
+        scan = benchmark_scan(
+            root,
+            encoder_names,
+            os.path.join(work_dir, "scan-output"))
+
+        runs = []
+        for mode in modes:
+            for parallel in parallel_counts:
+                for i in range(args.repeat):
+                    print("running {} with -j {} ({}/{})".format(
+                        mode, parallel, i+1, args.repeat), file=sys.stderr)
+                    runs.append(benchmark_run(
+                        root, mode, parallel, encoder_names,
+                        args.transcoder_args, work_dir))
+
+        results = {
+            "revision": git_revision(),
+            "timestamp": time.time(),
+            "python": sys.version.split()[0],
+            "cpus": os.cpu_count(),
+            "corpus": corpus,
+            "scan": scan,
+            "runs": runs,
+        }
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
@@ -0,0 +1,962 @@
+# File name: distributed.py
+# This file is part of: mmutils
+#
+# LICENSE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# FEEDBACK & QUESTIONS
+#
+# For feedback and questions about mmutils please e-mail one of the
+# authors named in the AUTHORS file.
+########################################################################
+"""
+Run the tasks of a :class:`transcoder.Scheduler` on remote workers.
+
+A :class:`Coordinator` listens on a TCP or Unix socket and hands the
+encoding tasks of the scheduler to the :class:`Worker` processes which
+connect to it (``transcoder.py --listen`` and ``transcoder.py --worker``).
+Both sides exchange frames of a JSON header and an optional binary payload
+(see :func:`encode_frame` and :class:`FrameReader`).
+"""
+
+import collections
+import concurrent.futures
+import errno
+import functools
+import hmac
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import selectors
+import shutil
+import socket
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+
+import transcoder
+
+logger = logging.getLogger()
+
+def parse_address(address):
+    """
+    Parse ``unix:PATH`` or ``HOST:PORT`` into an ``(family, address)`` tuple
+    for :mod:`socket`.
+    """
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, sep, port = address.rpartition(":")
+    if not sep:
+        raise ValueError("invalid address: {!r}".format(address))
+    return socket.AF_INET6 if ":" in host else socket.AF_INET, \
+        (host.strip("[]"), int(port))
+
+def remove_stale_socket(path):
+    """
+    Remove the Unix socket at *path* if it is left over from a process which
+    is gone, so that it can be bound again.
+
+    Raise :class:`OSError` if *path* is not a socket, or if something is
+    still listening on it.
+    """
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise OSError(errno.EEXIST, "exists and is not a socket", path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise OSError(errno.EADDRINUSE, "already in use", path)
+
+def is_loopback_address(address):
+    """
+    Return whether *address* (see :func:`parse_address`) can only be reached
+    from the local host.
+    """
+    family, addr = parse_address(address)
+    if family == socket.AF_UNIX or addr[0] == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(addr[0]).is_loopback
+    except ValueError:
+        return False
+
+def authenticate(secret, challenge):
+    """
+    Return the response to the hex encoded *challenge* of a
+    :class:`Coordinator` for the shared *secret* (:class:`bytes`).
+    """
+    return hmac.new(
+        secret, bytes.fromhex(challenge), "sha256").hexdigest()
+
+def encode_frame(header, payload=b""):
+    """
+    Encode a protocol frame: a 32 bit big endian length, a JSON header of that
+    length and *payload*, whose length is stored in the header as ``size``.
+    """
+    if payload:
+        header = dict(header, size=len(payload))
+    data = json.dumps(header).encode("utf-8")
+    return len(data).to_bytes(4, "big") + data + payload
+
+class FrameReader:
+    """
+    Reassemble frames (see :func:`encode_frame`) from a byte stream.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Add *data* and return a list of the ``(header, payload)`` tuples
+        completed by it.
+        """
+        self._buffer.extend(data)
+        frames = []
+        while len(self._buffer) >= 4:
+            header_length = int.from_bytes(self._buffer[:4], "big")
+            if len(self._buffer) < 4 + header_length:
+                break
+            header = json.loads(
+                self._buffer[4:4+header_length].decode("utf-8"))
+            end = 4 + header_length + header.get("size", 0)
+            if len(self._buffer) < end:
+                break
+            payload = bytes(self._buffer[4+header_length:end])
+            del self._buffer[:end]
+            frames.append((header, payload))
+        return frames
+
+def encoder_task_spec(task):
+    """
+    Describe the :class:`transcoder.Encoder` *task* for a remote worker.
+
+    Return the header of the task frame. The command line contains
+    :data:`None` in place of the output file name.
+    """
+    comments = task._get_metadata()
+    command = [
+        None if item is transcoder.PipeEncoderHandle.OutFileToken else item
+        for item in task._get_command(comments)
+    ]
+    header = {
+        "type": "task",
+        "source": task.flac_file,
+        "output": task._get_output_file(),
+        "suffix": task._get_encoder_handle_class().suffix,
+        "command": command,
+    }
+    return header
+
+class RemoteTaskHandle(transcoder.TaskHandle):
+    """
+    Handle for a task which has been handed to a remote worker.
+    """
+
+    def __init__(self, task_id, task, worker):
+        super().__init__()
+        self.task_id = task_id
+        self.task = task
+        self.worker = worker
+        self.weight = task.weight
+        self.returncode = None
+        self.started = False
+        # the worker this task is being revoked for, if any
+        self.revoking = None
+        # partial output received from a worker without shared storage
+        self._output = None
+        self._output_file = None
+        self._output_error = None
+
+    def _lost(self):
+        self.requeue = True
+        self.returncode = -1
+
+    def _write_output(self, data):
+        """
+        Append *data* to the partial output file. Called on the I/O thread
+        of the coordinator.
+        """
+        if self._output_error is not None:
+            return
+        try:
+            if self._output is None:
+                handle_class = self.task._get_encoder_handle_class()
+                self._output_file = \
+                    transcoder.EncoderHandle._ensure_output_file(
+                        self.task.flac_file,
+                        self.task.output_directory,
+                        handle_class.suffix,
+                        sanitise=handle_class.sanitise_names)
+                self._output = open(
+                    transcoder.EncoderHandle._get_partial_file(
+                        self._output_file),
+                    "wb")
+            self._output.write(data)
+        except OSError as exc:
+            self._output_error = exc
+
+    def _finish_output(self, success):
+        """
+        Move the partial output file into place if *success* is true, remove
+        it otherwise. Called on the I/O thread of the coordinator.
+        """
+        if success:
+            # create the output even if the worker sent no data
+            self._write_output(b"")
+        if self._output is not None:
+            self._output.close()
+            self._output = None
+            transcoder.EncoderHandle._commit_output(
+                transcoder.EncoderHandle._get_partial_file(self._output_file),
+                self._output_file,
+                success and self._output_error is None)
+        if success and self._output_error is not None:
+            raise self._output_error
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            self.worker.coordinator.process(None)
+        return self.returncode
+
+    def term(self):
+        if self.returncode is None:
+            self.worker.send({"type": "cancel", "id": self.task_id})
+
+    kill = term
+
+    def __repr__(self):
+        return "<{!r} on {}>".format(self.task, self.worker.name)
+
+class RemoteWorker:
+    """
+    State of a worker connection on the coordinator side.
+    """
+
+    def __init__(self, coordinator, sock, address):
+        self.coordinator = coordinator
+        self.sock = sock
+        self.name = str(address) or "unix"
+        self.slots = 0
+        self.capacity = 0
+        self.shared_storage = False
+        self.handles = {}
+        # number of tasks being revoked from other workers for this one
+        self.steals = 0
+        self.last_seen = time.monotonic()
+        self.challenge = os.urandom(32).hex()
+        # [task id, source file, offset] of the sources left to send
+        self.uploads = collections.deque()
+        # whether a chunk of the first upload is being read
+        self.reading = False
+        self._reader = FrameReader()
+        self._outbuf = bytearray()
+
+    @property
+    def queued(self):
+        return [handle for handle in self.handles.values()
+                if not handle.started]
+
+    @property
+    def running(self):
+        return len(self.handles) - len(self.queued)
+
+    def send(self, header, payload=b""):
+        self._outbuf.extend(encode_frame(header, payload))
+        self.coordinator._update_events(self)
+
+    def flush(self):
+        if not self._outbuf:
+            return
+        try:
+            sent = self.sock.send(self._outbuf)
+        except BlockingIOError:
+            return
+        del self._outbuf[:sent]
+        self.coordinator._update_events(self)
+        self.coordinator._pump(self)
+
+    def read(self):
+        try:
+            data = self.sock.recv(1 << 20)
+        except BlockingIOError:
+            return []
+        if not data:
+            raise ConnectionResetError("connection closed by worker")
+        self.last_seen = time.monotonic()
+        return self._reader.feed(data)
+
+class Coordinator:
+    """
+    Hand the tasks of a :class:`transcoder.Scheduler` to remote workers.
+
+    Workers (see :class:`Worker`) connect to *address*, announce their number
+    of slots and pull tasks. A connection only becomes a worker once it has
+    said hello; if *secret* (:class:`bytes`) is given, the hello must carry
+    the HMAC of a random challenge sent by the coordinator, keyed with the
+    secret (see :func:`authenticate`). Connections which do not say hello
+    within :attr:`worker_timeout` seconds are closed. The scheduler's
+    :attr:`transcoder.Scheduler.max_tasks` is kept at the total capacity of the
+    connected workers, which is their slot count plus :attr:`Worker.prefetch`
+    queued tasks each.
+
+    :class:`transcoder.DirectoryFilter` tasks are run locally. The exit of
+    their processes is noticed through *child_watcher*, a
+    :class:`transcoder.ChildWatcher`, if given, and by polling otherwise.
+
+    Workers which have not sent anything (including heartbeats) for
+    :attr:`worker_timeout` seconds, or whose connection breaks, are dropped and
+    their tasks are requeued. If a worker runs out of work while the
+    scheduler has nothing pending, the heaviest task queued on the most
+    loaded other worker is revoked and requeued, so that the idle worker can
+    take it (work stealing).
+
+    Workers either share the storage with the coordinator, in which case they
+    read the sources and write the outputs themselves, or the source is
+    sent after the task and the output is sent back, both in frames of up to
+    :attr:`chunk_size` bytes. The files are read and written on a separate
+    I/O thread, and the next chunk of a source is only read once the
+    previous one has been handed to the connection, so neither the loop nor
+    the memory use depend on the size of the files.
+    """
+
+    worker_timeout = 10.0
+    chunk_size = 1 << 18
+
+    def __init__(self, scheduler, address, secret=None, child_watcher=None):
+        self.scheduler = scheduler
+        self.secret = secret
+        self.child_watcher = child_watcher
+        self.workers = {}
+        # connections which have not said hello yet
+        self._connecting = {}
+        self._task_ids = itertools.count()
+        self._selector = selectors.DefaultSelector()
+
+        family, addr = parse_address(address)
+        if family == socket.AF_UNIX:
+            remove_stale_socket(addr)
+        self._listener = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self._listener.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(addr)
+        self._listener.listen()
+        self._listener.setblocking(False)
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        if child_watcher is not None:
+            self._selector.register(child_watcher, selectors.EVENT_READ)
+
+        # the I/O thread wakes up the loop through this socket pair
+        self._io = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="coordinator-io")
+        self._io_done = collections.deque()
+        self._wakeup = socket.socketpair()
+        for sock in self._wakeup:
+            sock.setblocking(False)
+        self._selector.register(self._wakeup[0], selectors.EVENT_READ, self)
+
+        scheduler.launcher = self.launch
+        scheduler.max_tasks = 0
+
+    def _update_events(self, worker):
+        events = selectors.EVENT_READ
+        if worker._outbuf:
+            events |= selectors.EVENT_WRITE
+        self._selector.modify(worker.sock, events, worker)
+
+    def _submit_io(self, callback, function, *args):
+        """
+        Run *function* on the I/O thread, which is single threaded so that
+        the calls run in order. *callback*, if given, is called with the
+        future from :meth:`process` once it is done.
+        """
+        future = self._io.submit(function, *args)
+        if callback is not None:
+            future.add_done_callback(
+                functools.partial(self._wake_up, callback))
+
+    def _wake_up(self, callback, future):
+        self._io_done.append((callback, future))
+        try:
+            self._wakeup[1].send(b"\0")
+        except BlockingIOError:
+            pass
+
+    @staticmethod
+    def _read_chunk(path, offset, size):
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def _pump(self, worker):
+        """
+        Read the next chunk of the sources to send to *worker*, unless one is
+        being read already or the send buffer is still full.
+        """
+        if worker.reading or len(worker._outbuf) >= self.chunk_size:
+            return
+        while worker.uploads and worker.uploads[0][0] not in worker.handles:
+            worker.uploads.popleft()
+        if not worker.uploads:
+            return
+        task_id, path, offset = upload = worker.uploads[0]
+        worker.reading = True
+        self._submit_io(
+            functools.partial(self._send_chunk, worker, upload),
+            self._read_chunk, path, offset, self.chunk_size)
+
+    def _send_chunk(self, worker, upload, future):
+        worker.reading = False
+        if worker.sock not in self.workers:
+            return
+        task_id, path, offset = upload
+        handle = worker.handles.get(task_id)
+        if handle is None:
+            self._pump(worker)
+            return
+        try:
+            data = future.result()
+        except OSError as exc:
+            logger.error("cannot read %s: %s", path, exc)
+            worker.uploads.popleft()
+            self._forget(worker, handle)
+            worker.send({"type": "cancel", "id": task_id})
+            handle.returncode = 1
+            self._pump(worker)
+            return
+        end = len(data) < self.chunk_size
+        if end:
+            worker.uploads.popleft()
+        upload[2] += len(data)
+        worker.send({"type": "source", "id": task_id, "end": end}, data)
+        self._pump(worker)
+
+    def _stored(self, handle, returncode, future):
+        try:
+            future.result()
+        except OSError as exc:
+            logger.error("cannot store output of %r: %s", handle.task, exc)
+            returncode = 1
+        handle.returncode = returncode
+
+    def _update_capacity(self):
+        self.scheduler.max_tasks = sum(
+            worker.capacity
+            for worker in self.workers.values())
+
+    def _accept(self):
+        sock, address = self._listener.accept()
+        sock.setblocking(False)
+        worker = RemoteWorker(self, sock, address)
+        self._connecting[sock] = worker
+        self._selector.register(sock, selectors.EVENT_READ, worker)
+        worker.send({"type": "challenge", "challenge": worker.challenge})
+
+    def _drop(self, worker, reason):
+        self._selector.unregister(worker.sock)
+        worker.sock.close()
+        if self._connecting.pop(worker.sock, None) is not None:
+            logger.warning("rejected connection from %s: %s",
+                           worker.name, reason)
+            return
+        logger.warning("lost worker %s: %s", worker.name, reason)
+        del self.workers[worker.sock]
+        for handle in worker.handles.values():
+            if handle.revoking is not None:
+                handle.revoking.steals -= 1
+                handle.revoking = None
+            handle._lost()
+            if not worker.shared_storage:
+                self._submit_io(None, handle._finish_output, False)
+        worker.handles.clear()
+        worker.uploads.clear()
+        for other in self.workers.values():
+            for handle in other.handles.values():
+                if handle.revoking is worker:
+                    handle.revoking = None
+        self._update_capacity()
+
+    def _forget(self, worker, handle):
+        del worker.handles[handle.task_id]
+        if handle.revoking is not None:
+            handle.revoking.steals -= 1
+            handle.revoking = None
+
+    def _register(self, worker, header):
+        if header.get("type") != "hello":
+            raise ValueError("expected hello")
+        if self.secret is not None and not hmac.compare_digest(
+                authenticate(self.secret, worker.challenge),
+                str(header.get("auth"))):
+            raise ValueError("authentication failed")
+        worker.name = header.get("name", worker.name)
+        worker.slots = header["slots"]
+        worker.capacity = worker.slots + header.get("prefetch", 0)
+        worker.shared_storage = header.get("shared_storage", False)
+        del self._connecting[worker.sock]
+        self.workers[worker.sock] = worker
+        logging.info("worker %s offers %d slots", worker.name, worker.slots)
+        self._update_capacity()
+
+    def _handle_frame(self, worker, header, payload):
+        if worker.sock in self._connecting:
+            self._register(worker, header)
+            return
+        kind = header.get("type")
+        if kind == "heartbeat":
+            return
+
+        handle = worker.handles.get(header.get("id"))
+        if handle is None:
+            return
+        if kind == "started":
+            handle.started = True
+        elif kind == "revoked":
+            if header.get("ok"):
+                self._forget(worker, handle)
+                handle._lost()
+            elif handle.revoking is not None:
+                handle.revoking.steals -= 1
+                handle.revoking = None
+        elif kind == "output":
+            self._submit_io(None, handle._write_output, payload)
+        elif kind == "done":
+            self._forget(worker, handle)
+            returncode = header["returncode"]
+            if worker.shared_storage:
+                handle.returncode = returncode
+            else:
+                self._submit_io(
+                    functools.partial(self._stored, handle, returncode),
+                    handle._finish_output, returncode == 0)
+
+    def _steal(self):
+        if self.scheduler.has_pending():
+            return
+        for thief in self.workers.values():
+            while len(thief.handles) + thief.steals < thief.slots:
+                candidates = [
+                    handle
+                    for worker in self.workers.values()
+                    if worker is not thief
+                    for handle in worker.queued
+                    if handle.revoking is None
+                ]
+                if not candidates:
+                    return
+                handle = max(candidates, key=lambda handle: handle.weight)
+                logging.debug("revoking %r for %s", handle, thief.name)
+                handle.revoking = thief
+                thief.steals += 1
+                handle.worker.send({"type": "revoke", "id": handle.task_id})
+
+    def launch(self, task):
+        """
+        Send *task* to the worker with the most free capacity and return a
+        :class:`RemoteTaskHandle` for it.
+
+        :class:`transcoder.DirectoryFilter` tasks are run locally, as they
+        modify the sources.
+        """
+        if isinstance(task, transcoder.DirectoryFilter) or \
+                task._kwargs.get("dry_run", False):
+            return task()
+
+        out_file = task._get_output_file()
+        if task._kwargs.get("skip_existing", False) and \
+                os.path.isfile(out_file):
+            logging.info("skipping existing file: %s", out_file)
+            handle = transcoder.DummyTaskHandle()
+            return handle
+
+        # prefer idle slots over queueing behind running tasks
+        worker = max(
+            self.workers.values(),
+            key=lambda worker: (
+                worker.slots - len(worker.handles) - worker.steals,
+                worker.capacity - len(worker.handles),
+            ))
+        header = encoder_task_spec(task)
+        handle = RemoteTaskHandle(next(self._task_ids), task, worker)
+        header["id"] = handle.task_id
+        worker.handles[handle.task_id] = handle
+        worker.send(header)
+        if not worker.shared_storage:
+            worker.uploads.append([handle.task_id, task.flac_file, 0])
+            self._pump(worker)
+        return handle
+
+    def process(self, timeout=None):
+        """
+        Handle network events for up to *timeout* seconds.
+
+        Like :meth:`transcoder.Scheduler.wait`, this does not block while tasks
+        are being pulled from a feed.
+        """
+        if self.scheduler.refilling:
+            timeout = 0
+        elif self.child_watcher is None and \
+                (timeout is None or timeout > self.scheduler.poll_interval):
+            timeout = self.scheduler.poll_interval
+        elif timeout is None or timeout > 1.0:
+            # wake up regularly to check for lost workers
+            timeout = 1.0
+        for key, events in self._selector.select(timeout):
+            if key.fileobj is self._listener:
+                self._accept()
+                continue
+            if key.fileobj is self.child_watcher:
+                self.child_watcher.wait(0)
+                continue
+            if key.data is self:
+                try:
+                    self._wakeup[0].recv(4096)
+                except BlockingIOError:
+                    pass
+                continue
+            worker = key.data
+            if worker.sock not in self.workers and \
+                    worker.sock not in self._connecting:
+                continue
+            try:
+                if events & selectors.EVENT_WRITE:
+                    worker.flush()
+                if events & selectors.EVENT_READ:
+                    for header, payload in worker.read():
+                        self._handle_frame(worker, header, payload)
+            except (OSError, ValueError, KeyError) as exc:
+                self._drop(worker, exc)
+
+        while self._io_done:
+            callback, future = self._io_done.popleft()
+            callback(future)
+
+        now = time.monotonic()
+        for worker in list(self._connecting.values()):
+            if now - worker.last_seen > self.worker_timeout:
+                self._drop(worker, "no hello")
+        for worker in list(self.workers.values()):
+            if now - worker.last_seen > self.worker_timeout:
+                self._drop(worker, "heartbeat timeout")
+
+        self._steal()
+
+    def close(self):
+        for worker in self._connecting.values():
+            worker.sock.close()
+        self._connecting.clear()
+        for worker in list(self.workers.values()):
+            try:
+                worker.send({"type": "shutdown"})
+                worker.sock.setblocking(True)
+                worker.sock.sendall(worker._outbuf)
+            except OSError:
+                pass
+            worker.sock.close()
+        self.workers.clear()
+        self._io.shutdown()
+        self._selector.close()
+        for sock in self._wakeup:
+            sock.close()
+        if self._listener.family == socket.AF_UNIX:
+            try:
+                os.unlink(self._listener.getsockname())
+            except OSError:
+                pass
+        self._listener.close()
+
+class Worker:
+    """
+    Run encoder tasks received from a :class:`Coordinator`.
+
+    Up to *slots* tasks run at the same time, and up to *prefetch* more are
+    queued locally, so that a slot can be refilled without a round trip to
+    the coordinator. Tasks which have not started yet can be revoked by the
+    coordinator.
+
+    If *shared_storage* is true, the sources are read and the outputs written
+    at the paths used by the coordinator. Otherwise the source is received
+    in chunks after the task and written to a temporary directory, and the
+    task only becomes ready to start once it is complete; the output is sent
+    back in chunks of :attr:`chunk_size` bytes when done.
+
+    *secret* is the secret shared with the coordinator, if it requires one.
+    """
+
+    heartbeat_interval = 2.0
+    chunk_size = 1 << 18
+
+    def __init__(self, address, slots, prefetch=None, shared_storage=False,
+            secret=None):
+        self.address = address
+        self.secret = secret
+        self.slots = slots
+        self.prefetch = slots if prefetch is None else prefetch
+        self.shared_storage = shared_storage
+        # queued tasks: dicts with the header, the temporary directory and
+        # whether the source is complete
+        self._queue = collections.deque()
+        # task id -> (queue entry, file) of the sources being received
+        self._sources = {}
+        self._processes = {}
+        self._cancelled = set()
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._stopping = False
+        self._sock = None
+
+    def _send(self, header, payload=b""):
+        data = encode_frame(header, payload)
+        with self._send_lock:
+            self._sock.sendall(data)
+
+    def _recv_exactly(self, length):
+        parts = []
+        while length > 0:
+            data = self._sock.recv(min(length, 1 << 20))
+            if not data:
+                raise ConnectionResetError("connection closed by coordinator")
+            parts.append(data)
+            length -= len(data)
+        return b"".join(parts)
+
+    def _recv_frame(self):
+        header_length = int.from_bytes(self._recv_exactly(4), "big")
+        header = json.loads(self._recv_exactly(header_length).decode("utf-8"))
+        payload = b""
+        if header.get("size"):
+            payload = self._recv_exactly(header["size"])
+        return header, payload
+
+    def _heartbeat(self):
+        while not self._stopping:
+            time.sleep(self.heartbeat_interval)
+            try:
+                self._send({"type": "heartbeat"})
+            except OSError:
+                return
+
+    def _next_ready(self):
+        for entry in self._queue:
+            if entry["ready"]:
+                self._queue.remove(entry)
+                return entry
+        return None
+
+    def _discard(self, entry):
+        """
+        Remove the temporary files of the queued *entry*. Must be called with
+        :attr:`_cond` held.
+        """
+        source = self._sources.pop(entry["header"]["id"], None)
+        if source is not None:
+            source[1].close()
+        if entry["tmpdir"] is not None:
+            shutil.rmtree(entry["tmpdir"], ignore_errors=True)
+
+    def _slot(self):
+        while True:
+            with self._cond:
+                entry = None
+                while not self._stopping:
+                    entry = self._next_ready()
+                    if entry is not None:
+                        break
+                    self._cond.wait()
+                if self._stopping:
+                    return
+            task_id = entry["header"]["id"]
+            try:
+                self._send({"type": "started", "id": task_id})
+                returncode = self._execute(entry)
+            except Exception as err:
+                logger.error("while running task %d:", task_id)
+                logger.exception(err)
+                returncode = 1
+            finally:
+                if entry["tmpdir"] is not None:
+                    shutil.rmtree(entry["tmpdir"], ignore_errors=True)
+            try:
+                self._send(
+                    {"type": "done", "id": task_id, "returncode": returncode})
+            except OSError:
+                return
+
+    def _execute(self, entry):
+        header = entry["header"]
+        task_id = header["id"]
+        if self.shared_storage:
+            final_file = header["output"]
+            out_file = transcoder.EncoderHandle._get_partial_file(final_file)
+            os.makedirs(os.path.dirname(final_file), exist_ok=True)
+            decoder_command = ["flac", "-dc", header["source"]]
+        else:
+            out_file = os.path.join(
+                entry["tmpdir"], "output." + header["suffix"])
+            decoder_command = [
+                "flac", "-dc", os.path.join(entry["tmpdir"], "source.flac")]
+        command = [out_file if item is None else item
+                   for item in header["command"]]
+
+        logging.debug("$ %s", decoder_command)
+        decoder = subprocess.Popen(
+            decoder_command,
+            stdout=subprocess.PIPE,
+            stderr=transcoder.devnull)
+        try:
+            logging.debug("$ %s", command)
+            encoder = subprocess.Popen(
+                command,
+                stdin=decoder.stdout,
+                stdout=transcoder.devnull)
+        except:
+            decoder.kill()
+            raise
+        finally:
+            decoder.stdout.close()
+
+        with self._cond:
+            self._processes[task_id] = (decoder, encoder)
+            if task_id in self._cancelled:
+                decoder.terminate()
+                encoder.terminate()
+
+        returncode = encoder.wait()
+        returncode = decoder.wait() or returncode
+        with self._cond:
+            del self._processes[task_id]
+            self._cancelled.discard(task_id)
+
+        if self.shared_storage:
+            transcoder.EncoderHandle._commit_output(
+                out_file, final_file, returncode == 0)
+        elif returncode == 0:
+            with open(out_file, "rb") as f:
+                for chunk in iter(
+                        functools.partial(f.read, self.chunk_size), b""):
+                    self._send({"type": "output", "id": task_id}, chunk)
+        return returncode
+
+    def _handle_frame(self, header, payload):
+        kind = header.get("type")
+        if kind == "task":
+            entry = {
+                "header": header,
+                "tmpdir": None,
+                "ready": self.shared_storage,
+            }
+            if not self.shared_storage:
+                entry["tmpdir"] = tempfile.mkdtemp(prefix="transcoder-worker-")
+                self._sources[header["id"]] = (entry, open(
+                    os.path.join(entry["tmpdir"], "source.flac"), "wb"))
+            with self._cond:
+                self._queue.append(entry)
+                self._cond.notify()
+        elif kind == "source":
+            with self._cond:
+                source = self._sources.get(header["id"])
+                if source is None:
+                    # revoked or cancelled while being sent
+                    return True
+                entry, f = source
+                f.write(payload)
+                if header.get("end"):
+                    f.close()
+                    del self._sources[header["id"]]
+                    entry["ready"] = True
+                    self._cond.notify()
+        elif kind == "revoke":
+            task_id = header["id"]
+            with self._cond:
+                for entry in self._queue:
+                    if entry["header"]["id"] == task_id:
+                        self._queue.remove(entry)
+                        self._discard(entry)
+                        ok = True
+                        break
+                else:
+                    ok = False
+            self._send({"type": "revoked", "id": task_id, "ok": ok})
+        elif kind == "cancel":
+            task_id = header["id"]
+            with self._cond:
+                for entry in self._queue:
+                    if entry["header"]["id"] == task_id:
+                        self._queue.remove(entry)
+                        self._discard(entry)
+                        break
+                else:
+                    self._cancelled.add(task_id)
+                    for process in self._processes.get(task_id, ()):
+                        process.terminate()
+        elif kind == "shutdown":
+            return False
+        return True
+
+    def run(self):
+        family, addr = parse_address(self.address)
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.connect(addr)
+        header, _ = self._recv_frame()
+        if header.get("type") != "challenge":
+            raise ConnectionError("unexpected greeting from coordinator")
+        hello = {
+            "type": "hello",
+            "name": socket.gethostname(),
+            "slots": self.slots,
+            "prefetch": self.prefetch,
+            "shared_storage": self.shared_storage,
+        }
+        if self.secret is not None:
+            hello["auth"] = authenticate(self.secret, header["challenge"])
+        self._send(hello)
+
+        threads = [threading.Thread(target=self._heartbeat, daemon=True)]
+        threads.extend(
+            threading.Thread(target=self._slot, daemon=True)
+            for i in range(self.slots))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while self._handle_frame(*self._recv_frame()):
+                pass
+        except ConnectionError as exc:
+            logger.error("connection to coordinator lost: %s", exc)
+        finally:
+            with self._cond:
+                self._stopping = True
+                for entry in self._queue:
+                    self._discard(entry)
+                self._queue.clear()
+                for processes in self._processes.values():
+                    for process in processes:
+                        process.terminate()
+                self._cond.notify_all()
+            self._sock.close()
@@ -0,0 +1,277 @@
+# File name: flacmeta.py
+# This file is part of: mmutils
+#
+# LICENSE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# FEEDBACK & QUESTIONS
+#
+# For feedback and questions about mmutils please e-mail one of the
+# authors named in the AUTHORS file.
+########################################################################
+"""
+Read the metadata blocks of FLAC files without spawning ``metaflac``.
+
+Only the metadata blocks at the start of the file are read; the blocks which
+are not needed (most notably PICTURE blocks, which can be huge) are skipped
+with a seek and only their position is recorded.
+"""
+
+import struct
+
+BLOCK_STREAMINFO = 0
+BLOCK_PADDING = 1
+BLOCK_APPLICATION = 2
+BLOCK_SEEKTABLE = 3
+BLOCK_VORBIS_COMMENT = 4
+BLOCK_CUESHEET = 5
+BLOCK_PICTURE = 6
+
+MAGIC = b"fLaC"
+
+class FLACFormatError(ValueError):
+    pass
+
+class StreamInfo:
+    __slots__ = (
+        "min_blocksize",
+        "max_blocksize",
+        "min_framesize",
+        "max_framesize",
+        "sample_rate",
+        "channels",
+        "bits_per_sample",
+        "total_samples",
+        "md5",
+    )
+
+    _struct = struct.Struct(">HH3s3sQ16s")
+
+    @classmethod
+    def from_bytes(cls, data):
+        if len(data) != 34:
+            raise FLACFormatError("STREAMINFO block has invalid size")
+        (min_blocksize, max_blocksize,
+         min_framesize, max_framesize,
+         packed, md5) = cls._struct.unpack(data)
+
+        self = cls()
+        self.min_blocksize = min_blocksize
+        self.max_blocksize = max_blocksize
+        self.min_framesize = int.from_bytes(min_framesize, "big")
+        self.max_framesize = int.from_bytes(max_framesize, "big")
+        # 20 bits sample rate, 3 bits channels - 1, 5 bits bits per sample - 1,
+        # 36 bits total samples
+        self.sample_rate = packed >> 44
+        self.channels = ((packed >> 41) & 0x7) + 1
+        self.bits_per_sample = ((packed >> 36) & 0x1f) + 1
+        self.total_samples = packed & 0xfffffffff
+        self.md5 = md5
+        return self
+
+    @property
+    def duration(self):
+        """
+        Duration of the stream in seconds, or :data:`None` if the total number
+        of samples is not known.
+        """
+        if not self.total_samples or not self.sample_rate:
+            return None
+        return self.total_samples / self.sample_rate
+
+    def __repr__(self):
+        return "<StreamInfo {} Hz, {} ch, {} bit, {} samples>".format(
+            self.sample_rate,
+            self.channels,
+            self.bits_per_sample,
+            self.total_samples)
+
+class Picture:
+    """
+    Location of a PICTURE block.
+
+    *offset* is the file offset of the block data (after the block header) and
+    *length* its size in bytes.
+    """
+    __slots__ = ("offset", "length", "picture_type")
+
+    def __init__(self, offset, length, picture_type):
+        self.offset = offset
+        self.length = length
+        self.picture_type = picture_type
+
+    def __repr__(self):
+        return "<Picture type {} at {} ({} bytes)>".format(
+            self.picture_type,
+            self.offset,
+            self.length)
+
+class FLACMetadata:
+    """
+    The metadata read from a FLAC file.
+
+    .. attribute:: comments
+
+       List of ``(key, value)`` pairs from the VORBIS_COMMENT block, in file
+       order. Keys are kept as they are stored in the file.
+
+    .. attribute:: audio_offset
+
+       File offset of the first audio frame.
+    """
+
+    def __init__(self):
+        self.streaminfo = None
+        self.vendor = None
+        self.comments = []
+        self.pictures = []
+        self.audio_offset = None
+
+    def comment_dict(self):
+        """
+        Return the comments as dictionary. If a key occurs more than once, the
+        last value wins.
+        """
+        return dict(self.comments)
+
+def split_vorbis_comment(data):
+    """
+    Parse the body of a VORBIS_COMMENT block or of an Ogg comment packet
+    (without the packet type) and return ``(vendor, comments, rest)``, where
+    *rest* is whatever follows the comments (the framing bit of Vorbis, or
+    padding in Opus).
+    """
+    try:
+        offset = 0
+        vendor_length, = struct.unpack_from("<I", data, offset)
+        offset += 4
+        vendor = data[offset:offset+vendor_length].decode("utf-8", "replace")
+        offset += vendor_length
+        count, = struct.unpack_from("<I", data, offset)
+        offset += 4
+        comments = []
+        for i in range(count):
+            length, = struct.unpack_from("<I", data, offset)
+            offset += 4
+            entry = data[offset:offset+length]
+            if len(entry) != length:
+                raise FLACFormatError("truncated VORBIS_COMMENT block")
+            offset += length
+            key, sep, value = entry.decode("utf-8", "replace").partition("=")
+            if not sep:
+                continue
+            comments.append((key, value))
+    except struct.error:
+        raise FLACFormatError("truncated VORBIS_COMMENT block") from None
+    return vendor, comments, data[offset:]
+
+def parse_vorbis_comment(data):
+    """
+    Parse the body of a VORBIS_COMMENT block (or of an Ogg comment packet
+    with the framing stripped) and return ``(vendor, comments)``.
+    """
+    vendor, comments, rest = split_vorbis_comment(data)
+    return vendor, comments
+
+def build_vorbis_comment(vendor, comments):
+    """
+    Return the body of a VORBIS_COMMENT block with *vendor* and *comments*,
+    a sequence of ``(key, value)`` pairs; the inverse of
+    :func:`parse_vorbis_comment`.
+    """
+    vendor = vendor.encode("utf-8")
+    parts = [struct.pack("<I", len(vendor)), vendor,
+             struct.pack("<I", len(comments))]
+    for key, value in comments:
+        entry = "{}={}".format(key, value).encode("utf-8")
+        parts.append(struct.pack("<I", len(entry)))
+        parts.append(entry)
+    return b"".join(parts)
+
+def _read_magic(f):
+    """
+    Read the stream marker, skipping an ID3v2 tag in front of it.
+    """
+    magic = f.read(4)
+    if magic[:3] != b"ID3":
+        return magic
+    header = magic + f.read(6)
+    if len(header) != 10:
+        return b""
+    size = 0
+    for byte in header[6:10]:
+        size = (size << 7) | (byte & 0x7f)
+    if header[5] & 0x10:
+        # footer present
+        size += 10
+    f.seek(size, 1)
+    return f.read(4)
+
+def read_metadata_from(f, blocks=None):
+    """
+    Read the metadata blocks from the binary file object *f*, which must be
+    positioned at the start of the FLAC file.
+
+    *blocks* may be a set of block types to parse; all other blocks are
+    skipped. PICTURE block locations are always recorded.
+    """
+    if _read_magic(f) != MAGIC:
+        raise FLACFormatError("not a FLAC file")
+
+    result = FLACMetadata()
+    last = False
+    while not last:
+        header = f.read(4)
+        if len(header) != 4:
+            raise FLACFormatError("truncated metadata block header")
+        last = bool(header[0] & 0x80)
+        block_type = header[0] & 0x7f
+        length = int.from_bytes(header[1:4], "big")
+
+        if block_type == 0x7f:
+            raise FLACFormatError("invalid metadata block type")
+
+        wanted = blocks is None or block_type in blocks
+        if block_type == BLOCK_PICTURE:
+            offset = f.tell()
+            picture_type = None
+            if length >= 4:
+                picture_type, = struct.unpack(">I", f.read(4))
+                f.seek(length - 4, 1)
+            else:
+                f.seek(length, 1)
+            result.pictures.append(Picture(offset, length, picture_type))
+        elif wanted and block_type in (BLOCK_STREAMINFO, BLOCK_VORBIS_COMMENT):
+            data = f.read(length)
+            if len(data) != length:
+                raise FLACFormatError("truncated metadata block")
+            if block_type == BLOCK_STREAMINFO:
+                result.streaminfo = StreamInfo.from_bytes(data)
+            else:
+                result.vendor, result.comments = parse_vorbis_comment(data)
+        else:
+            f.seek(length, 1)
+
+    result.audio_offset = f.tell()
+    return result
+
+def read_metadata(path, blocks=None):
+    """
+    Read the metadata of the FLAC file at *path*.
+
+    See :func:`read_metadata_from` for the meaning of *blocks*.
+    """
+    with open(path, "rb") as f:
+        return read_metadata_from(f, blocks=blocks)
@@ -0,0 +1,491 @@
+# File name: jobservice.py
+# This file is part of: mmutils
+#
+# LICENSE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# FEEDBACK & QUESTIONS
+#
+# For feedback and questions about mmutils please e-mail one of the
+# authors named in the AUTHORS file.
+########################################################################
+"""
+Run transcoder.py as a long-lived service which accepts jobs from clients.
+
+A :class:`Service` listens on a Unix socket (``transcoder.py --serve``) for
+jobs submitted with :class:`ServiceClient` (``--submit``, ``--status`` and
+``--cancel``), and feeds their tasks to a single
+:class:`transcoder.Scheduler`, sharing the slots fairly between the jobs.
+"""
+
+import collections
+import itertools
+import logging
+import os
+import selectors
+import socket
+import sqlite3
+import time
+
+import distributed
+import transcoder
+
+class ServiceJob:
+    """
+    State of a job submitted to a :class:`Service`: the directories *paths*,
+    relative to the working directory of the service, encoded with the
+    ``(encoder name, output directory)`` pairs *transcoders*.
+    """
+
+    def __init__(self, job_id, transcoders, paths):
+        self.id = job_id
+        self.transcoders = transcoders
+        self.paths = paths
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.scanned = False
+        self.cancelled = False
+        self.tasks = 0
+        self.succeeded = 0
+        self.skipped = 0
+        self.failed = 0
+        self.dropped = 0
+        # connections waiting for the job to finish
+        self.waiting = []
+
+    @property
+    def outstanding(self):
+        return self.tasks - self.succeeded - self.skipped - self.failed - \
+            self.dropped
+
+    @property
+    def state(self):
+        if self.finished_at is not None:
+            return "cancelled" if self.cancelled else "done"
+        if self.cancelled:
+            return "cancelling"
+        if not self.scanned:
+            return "scanning"
+        return "running"
+
+    def status(self, running=0):
+        return {
+            "job": self.id,
+            "state": self.state,
+            "paths": self.paths,
+            "transcoders": self.transcoders,
+            "tasks": self.tasks,
+            "running": running,
+            "succeeded": self.succeeded,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "submitted_at": self.submitted_at,
+            "finished_at": self.finished_at,
+        }
+
+class ServiceConnection:
+    """
+    State of a client connection on the side of the :class:`Service`.
+    """
+
+    def __init__(self, service, sock):
+        self.service = service
+        self.sock = sock
+        self._reader = distributed.FrameReader()
+        self._outbuf = bytearray()
+
+    def send(self, header):
+        self._outbuf.extend(distributed.encode_frame(header))
+        self.flush()
+
+    def flush(self):
+        if self._outbuf:
+            try:
+                sent = self.sock.send(self._outbuf)
+            except BlockingIOError:
+                sent = 0
+            del self._outbuf[:sent]
+        self.service._update_events(self)
+
+    def read(self):
+        try:
+            data = self.sock.recv(65536)
+        except BlockingIOError:
+            return []
+        if not data:
+            raise ConnectionResetError("connection closed by client")
+        return self._reader.feed(data)
+
+class Service(transcoder.SchedulerListener):
+    """
+    Run the jobs submitted by clients (see :class:`ServiceClient`) on a single
+    long-running :class:`transcoder.Scheduler`, so that they share its slots
+    instead of each starting its own tasks.
+
+    Clients connect to the Unix socket at *path* and exchange frames (see
+    :func:`distributed.encode_frame`) to submit jobs, query their state and
+    cancel them. *make_task_generator* is called with the ``(encoder class,
+    output directory)`` pairs of a job and returns its task generator (see
+    :func:`transcoder.task_generator`); *dir_filters* and *measure_loudness*
+    are passed to :func:`transcoder.scan_dir`. The paths of the jobs, and their
+    output directories, have to be below the working directory of the service,
+    and the outputs are named relative to it, as with a run of transcoder.py
+    there. Anyone who can connect to the socket can have files written there
+    with the permissions of the service, so access is controlled by the
+    permissions of the socket and of its directory.
+
+    The pending tasks of the scheduler are replaced by a
+    :class:`transcoder.FairShareDispatch` over the jobs, ordered within each
+    job by the policy the scheduler had. The scheduler's signal wake-up is
+    waited for in :meth:`process`, which replaces
+    :meth:`transcoder.Scheduler.wait`.
+    """
+
+    # number of finished jobs whose state is kept for status queries
+    keep_finished = 100
+
+    def __init__(self, scheduler, path, make_task_generator,
+            child_watcher=None,
+            dir_filters=(),
+            measure_loudness=False):
+        self.scheduler = scheduler
+        self.make_task_generator = make_task_generator
+        self.child_watcher = child_watcher
+        self.dir_filters = dir_filters
+        self.measure_loudness = measure_loudness
+        self.jobs = collections.OrderedDict()
+        self._job_ids = itertools.count(1)
+        # the job of each scheduled task which has not finished yet
+        self._task_jobs = {}
+        self._connections = {}
+        self._selector = selectors.DefaultSelector()
+
+        distributed.remove_stale_socket(path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(path)
+        self._listener.listen()
+        self._listener.setblocking(False)
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        if child_watcher is not None:
+            self._selector.register(child_watcher, selectors.EVENT_READ)
+
+        scheduler.pending_tasks = transcoder.FairShareDispatch(
+            self._task_jobs.get,
+            self._running_by_job,
+            policy=type(scheduler.pending_tasks))
+        scheduler.listeners.append(self)
+
+    def _running_by_job(self):
+        return collections.Counter(
+            self._task_jobs.get(handle.task)
+            for handle in self.scheduler.running_tasks)
+
+    def submit(self, transcoders, paths):
+        """
+        Add a job encoding the directories *paths* with the ``(encoder name,
+        output directory)`` pairs *transcoders* and return it.
+        """
+        if not transcoders or not paths:
+            raise ValueError("a job needs transcoders and directories")
+        relative_paths = []
+        for path in paths:
+            relative = self._confine(path)
+            if not os.path.isdir(relative):
+                raise ValueError("not a directory: {}".format(path))
+            relative_paths.append(relative)
+        try:
+            transcoder_classes = [
+                (transcoder.encoders[name], self._confine(output_dir))
+                for name, output_dir in transcoders
+            ]
+        except KeyError as err:
+            raise ValueError("unknown encoder: {}".format(err)) from None
+        generator = self.make_task_generator(transcoder_classes)
+
+        job = ServiceJob(
+            next(self._job_ids),
+            [list(transcoder) for transcoder in transcoders],
+            relative_paths)
+        self.jobs[job.id] = job
+        self.scheduler.feed(self._job_tasks(job, generator))
+        logging.info("job %d submitted: %s", job.id, ", ".join(job.paths))
+        return job
+
+    @staticmethod
+    def _confine(path):
+        """
+        Return *path* relative to the working directory, or raise
+        :class:`ValueError` if it, or the target of a symbolic link in it, is
+        not below the working directory.
+        """
+        root = os.getcwd()
+        relative = os.path.relpath(os.path.join(root, path), root)
+        real = os.path.relpath(
+            os.path.realpath(relative), os.path.realpath(root))
+        for candidate in (relative, real):
+            if candidate == os.pardir or \
+                    candidate.startswith(os.pardir + os.sep):
+                raise ValueError("{} is not below {}".format(path, root))
+        return relative
+
+    def _job_tasks(self, job, generator):
+        try:
+            for directory in job.paths:
+                for task in transcoder.scan_dir(
+                        directory,
+                        lambda: None,
+                        generator,
+                        dir_filters=self.dir_filters,
+                        measure_loudness=self.measure_loudness):
+                    if job.cancelled:
+                        return
+                    self._task_jobs[task] = job
+                    job.tasks += 1
+                    yield task
+        finally:
+            job.scanned = True
+            self._check_finished(job)
+
+    def cancel(self, job):
+        """
+        Stop scanning for *job*, drop its pending tasks and terminate its
+        running ones.
+        """
+        job.cancelled = True
+        self.scheduler.cancel(lambda task: self._task_jobs.get(task) is job)
+        self._check_finished(job)
+
+    def _get_job(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise ValueError("no such job: {}".format(job_id))
+        return job
+
+    def _check_finished(self, job):
+        if job.finished_at is not None or not job.scanned or job.outstanding:
+            return
+        job.finished_at = time.time()
+        logging.info("job %d %s: %d tasks, %d failed",
+                     job.id, job.state, job.tasks, job.failed)
+        status = job.status()
+        for connection in job.waiting:
+            if connection.sock in self._connections:
+                connection.send({"type": "finished", "job": status})
+        job.waiting.clear()
+
+        finished = [other for other in self.jobs.values()
+                    if other.finished_at is not None]
+        for other in finished[:-self.keep_finished]:
+            del self.jobs[other.id]
+
+    def _settle(self, task, counter):
+        job = self._task_jobs.pop(task, None)
+        if job is None:
+            return
+        setattr(job, counter, getattr(job, counter) + 1)
+        self._check_finished(job)
+
+    def task_skipped(self, task):
+        self._settle(task, "skipped")
+
+    def task_finished(self, task, handle, returncode, wall_time):
+        self._settle(task, "succeeded" if returncode == 0 else "failed")
+
+    def task_dropped(self, task):
+        self._settle(task, "dropped")
+
+    def _status(self, header):
+        running = self._running_by_job()
+        if header.get("job") is not None:
+            jobs = [self._get_job(header["job"])]
+        else:
+            jobs = self.jobs.values()
+        done, pending, running_tasks, eta = self.scheduler.guesstimate()
+        return {
+            "type": "status",
+            "jobs": [job.status(running[job]) for job in jobs],
+            "slots": self.scheduler.max_tasks,
+            "pending": pending,
+            "running": running_tasks,
+            "eta": eta,
+        }
+
+    def _handle_frame(self, connection, header):
+        kind = header.get("type")
+        try:
+            if kind == "submit":
+                job = self.submit(header["transcoders"], header["paths"])
+                connection.send({"type": "submitted", "job": job.id})
+                if header.get("wait"):
+                    job.waiting.append(connection)
+            elif kind == "status":
+                connection.send(self._status(header))
+            elif kind == "cancel":
+                job = self._get_job(header["job"])
+                if job.finished_at is None:
+                    self.cancel(job)
+                connection.send({"type": "cancelled", "job": job.id})
+            elif kind == "wait":
+                job = self._get_job(header["job"])
+                if job.finished_at is None:
+                    job.waiting.append(connection)
+                else:
+                    connection.send({"type": "finished", "job": job.status()})
+            else:
+                raise ValueError("unknown request: {!r}".format(kind))
+        except (KeyError, TypeError, ValueError, OSError,
+                sqlite3.Error) as err:
+            connection.send({"type": "error", "message": str(err)})
+
+    def _update_events(self, connection):
+        events = selectors.EVENT_READ
+        if connection._outbuf:
+            events |= selectors.EVENT_WRITE
+        self._selector.modify(connection.sock, events, connection)
+
+    def _accept(self):
+        sock, address = self._listener.accept()
+        sock.setblocking(False)
+        connection = ServiceConnection(self, sock)
+        self._connections[sock] = connection
+        self._selector.register(sock, selectors.EVENT_READ, connection)
+
+    def _drop(self, connection, reason):
+        logging.debug("client disconnected: %s", reason)
+        self._selector.unregister(connection.sock)
+        connection.sock.close()
+        del self._connections[connection.sock]
+
+    def process(self, timeout=None):
+        """
+        Handle client requests and wait for child processes to exit, for up
+        to *timeout* seconds.
+        """
+        if self.scheduler.refilling:
+            timeout = 0
+        elif self.child_watcher is None and \
+                (timeout is None or timeout > self.scheduler.poll_interval):
+            timeout = self.scheduler.poll_interval
+        for key, events in self._selector.select(timeout):
+            if key.fileobj is self._listener:
+                self._accept()
+                continue
+            if key.fileobj is self.child_watcher:
+                self.child_watcher.wait(0)
+                continue
+            connection = key.data
+            if connection.sock not in self._connections:
+                continue
+            try:
+                if events & selectors.EVENT_WRITE:
+                    connection.flush()
+                if events & selectors.EVENT_READ:
+                    for header, payload in connection.read():
+                        self._handle_frame(connection, header)
+            except (OSError, ValueError) as exc:
+                self._drop(connection, exc)
+
+    def close(self):
+        for connection in list(self._connections.values()):
+            connection.sock.close()
+        self._connections.clear()
+        self._selector.close()
+        try:
+            os.unlink(self._listener.getsockname())
+        except OSError:
+            pass
+        self._listener.close()
+
+class ServiceClient:
+    """
+    Submit jobs to, and query, a :class:`Service` listening on the Unix
+    socket at *path*.
+
+    Requests which the service rejects raise :class:`ValueError`.
+    """
+
+    def __init__(self, path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._reader = distributed.FrameReader()
+        self._frames = collections.deque()
+
+    def _receive(self):
+        while not self._frames:
+            data = self._sock.recv(65536)
+            if not data:
+                raise ConnectionResetError("connection closed by service")
+            self._frames.extend(self._reader.feed(data))
+        header, payload = self._frames.popleft()
+        if header.get("type") == "error":
+            raise ValueError(header.get("message"))
+        return header
+
+    def _request(self, header):
+        self._sock.sendall(distributed.encode_frame(header))
+        return self._receive()
+
+    def submit(self, transcoders, paths, wait=False):
+        """
+        Submit a job for the directories *paths* with the ``(encoder name,
+        output directory)`` pairs *transcoders* and return its id. Relative
+        paths are made absolute here.
+
+        If *wait* is true, :meth:`wait` has to be called for the job.
+        """
+        response = self._request({
+            "type": "submit",
+            "transcoders": [
+                (name, os.path.abspath(output_dir))
+                for name, output_dir in transcoders
+            ],
+            "paths": [os.path.abspath(path) for path in paths],
+            "wait": wait,
+        })
+        return response["job"]
+
+    def status(self, job=None):
+        """
+        Return the state of the service and of the job *job*, or of all jobs
+        it knows about, as a dictionary.
+        """
+        return self._request({"type": "status", "job": job})
+
+    def cancel(self, job):
+        self._request({"type": "cancel", "job": job})
+
+    def wait(self, job, submitted=False):
+        """
+        Wait until *job* has finished and return its state. *submitted* has
+        to be true if the job has been submitted with *wait*.
+        """
+        if not submitted:
+            self._sock.sendall(
+                distributed.encode_frame({"type": "wait", "job": job}))
+        while True:
+            header = self._receive()
+            if header.get("type") == "finished" and \
+                    header["job"]["job"] == job:
+                return header["job"]
+
+    def close(self):
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,441 @@
+# File name: loudness.py
+# This file is part of: mmutils
+#
+# LICENSE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# FEEDBACK & QUESTIONS
+#
+# For feedback and questions about mmutils please e-mail one of the
+# authors named in the AUTHORS file.
+########################################################################
+"""
+Measure the loudness of PCM streams as specified in ITU-R BS.1770-4 and
+EBU R 128, for ReplayGain 2.0 and Opus R128 gain tags.
+
+The audio is fed in as it streams by, in chunks of any size. The two
+K-weighting filters are applied as one FIR filter (the impulse response of
+the cascade, truncated where it has decayed below the precision of the
+arithmetic) by FFT convolution of fixed-size blocks, so that all the work is
+vectorised with NumPy. NumPy is optional for the rest of mmutils and slow to
+import, so it is only imported once a meter is created.
+"""
+
+import functools
+import importlib.util
+import math
+import struct
+
+#: blocks quieter than this (in LUFS) are ignored
+ABSOLUTE_GATE = -70.0
+
+#: blocks this much (in LU) below the loudness of the blocks above the
+#: absolute gate are ignored
+RELATIVE_GATE = -10.0
+
+#: target loudness of ReplayGain 2.0, in LUFS
+REPLAYGAIN_REFERENCE = -18.0
+
+#: target loudness of the R128_*_GAIN tags of Ogg Opus, in LUFS
+R128_REFERENCE = -23.0
+
+# gating blocks are 400 ms long and overlap by 75 %, i.e. they are made of
+# four 100 ms segments
+SEGMENT_DURATION = 0.1
+SEGMENTS_PER_BLOCK = 4
+
+# channel weights in the FLAC (WAVE) channel order; surround channels are
+# weighted with +1.5 dB and the LFE channel is left out
+_CHANNEL_WEIGHTS = {
+    1: (1.0,),
+    2: (1.0, 1.0),
+    3: (1.0, 1.0, 1.0),
+    4: (1.0, 1.0, 1.41, 1.41),
+    5: (1.0, 1.0, 1.0, 1.41, 1.41),
+    6: (1.0, 1.0, 1.0, 0.0, 1.41, 1.41),
+    7: (1.0, 1.0, 1.0, 0.0, 1.41, 1.41, 1.41),
+    8: (1.0, 1.0, 1.0, 0.0, 1.41, 1.41, 1.41, 1.41),
+}
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xfffe
+
+class WaveFormatError(ValueError):
+    pass
+
+def available():
+    """
+    Return whether NumPy, which is needed to measure loudness, is installed.
+    """
+    return importlib.util.find_spec("numpy") is not None
+
+def k_weighting(sample_rate):
+    """
+    Return the coefficients ``(b, a)`` of the two K-weighting filters (the
+    high shelf and the high pass of BS.1770) for *sample_rate*, as list of
+    ``(b, a)`` pairs.
+
+    The filters are given for 48 kHz in the recommendation; they are derived
+    from their analogue prototypes here, as libebur128 does.
+    """
+    f0 = 1681.974450955533
+    gain = 3.999843853973347
+    q = 0.7071752369554196
+    k = math.tan(math.pi * f0 / sample_rate)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = (
+        [(vh + vb * k / q + k * k) / a0,
+         2 * (k * k - vh) / a0,
+         (vh - vb * k / q + k * k) / a0],
+        [1.0,
+         2 * (k * k - 1) / a0,
+         (1 - k / q + k * k) / a0],
+    )
+
+    f0 = 38.13547087602444
+    q = 0.5003270373238773
+    k = math.tan(math.pi * f0 / sample_rate)
+    a0 = 1 + k / q + k * k
+    high_pass = (
+        [1.0, -2.0, 1.0],
+        [1.0,
+         2 * (k * k - 1) / a0,
+         (1 - k / q + k * k) / a0],
+    )
+    return [shelf, high_pass]
+
+@functools.lru_cache(maxsize=None)
+def _impulse_response(sample_rate, tolerance=1e-12):
+    """
+    Return the impulse response of the K-weighting filters at *sample_rate*
+    as tuple, cut off once it has stayed below *tolerance* for 10 ms.
+    """
+    quiet_for = max(int(sample_rate * 0.01), 1)
+    limit = sample_rate * 8
+    filters = k_weighting(sample_rate)
+    # direct form I state of both filters
+    state = [[0.0, 0.0, 0.0, 0.0] for f in filters]
+    response = []
+    quiet = 0
+    x = 1.0
+    while len(response) < limit:
+        for (b, a), s in zip(filters, state):
+            x1, x2, y1, y2 = s
+            y = b[0] * x + b[1] * x1 + b[2] * x2 - a[1] * y1 - a[2] * y2
+            s[:] = x, x1, y, y1
+            x = y
+        response.append(x)
+        quiet = quiet + 1 if abs(x) < tolerance else 0
+        if quiet >= quiet_for:
+            del response[-quiet:]
+            break
+        x = 0.0
+    return tuple(response)
+
+@functools.lru_cache(maxsize=16)
+def _filter_spectrum(sample_rate, fft_size):
+    import numpy
+    return numpy.fft.rfft(
+        numpy.array(_impulse_response(sample_rate)),
+        fft_size)
+
+def _energy_to_loudness(energy):
+    return -0.691 + 10 * math.log10(energy)
+
+def _loudness_to_energy(loudness):
+    return 10 ** ((loudness + 0.691) / 10)
+
+class Loudness:
+    """
+    Result of a measurement: the mean square of the K-weighted signal in each
+    gating block (summed over the weighted channels), and the sample peak
+    relative to full scale.
+    """
+    __slots__ = ("blocks", "peak")
+
+    def __init__(self, blocks, peak):
+        self.blocks = blocks
+        self.peak = peak
+
+    @classmethod
+    def combine(cls, measurements):
+        """
+        Return the loudness of the concatenation of *measurements*, e.g. of
+        an album from those of its tracks.
+        """
+        import numpy
+        measurements = list(measurements)
+        return cls(
+            numpy.concatenate([m.blocks for m in measurements]),
+            max((m.peak for m in measurements), default=0.0))
+
+    @property
+    def integrated(self):
+        """
+        Gated loudness in LUFS, or :data:`None` if there is no block above
+        the absolute gate (silence, or less than 400 ms of audio).
+        """
+        blocks = self.blocks[self.blocks > _loudness_to_energy(ABSOLUTE_GATE)]
+        if not len(blocks):
+            return None
+        threshold = blocks.mean() * 10 ** (RELATIVE_GATE / 10)
+        blocks = blocks[blocks > threshold]
+        return _energy_to_loudness(blocks.mean())
+
+    def __repr__(self):
+        integrated = self.integrated
+        return "<Loudness {} LUFS, peak {:.6f}>".format(
+            "-inf" if integrated is None else "{:.2f}".format(integrated),
+            self.peak)
+
+class LoudnessMeter:
+    """
+    Measure the loudness of a stream of samples with *channels* channels at
+    *sample_rate*.
+
+    Samples are passed to :meth:`feed` as float arrays of shape ``(frames,
+    channels)`` with full scale at 1.0; they are filtered in blocks of
+    :attr:`block_frames` frames.
+    """
+
+    block_frames = 1 << 15
+
+    def __init__(self, sample_rate, channels):
+        import numpy
+        if channels not in _CHANNEL_WEIGHTS:
+            raise ValueError("unsupported number of channels: {}".format(
+                channels))
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self._weights = numpy.array(_CHANNEL_WEIGHTS[channels])[:, None]
+        self._filter_length = len(_impulse_response(sample_rate))
+        self._fft_size = 1 << (
+            self.block_frames + self._filter_length - 2).bit_length()
+        self._history = numpy.zeros((channels, self._filter_length - 1))
+        self._pending = []
+        self._pending_frames = 0
+        self._segment_frames = max(round(sample_rate * SEGMENT_DURATION), 1)
+        self._segments = []
+        self._segment_sum = 0.0
+        self._segment_fill = 0
+        self.peak = 0.0
+
+    def feed(self, samples):
+        self._pending.append(samples)
+        self._pending_frames += len(samples)
+        if self._pending_frames < self.block_frames:
+            return
+        import numpy
+        samples = numpy.concatenate(self._pending)
+        end = len(samples) - len(samples) % self.block_frames
+        for start in range(0, end, self.block_frames):
+            self._process(samples[start:start+self.block_frames])
+        self._pending = [samples[end:]]
+        self._pending_frames = len(samples) - end
+
+    def _process(self, samples):
+        import numpy
+        if not len(samples):
+            return
+        self.peak = max(self.peak, float(numpy.abs(samples).max()))
+
+        # overlap-save: the filter sees the tail of the previous block
+        signal = numpy.concatenate([self._history, samples.T], axis=1)
+        self._history = signal[:, len(samples):]
+        spectrum = numpy.fft.rfft(signal, self._fft_size, axis=1)
+        spectrum *= _filter_spectrum(self.sample_rate, self._fft_size)
+        filtered = numpy.fft.irfft(spectrum, self._fft_size, axis=1)[
+            :, self._filter_length-1:self._filter_length-1+len(samples)]
+        energy = (self._weights * filtered * filtered).sum(axis=0)
+
+        # sum up the energy per 100 ms segment
+        length = self._segment_frames
+        offset = 0
+        if self._segment_fill:
+            offset = min(length - self._segment_fill, len(energy))
+            self._segment_sum += float(energy[:offset].sum())
+            self._segment_fill += offset
+            if self._segment_fill < length:
+                return
+            self._segments.append(numpy.array([self._segment_sum]))
+        count = (len(energy) - offset) // length
+        end = offset + count * length
+        self._segments.append(
+            energy[offset:end].reshape(count, length).sum(axis=1))
+        self._segment_sum = float(energy[end:].sum())
+        self._segment_fill = len(energy) - end
+
+    def result(self):
+        """
+        Process the samples fed so far and return the :class:`Loudness`.
+        """
+        import numpy
+        if self._pending_frames:
+            self._process(numpy.concatenate(self._pending))
+        self._pending = []
+        self._pending_frames = 0
+        segments = numpy.concatenate(
+            self._segments + [numpy.zeros(0)]) / self._segment_frames
+        if len(segments) >= SEGMENTS_PER_BLOCK:
+            blocks = numpy.convolve(
+                segments,
+                numpy.full(SEGMENTS_PER_BLOCK, 1 / SEGMENTS_PER_BLOCK),
+                "valid")
+        else:
+            blocks = numpy.zeros(0)
+        return Loudness(blocks, self.peak)
+
+class WaveMeter:
+    """
+    Measure the loudness of a WAVE stream, such as the output of ``flac
+    -dc``, which is passed to :meth:`feed` in chunks of any size.
+
+    The sizes in the RIFF header are ignored, as they are not known in
+    advance to the writers of streams.
+    """
+
+    _chunk_header = struct.Struct("<4sI")
+    _format = struct.Struct("<HHIIHH")
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._meter = None
+        self._sample_width = None
+        self._frame_size = None
+        self._dtype = None
+
+    def _parse_header(self):
+        buffer = self._buffer
+        if len(buffer) < 12:
+            return False
+        if buffer[0:4] != b"RIFF" or buffer[8:12] != b"WAVE":
+            raise WaveFormatError("not a RIFF WAVE stream")
+        offset = 12
+        while True:
+            if len(buffer) < offset + 8:
+                return False
+            chunk_id, length = self._chunk_header.unpack_from(buffer, offset)
+            offset += 8
+            if chunk_id == b"data":
+                break
+            if len(buffer) < offset + length + (length & 1):
+                return False
+            if chunk_id == b"fmt ":
+                self._parse_format(bytes(buffer[offset:offset+length]))
+            offset += length + (length & 1)
+        if self._meter is None:
+            raise WaveFormatError("data chunk without format chunk")
+        del buffer[:offset]
+        return True
+
+    def _parse_format(self, data):
+        import numpy
+        if len(data) < self._format.size:
+            raise WaveFormatError("format chunk too short")
+        (tag, channels, sample_rate, byte_rate, block_align,
+         bits_per_sample) = self._format.unpack_from(data)
+        if tag == WAVE_FORMAT_EXTENSIBLE and len(data) >= 26:
+            # the format tag is repeated in the sub format GUID
+            tag, = struct.unpack_from("<H", data, 24)
+        if tag != WAVE_FORMAT_PCM:
+            raise WaveFormatError("unsupported format {:#x}".format(tag))
+        if not channels or block_align % channels:
+            raise WaveFormatError("invalid block alignment")
+        width = block_align // channels
+        if width not in (1, 2, 3, 4):
+            raise WaveFormatError("unsupported sample width {}".format(width))
+        self._sample_width = width
+        self._frame_size = block_align
+        self._dtype = {
+            1: numpy.uint8, 2: "<i2", 3: numpy.uint8, 4: "<i4"}[width]
+        self._meter = LoudnessMeter(sample_rate, channels)
+
+    def _decode(self, data):
+        import numpy
+        width = self._sample_width
+        raw = numpy.frombuffer(data, dtype=self._dtype)
+        if width == 1:
+            # 8 bit samples are unsigned
+            samples = raw.astype(numpy.float64) - 128
+        elif width == 3:
+            raw = raw.reshape(-1, 3)
+            samples = (
+                raw[:, 0].astype(numpy.int32) |
+                (raw[:, 1].astype(numpy.int32) << 8) |
+                (raw[:, 2].astype(numpy.int8).astype(numpy.int32) << 16)
+            ).astype(numpy.float64)
+        else:
+            samples = raw.astype(numpy.float64)
+        samples *= 1 / (1 << (8 * width - 1))
+        return samples.reshape(-1, self._meter.channels)
+
+    def feed(self, data):
+        self._buffer += data
+        if self._meter is None and not self._parse_header():
+            return
+        usable = len(self._buffer) - len(self._buffer) % self._frame_size
+        if usable:
+            self._meter.feed(self._decode(bytes(self._buffer[:usable])))
+            del self._buffer[:usable]
+
+    def result(self):
+        """
+        Return the :class:`Loudness` of the stream, which must have ended.
+        """
+        if self._meter is None:
+            raise WaveFormatError("stream ended within the header")
+        return self._meter.result()
+
+def replaygain_tags(track, album=None):
+    """
+    Return the ReplayGain 2.0 tags for the *track* and, if given, the
+    *album* :class:`Loudness`, as list of ``(key, value)`` pairs.
+    """
+    tags = []
+    for prefix, measurement in (("TRACK", track), ("ALBUM", album)):
+        if measurement is None:
+            continue
+        integrated = measurement.integrated
+        if integrated is None:
+            continue
+        tags.append((
+            "REPLAYGAIN_{}_GAIN".format(prefix),
+            "{:+.2f} dB".format(REPLAYGAIN_REFERENCE - integrated)))
+        tags.append((
+            "REPLAYGAIN_{}_PEAK".format(prefix),
+            "{:.6f}".format(measurement.peak)))
+    return tags
+
+def r128_tags(track, album=None):
+    """
+    Return the ``R128_TRACK_GAIN`` and ``R128_ALBUM_GAIN`` tags of Ogg Opus
+    (RFC 7845) for the *track* and, if given, the *album*
+    :class:`Loudness`. The gains are in Q7.8 fixed point, relative to the
+    output gain in the header, which the encoders leave at zero.
+    """
+    tags = []
+    for prefix, measurement in (("TRACK", track), ("ALBUM", album)):
+        if measurement is None:
+            continue
+        integrated = measurement.integrated
+        if integrated is None:
+            continue
+        gain = round((R128_REFERENCE - integrated) * 256)
+        tags.append((
+            "R128_{}_GAIN".format(prefix),
+            str(min(max(gain, -32768), 32767))))
+    return tags
@@ -0,0 +1,493 @@
+#!/usr/bin/python3
+# File name: oggtags.py
+# This file is part of: mmutils
+#
+# LICENSE
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# FEEDBACK & QUESTIONS
+#
+# For feedback and questions about mmutils please e-mail one of the
+# authors named in the AUTHORS file.
+########################################################################
+"""
+Rewrite the comments of Ogg Vorbis and Ogg Opus files without re-encoding
+them.
+
+The comment packet is replaced and the header packets following the
+identification header are paginated anew. If that changes the number of
+header pages, the sequence numbers of all following pages of the stream are
+shifted and their checksums recomputed. The result is written next to the
+file and renamed over it, so the file is never left half-written.
+
+The result can also be written to another file, which is how transcoder.py
+builds the output for a source whose audio has already been encoded for
+another one; if the comments stay the same, the file is merely copied,
+sharing the data with a reflink or a hard link where possible.
+"""
+
+import fcntl
+import os
+import shutil
+import struct
+import zlib
+
+import flacmeta
+
+CAPTURE_PATTERN = b"OggS"
+
+FLAG_CONTINUED = 0x01
+FLAG_BOS = 0x02
+FLAG_EOS = 0x04
+
+# granule position of pages on which no packet ends
+NO_GRANULE = -1
+
+# at most this many lacing values (of up to 255 bytes each) per page
+MAX_SEGMENTS = 255
+
+# ioctl cloning a whole file on copy-on-write file systems (linux/fs.h)
+FICLONE = 0x40049409
+
+COPY_METHODS = ("reflink", "hardlink", "copy")
+
+class OggFormatError(ValueError):
+    pass
+
+_BIT_REVERSED = bytes(int("{:08b}".format(i)[::-1], 2) for i in range(256))
+
+def ogg_crc(data):
+    """
+    Return the checksum of an Ogg page (CRC-32 with polynomial 0x04c11db7,
+    neither reflected nor with initial value or final XOR).
+
+    :func:`zlib.crc32` implements the reflected variant, with initial value
+    and final XOR; run on the bit-reversed data and corrected for those, it
+    yields the bit-reversed checksum. This keeps the work in C.
+    """
+    crc = zlib.crc32(data.translate(_BIT_REVERSED)) ^ \
+        zlib.crc32(bytes(len(data)))
+    return int("{:032b}".format(crc)[::-1], 2)
+
+class Page:
+    __slots__ = (
+        "flags",
+        "granule",
+        "serial",
+        "sequence",
+        "lacing",
+        "data",
+    )
+
+    _header = struct.Struct("<4sBBqIIIB")
+
+    def __init__(self, flags, granule, serial, sequence, lacing, data):
+        self.flags = flags
+        self.granule = granule
+        self.serial = serial
+        self.sequence = sequence
+        self.lacing = lacing
+        self.data = data
+
+    @classmethod
+    def read_from(cls, f):
+        """
+        Read the next page from the binary file object *f*. Return
+        :data:`None` at the end of the file.
+        """
+        header = f.read(cls._header.size)
+        if not header:
+            return None
+        if len(header) != cls._header.size:
+            raise OggFormatError("truncated page header")
+        (capture, version, flags, granule, serial, sequence, crc,
+         segments) = cls._header.unpack(header)
+        if capture != CAPTURE_PATTERN:
+            raise OggFormatError("lost synchronisation")
+        if version != 0:
+            raise OggFormatError("unsupported version {}".format(version))
+        lacing = f.read(segments)
+        data = f.read(sum(lacing))
+        if len(lacing) != segments or len(data) != sum(lacing):
+            raise OggFormatError("truncated page")
+        page = cls(flags, granule, serial, sequence, lacing, data)
+        if page.checksum() != crc:
+            raise OggFormatError("checksum mismatch in page {}".format(
+                sequence))
+        return page
+
+    def _serialise(self, crc):
+        return self._header.pack(
+            CAPTURE_PATTERN, 0,
+            self.flags,
+            self.granule,
+            self.serial,
+            self.sequence,
+            crc,
+            len(self.lacing)) + self.lacing + self.data
+
+    def checksum(self):
+        return ogg_crc(self._serialise(0))
+
+    def to_bytes(self):
+        return self._serialise(self.checksum())
+
+def paginate(packets, serial, sequence, granule=0):
+    """
+    Lay out *packets* on pages of the stream *serial*, numbered from
+    *sequence* on. The first packet starts a new page and the last one ends
+    its page. Pages on which a packet ends get the granule position
+    *granule*.
+    """
+    pages = []
+    lacing = bytearray()
+    data = bytearray()
+    continued = False
+    packet_ended = False
+
+    def flush():
+        nonlocal lacing, data, continued, packet_ended
+        pages.append(Page(
+            FLAG_CONTINUED if continued else 0,
+            granule if packet_ended else NO_GRANULE,
+            serial,
+            sequence + len(pages),
+            bytes(lacing),
+            bytes(data)))
+        continued = not lacing or lacing[-1] == 255
+        lacing = bytearray()
+        data = bytearray()
+        packet_ended = False
+
+    for packet in packets:
+        offset = 0
+        while True:
+            if len(lacing) == MAX_SEGMENTS:
+                flush()
+            segment = packet[offset:offset+255]
+            lacing.append(len(segment))
+            data += segment
+            offset += len(segment)
+            if len(segment) < 255:
+                packet_ended = True
+                break
+    flush()
+    return pages
+
+class _Codec:
+    """
+    Header layout of a codec: the magic of the identification packet, the
+    number of header packets and the prefix of the comment packet.
+    """
+
+    def __init__(self, name, magic, header_count, comment_prefix):
+        self.name = name
+        self.magic = magic
+        self.header_count = header_count
+        self.comment_prefix = comment_prefix
+
+CODECS = [
+    _Codec("vorbis", b"\x01vorbis", 3, b"\x03vorbis"),
+    _Codec("opus", b"OpusHead", 2, b"OpusTags"),
+]
+
+class OggHeaders:
+    """
+    The header pages of the first logical stream of an Ogg Vorbis or Opus
+    file and the packets on them.
+    """
+
+    def __init__(self, codec, pages, packets):
+        self.codec = codec
+        self.pages = pages
+        self.packets = packets
+
+    @property
+    def serial(self):
+        return self.pages[0].serial
+
+    @classmethod
+    def read_from(cls, f):
+        first = Page.read_from(f)
+        if first is None or not first.flags & FLAG_BOS:
+            raise OggFormatError("not an Ogg stream")
+        for codec in CODECS:
+            if first.data.startswith(codec.magic):
+                break
+        else:
+            raise OggFormatError("neither Vorbis nor Opus")
+
+        pages = [first]
+        packets = []
+        current = bytearray()
+        page = first
+        while True:
+            offset = 0
+            for length in page.lacing:
+                current += page.data[offset:offset+length]
+                offset += length
+                if length < 255:
+                    packets.append(bytes(current))
+                    current = bytearray()
+            if len(packets) >= codec.header_count:
+                break
+            page = Page.read_from(f)
+            if page is None:
+                raise OggFormatError("truncated headers")
+            if page.serial != first.serial:
+                raise OggFormatError("multiplexed streams are not supported")
+            pages.append(page)
+
+        if len(packets) > codec.header_count or current:
+            raise OggFormatError("audio data on a header page")
+        if len(pages[0].lacing) != 1 or pages[0].lacing[0] == 255:
+            raise OggFormatError("identification header not alone on its page")
+        return cls(codec, pages, packets)
+
+    def comments(self):
+        """
+        Return ``(vendor, comments, rest)`` from the comment packet, as
+        :func:`flacmeta.split_vorbis_comment` does.
+        """
+        packet = self.packets[1]
+        prefix = self.codec.comment_prefix
+        if not packet.startswith(prefix):
+            raise OggFormatError("second packet is not a comment header")
+        try:
+            return flacmeta.split_vorbis_comment(packet[len(prefix):])
+        except flacmeta.FLACFormatError as err:
+            raise OggFormatError(str(err)) from None
+
+    def with_comments(self, vendor, comments, rest):
+        """
+        Return the header pages with the comment packet replaced.
+        """
+        packet = self.codec.comment_prefix + \
+            flacmeta.build_vorbis_comment(vendor, comments) + rest
+        first = self.pages[0]
+        return [first] + paginate(
+            [packet] + self.packets[2:],
+            first.serial,
+            first.sequence + 1)
+
+def read_comments(path):
+    """
+    Return the vendor string and the comments of the Ogg Vorbis or Opus
+    file at *path*, as list of ``(key, value)`` pairs.
+    """
+    with open(path, "rb") as f:
+        vendor, comments, rest = OggHeaders.read_from(f).comments()
+    return vendor, comments
+
+def _unlink_partial(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def clone_file(source, path, method="reflink"):
+    """
+    Copy the file *source* to *path*, replacing it.
+
+    With *method* ``"reflink"``, the copy shares its data with *source* on
+    file systems supporting it; with ``"hardlink"``, *path* becomes a hard
+    link to *source*. Both fall back to an ordinary copy (``"copy"``).
+    """
+    if method not in COPY_METHODS:
+        raise ValueError("unknown copy method: {!r}".format(method))
+    partial_path = path + ".part"
+    _unlink_partial(partial_path)
+    if method == "hardlink":
+        try:
+            os.link(source, partial_path)
+        except OSError:
+            # different file system, or too many links
+            pass
+        else:
+            os.replace(partial_path, path)
+            return
+    try:
+        with open(source, "rb") as src, open(partial_path, "wb") as dst:
+            cloned = False
+            if method == "reflink":
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    cloned = True
+                except OSError:
+                    pass
+            if not cloned:
+                shutil.copyfileobj(src, dst)
+        shutil.copymode(source, partial_path)
+    except:
+        _unlink_partial(partial_path)
+        raise
+    os.replace(partial_path, path)
+
+def _copy_pages(src, dst, serial, shift):
+    while True:
+        page = Page.read_from(src)
+        if page is None:
+            return
+        if page.serial == serial:
+            page.sequence += shift
+        dst.write(page.to_bytes())
+
+def update_comments(path, update, source=None, method="reflink"):
+    """
+    Replace the comments of the Ogg Vorbis or Opus file at *path* with what
+    *update* returns when called with the current comments, a list of
+    ``(key, value)`` pairs.
+
+    If *source* is given, its comments are passed to *update* instead and
+    the result is written to *path*, replacing the file there. If the
+    comments are unchanged, *source* is copied with :func:`clone_file` and
+    *method*.
+
+    Return :data:`False` if the comments are unchanged, in which case a file
+    is left alone if it is not written to another path.
+    """
+    if source is None:
+        source = path
+    partial_path = path + ".part"
+    with open(source, "rb") as src:
+        headers = OggHeaders.read_from(src)
+        vendor, comments, rest = headers.comments()
+        new_comments = list(update(list(comments)))
+        changed = new_comments != comments
+        if changed:
+            pages = headers.with_comments(vendor, new_comments, rest)
+            shift = len(pages) - len(headers.pages)
+            try:
+                with open(partial_path, "wb") as dst:
+                    for page in pages:
+                        dst.write(page.to_bytes())
+                    if shift:
+                        _copy_pages(src, dst, headers.serial, shift)
+                    else:
+                        shutil.copyfileobj(src, dst)
+                shutil.copymode(source, partial_path)
+            except:
+                _unlink_partial(partial_path)
+                raise
+    if changed:
+        os.replace(partial_path, path)
+    elif source != path:
+        clone_file(source, path, method)
+    return changed
+
+def set_comments(path, values, delete=(), source=None, method="reflink"):
+    """
+    Set the comments in *values*, a sequence of ``(key, value)`` pairs, in
+    the file at *path*, replacing all comments with these keys, and remove
+    those with the keys in *delete*. Keys are compared case-insensitively.
+
+    *source* and *method* are passed to :func:`update_comments`.
+    """
+    drop = {key.upper() for key, value in values}
+    drop.update(key.upper() for key in delete)
+
+    def update(comments):
+        return [
+            (key, value)
+            for key, value in comments
+            if key.upper() not in drop
+        ] + list(values)
+
+    return update_comments(path, update, source=source, method=method)
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    def assignment(x):
+        key, sep, value = x.partition("=")
+        if not sep or not key:
+            raise ValueError("Must be KEY=VALUE.")
+        return key, value
+
+    parser = argparse.ArgumentParser(
+        description="Show or change the comments of Ogg Vorbis and Ogg Opus "
+                    "files without re-encoding them.")
+    parser.add_argument(
+        "-s", "--set",
+        metavar="KEY=VALUE",
+        type=assignment,
+        action="append",
+        default=[],
+        help="Set KEY to VALUE, replacing all comments with KEY. Can be "
+             "specified multiple times; the same KEY may be given more than "
+             "once to set several values.",
+        dest="values"
+    )
+    parser.add_argument(
+        "-d", "--delete",
+        metavar="KEY",
+        action="append",
+        default=[],
+        help="Remove all comments with KEY",
+    )
+    parser.add_argument(
+        "--from",
+        metavar="SOURCE",
+        default=None,
+        help="Write the comments of SOURCE, changed as requested, to FILE "
+             "instead of changing FILE in place. If no change is requested, "
+             "SOURCE is merely copied, whatever its format.",
+        dest="source"
+    )
+    parser.add_argument(
+        "--copy-method",
+        choices=COPY_METHODS,
+        default="reflink",
+        help="How to copy SOURCE if the comments are unchanged; reflink and "
+             "hardlink fall back to copy (default reflink)",
+    )
+    parser.add_argument(
+        "files",
+        nargs="+",
+        metavar="FILE",
+    )
+    args = parser.parse_args()
+
+    if args.source is not None:
+        if len(args.files) != 1:
+            parser.error("--from needs exactly one FILE")
+        try:
+            if args.values or args.delete:
+                set_comments(args.files[0], args.values, args.delete,
+                             source=args.source,
+                             method=args.copy_method)
+            else:
+                clone_file(args.source, args.files[0], args.copy_method)
+        except (OSError, OggFormatError) as err:
+            print("{}: {}".format(args.source, err), file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+
+    status = 0
+    for path in args.files:
+        try:
+            if args.values or args.delete:
+                set_comments(path, args.values, args.delete)
+            else:
+                vendor, comments = read_comments(path)
+                if len(args.files) > 1:
+                    print("{}:".format(path))
+                for key, value in comments:
+                    print("{}={}".format(key, value))
+        except (OSError, OggFormatError) as err:
+            print("{}: {}".format(path, err), file=sys.stderr)
+            status = 1
+    sys.exit(status)
@@ -25,12 +25,34 @@
 
 import abc
 import subprocess
-import re
 import logging
 import os
 import sys
 import time
 import math
+import selectors
+import signal
+import asyncio
+import threading
+import stat
+import errno
+import ctypes
+import ctypes.util
+import struct
+import sqlite3
+import collections
+import heapq
+import itertools
+import functools
+import json
+import concurrent.futures
+import csv
+import array
+import copy
+
+import flacmeta
+import loudness
+import oggtags
 
 devnull = open("/dev/null", "wb")
 devzero = open("/dev/zero", "rb")
@@ -52,7 +74,103 @@ class DummySubprocess:
 
     stdout = devzero
 
+class PhaseProfiler:
+    """
+    Collect the wall-clock time spent in the phases of a run (scanning,
+    reading metadata, creating directories, spawning children, ...) and
+    summarise them as percentiles.
+
+    Code under measurement uses :func:`_phase`, which times nothing unless a
+    profiler has been installed in :data:`profiler`.
+    """
+
+    class _Timer:
+        __slots__ = ("_samples", "_start")
+
+        def __init__(self, samples):
+            self._samples = samples
+
+        def __enter__(self):
+            self._start = time.perf_counter()
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            self._samples.append(time.perf_counter() - self._start)
+
+    def __init__(self):
+        self.samples = {}
+
+    def phase(self, name):
+        """
+        Return a context manager which records the time spent in it as
+        sample of phase *name*.
+        """
+        try:
+            samples = self.samples[name]
+        except KeyError:
+            samples = self.samples[name] = array.array("d")
+        return self._Timer(samples)
+
+    @staticmethod
+    def _percentile(ordered, q):
+        return ordered[max(math.ceil(q * len(ordered)) - 1, 0)]
+
+    def summary(self):
+        """
+        Return a list of ``(phase, count, total, p50, p95, max)`` tuples,
+        with all times in seconds.
+        """
+        result = []
+        for name, samples in sorted(self.samples.items()):
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            result.append((
+                name,
+                len(ordered),
+                math.fsum(ordered),
+                self._percentile(ordered, 0.5),
+                self._percentile(ordered, 0.95),
+                ordered[-1]))
+        return result
+
+    def format(self):
+        lines = ["{:<14s} {:>9s} {:>11s} {:>10s} {:>10s} {:>10s}".format(
+            "phase", "count", "total [s]", "p50 [ms]", "p95 [ms]", "max [ms]")]
+        for name, count, total, p50, p95, maximum in self.summary():
+            lines.append(
+                "{:<14s} {:>9d} {:>11.3f} {:>10.3f} {:>10.3f} {:>10.3f}"
+                .format(name, count, total, p50*1000, p95*1000, maximum*1000))
+        return "\n".join(lines)
+
+class _NoPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_no_phase = _NoPhase()
+
+#: the :class:`PhaseProfiler` in use, if any
+profiler = None
+
+def _phase(name):
+    if profiler is None:
+        return _no_phase
+    return profiler.phase(name)
+
 class TaskHandle:
+    #: whether the handle has started a child process; handles which have not
+    #: (skipped or dry-run tasks) are finished right away
+    spawned = True
+
+    #: set by handles which could not run their task (e.g. because a remote
+    #: worker was lost); the scheduler puts the task back into the queue
+    #: instead of counting it as finished
+    requeue = False
+
     @abc.abstractmethod
     def poll(self):
         """
@@ -80,43 +198,123 @@ class TaskHandle:
         """
         return super().term()
 
+    def processes(self):
+        """
+        Return the :class:`SubprocessHandle` instances of the child processes
+        run for the task.
+        """
+        return []
+
+    def add_wakeup(self, callback):
+        """
+        Call *callback*, from any thread, when the task finishes without a
+        child process exiting. Child processes are noticed through
+        :data:`signal.SIGCHLD`, so this does nothing by default.
+        """
+
+class ResourceUsage:
+    """
+    Resources used by a child process, as reported by :func:`os.wait4`.
+
+    Times are in seconds, :attr:`max_rss` is in KiB.
+    """
+    __slots__ = ("wall_time", "user_time", "system_time", "max_rss")
+
+    def __init__(self, wall_time, user_time, system_time, max_rss):
+        self.wall_time = wall_time
+        self.user_time = user_time
+        self.system_time = system_time
+        self.max_rss = max_rss
+
+    @classmethod
+    def from_rusage(cls, wall_time, rusage):
+        return cls(
+            wall_time, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss)
+
+    @property
+    def cpu_time(self):
+        return self.user_time + self.system_time
+
 class SubprocessHandle(TaskHandle, subprocess.Popen):
+    #: :class:`ResourceUsage` of the child, once it has been reaped
+    usage = None
+
     def skip_init(self):
+        self.spawned = False
         self.poll = lambda: DummySubprocess.poll(self)
         self.wait = lambda: DummySubprocess.wait(self)
         self.kill = lambda: DummySubprocess.kill(self)
+        self.term = lambda: DummySubprocess.term(self)
         self.stdout = DummySubprocess.stdout
 
     def __init__(self, cmdline, *args, dry_run=False, **kwargs):
         logging.debug("$ %s", cmdline)
+        self.program = os.path.basename(cmdline[0])
         if dry_run:
             # that'll be funny :)
             self.skip_init()
         else:
-            super().__init__(cmdline, *args, **kwargs)
+            self._spawned_at = time.monotonic()
+            with _phase("spawn"):
+                super().__init__(cmdline, *args, **kwargs)
 
-class ReinjectWrapper(TaskHandle):
-    def __init__(self, task_handle, reinject_callback, directory):
-        super().__init__()
-        self.hnd = task_handle
-        self.reinject_callback = reinject_callback
-        self.directory = directory
+    def reaped(self, status, rusage):
+        """
+        Record the wait *status* and *rusage* of the child, as returned by
+        :func:`os.wait4`, once it has been reaped by the handle itself or by
+        a :class:`ChildWatcher`.
+        """
+        if self.returncode is not None:
+            return
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+        if rusage is not None:
+            self.usage = ResourceUsage.from_rusage(
+                time.monotonic() - self._spawned_at,
+                rusage)
+
+    # the child is reaped with os.wait4 instead of letting subprocess.Popen
+    # do it, to learn about its resource usage; Popen takes a returncode
+    # which is set as final
 
-    def _handle_result(self):
-        if result == 0 and self.reinject_callback is not None:
-            self.reinject_callback(self.directory)
-            self.reinject_callback = None
-            del self.directory
+    def _reap(self, options):
+        try:
+            pid, status, rusage = os.wait4(self.pid, options)
+        except ChildProcessError:
+            # the child has been reaped elsewhere, its status is lost
+            pid, status, rusage = self.pid, 0, None
+        if pid == self.pid:
+            self.reaped(status, rusage)
 
     def poll(self):
-        result = self.hnd.poll()
-        self._handle_result(result)
-        return result
+        if self.returncode is None:
+            self._reap(os.WNOHANG)
+        return self.returncode
 
-    def wait(self):
-        result = self.hnd.wait()
-        self._handle_result(result)
-        return result
+    def wait(self, timeout=None):
+        if timeout is None:
+            if self.returncode is None:
+                self._reap(0)
+            return self.returncode
+        deadline = time.monotonic() + timeout
+        while self.poll() is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            time.sleep(min(remaining, 0.05))
+        return self.returncode
+
+    def term(self):
+        self.terminate()
+
+    def processes(self):
+        return [self] if self.spawned else []
+
+# characters which some file systems and players choke on, replaced by
+# spaces in the names of outputs which ask for it
+_UNSAFE_NAME_CHARACTERS = str.maketrans(":?!<>*", "      ")
 
 class EncoderHandle(SubprocessHandle):
     def __init__(self, *args, weight=0, **kwargs):
@@ -124,12 +322,47 @@ class EncoderHandle(SubprocessHandle):
         super().__init__(*args, **kwargs)
 
     @staticmethod
-    def _ensure_output_file(flac_file, output_directory, extension):
+    def _get_output_file(flac_file, output_directory, extension,
+            sanitise=False):
         new_name = "./" + os.path.splitext(flac_file)[0] + "." + extension
-        out_file = os.path.join(output_directory, new_name)
+        if sanitise:
+            new_name = new_name.translate(_UNSAFE_NAME_CHARACTERS)
+        return os.path.join(output_directory, new_name)
+
+    @staticmethod
+    def _get_partial_file(out_file):
+        """
+        Return the name under which *out_file* is written while it is being
+        encoded. It is only renamed to *out_file* once the encoder has
+        succeeded, so that an interrupted run never leaves a truncated file
+        under the final name.
+        """
+        return out_file + ".part"
+
+    @staticmethod
+    def _commit_output(partial_file, out_file, success):
+        """
+        Move *partial_file* into place as *out_file* if *success* is true,
+        remove it otherwise.
+        """
+        if success:
+            os.replace(partial_file, out_file)
+            return
+        try:
+            os.unlink(partial_file)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _ensure_output_file(flac_file, output_directory, extension,
+            sanitise=False):
+        out_file = EncoderHandle._get_output_file(
+            flac_file, output_directory, extension, sanitise=sanitise)
         out_dir = os.path.dirname(out_file)
-        if not os.path.isdir(out_dir):
-            os.makedirs(out_dir)
+        with _phase("makedirs"):
+            if not os.path.isdir(out_dir):
+                # several executor threads may create the same directory
+                os.makedirs(out_dir, exist_ok=True)
         return out_file
 
     @staticmethod
@@ -147,10 +380,28 @@ class EncoderHandle(SubprocessHandle):
         )
         return in_pipe_process
 
-class PipeEncoderHandle(EncoderHandle):
+class PipeEncoderHandle(EncoderHandle, metaclass=abc.ABCMeta):
     class OutFileToken:
         __init__ = None
 
+    #: file name extension of the output files; set by subclasses
+    suffix = None
+
+    #: whether characters in :data:`_UNSAFE_NAME_CHARACTERS` are replaced in
+    #: the names of the output files
+    sanitise_names = False
+
+    #: whether the tags of the output files can be rewritten with
+    #: :mod:`oggtags`
+    retaggable = False
+
+    @abc.abstractclassmethod
+    def build_command(cls, comments, *args, **kwargs):
+        """
+        Return the encoder command line, with :class:`OutFileToken` in place of
+        the output file name.
+        """
+
     @staticmethod
     def replace_token(token, substitute):
         def replacer(item):
@@ -166,15 +417,19 @@ class PipeEncoderHandle(EncoderHandle):
             weight=0,
             **kwargs):
 
-        out_file = self._ensure_output_file(flac_file, output_directory, suffix)
+        self._status = None
+        out_file = self._ensure_output_file(
+            flac_file, output_directory, suffix,
+            sanitise=self.sanitise_names)
         if os.path.isfile(out_file) and skip_existing:
             logging.info("skipping existing file: %s", out_file)
             self.skip_init()
             self.weight = 0
             return
 
+        partial_file = self._get_partial_file(out_file)
         command = list(map(
-            self.replace_token(self.OutFileToken, out_file),
+            self.replace_token(self.OutFileToken, partial_file),
             command_template))
 
         in_pipe = self._get_flac_decoder(flac_file, **kwargs)
@@ -188,32 +443,70 @@ class PipeEncoderHandle(EncoderHandle):
         except:
             in_pipe.kill()
             raise
+        # only the encoder reads from the pipe, so that the decoder gets
+        # SIGPIPE if the encoder goes away
+        in_pipe.stdout.close()
         self.in_pipe = in_pipe
         self.out_file = out_file
+        self.partial_file = partial_file
 
-    def term(self):
-        if not self.weight:
+    def _finish(self, returncode):
+        if returncode is None:
+            return None
+        if self._status is None:
+            # once the encoder is gone, the decoder has either hit the end of
+            # its input or will be killed by SIGPIPE, so this does not block
+            # for long; it is reaped even if the encoder has failed
+            decoder_status = self.in_pipe.wait()
+            status = returncode or decoder_status
+            try:
+                self._commit_output(self.partial_file, self.out_file,
+                                    status == 0)
+            except OSError as err:
+                logger.error("cannot move %s into place: %s",
+                             self.out_file, err)
+                status = 1
+            self._status = status
+        return self._status
+
+    def poll(self):
+        return self._finish(super().poll())
+
+    def wait(self):
+        return self._finish(super().wait())
+
+    def processes(self):
+        if not self.spawned:
+            return []
+        return [self.in_pipe, self]
+
+    def _stop(self, how):
+        if not self.spawned or self._status is not None:
             return
-        logging.info("terminating transcoder for %s", self.out_file)
-        self.in_pipe.term()
-        super().term()
-        os.unlink(self.out_file)
+        logging.info("%s transcoder for %s", how, self.out_file)
+        if how == "killing":
+            self.in_pipe.kill()
+            super().kill()
+        else:
+            self.in_pipe.term()
+            super().term()
+        self.in_pipe.wait()
+        super().wait()
+        self._status = -1
+        self._commit_output(self.partial_file, self.out_file, False)
+
+    def term(self):
+        self._stop("terminating")
 
     def kill(self):
-        if not self.weight:
-            return
-        logging.info("killing transcoder for %s", self.out_file)
-        self.in_pipe.kill()
-        super().kill()
-        os.unlink(self.out_file)
+        self._stop("killing")
 
 class OpusEncoderHandle(PipeEncoderHandle):
-    def __init__(self, flac_file, comments, output_directory, mode,
-            skip_existing=False,
-            weight=0,
-            complexity=10,
-            bitrate=None,
-            **kwargs):
+    suffix = "opus"
+    retaggable = True
+
+    @classmethod
+    def build_command(cls, comments, mode, complexity=10, bitrate=None):
         comment_list = []
         for key, value in comments.items():
             comment_list.append("--comment")
@@ -226,17 +519,30 @@ class OpusEncoderHandle(PipeEncoderHandle):
         command_template.extend(mode.to_args())
         command_template.extend(comment_list)
         command_template.append("-")
-        command_template.append(self.OutFileToken)
-
-        super().__init__(
-            flac_file, command_template, output_directory, "opus",
-            skip_existing=skip_existing, weight=weight, **kwargs)
+        command_template.append(cls.OutFileToken)
+        return command_template
 
-class VorbisEncoderHandle(PipeEncoderHandle):
     def __init__(self, flac_file, comments, output_directory, mode,
             skip_existing=False,
             weight=0,
+            complexity=10,
+            bitrate=None,
             **kwargs):
+        command_template = self.build_command(
+            comments, mode,
+            complexity=complexity,
+            bitrate=bitrate)
+
+        super().__init__(
+            flac_file, command_template, output_directory, self.suffix,
+            skip_existing=skip_existing, weight=weight, **kwargs)
+
+class VorbisEncoderHandle(PipeEncoderHandle):
+    suffix = "ogg"
+    retaggable = True
+
+    @classmethod
+    def build_command(cls, comments, mode):
         comment_list = []
         for key, value in comments.items():
             comment_list.append("--comment={0}={1}".format(key, value))
@@ -248,257 +554,4174 @@ class VorbisEncoderHandle(PipeEncoderHandle):
         command_template.append("-Q")
         command_template.append("-")
         command_template.append("-o")
-        command_template.append(self.OutFileToken)
+        command_template.append(cls.OutFileToken)
+        return command_template
+
+    def __init__(self, flac_file, comments, output_directory, mode,
+            skip_existing=False,
+            weight=0,
+            **kwargs):
+        command_template = self.build_command(comments, mode)
 
         super().__init__(
-            flac_file, command_template, output_directory, "ogg",
+            flac_file, command_template, output_directory, self.suffix,
             skip_existing=skip_existing, weight=weight, **kwargs)
 
-class Task(metaclass=abc.ABCMeta):
-    def __init__(self, *args, **kwargs):
-        super().__init__()
-        self._args = args
-        self._kwargs = kwargs
+class LameEncoderHandle(PipeEncoderHandle):
+    suffix = "mp3"
+    sanitise_names = True
 
-    @abc.abstractmethod
-    def __call__(self):
+    # ID3 frames written by lame, by the Vorbis comment they are taken from
+    id3_options = [
+        ("TITLE", "--tt"),
+        ("ARTIST", "--ta"),
+        ("ALBUM", "--tl"),
+        ("GENRE", "--tg"),
+    ]
+
+    @staticmethod
+    def _leading_number(value):
+        digits = ""
+        for c in value.strip():
+            if not c.isdigit():
+                break
+            digits += c
+        return int(digits) if digits else None
+
+    @classmethod
+    def id3_args(cls, comments):
         """
-        Return a task handle executing the task represented by this instance.
+        Return the lame options setting the ID3 tags from the Vorbis
+        *comments*.
+
+        The track number is prefixed with the disc number (or ``0`` if
+        there is none), so that the tracks of multi-disc albums sort
+        correctly on players which ignore the disc number: track 7 of disc 2
+        becomes ``207``.
         """
+        by_key = {key.upper(): value for key, value in comments.items()}
+        args = ["--add-id3v2"]
+        for key, option in cls.id3_options:
+            if key in by_key:
+                args.extend([option, by_key[key]])
 
-class DirectoryFilter(Task):
-    def __init__(self, directory, reinject_callback=None):
-        super().__init__()
-        self.directory = directory
-        self.reinject_callback = reinject_callback
+        year = cls._leading_number(by_key.get("DATE", ""))
+        if year is not None:
+            args.extend(["--ty", str(year)])
 
-class Encoder(Task, metaclass=abc.ABCMeta):
-    comment_re = re.compile("^\s*comment\[[0-9]+\]: ([^=]+)=(.+)$")
+        track = cls._leading_number(by_key.get("TRACKNUMBER", ""))
+        if track is not None:
+            disc = cls._leading_number(by_key.get("DISCNUMBER", "")) or 0
+            args.extend(["--tn", "{:d}{:02d}".format(disc, track)])
+        return args
 
-    def __init__(self, flac_file, output_directory, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.output_directory = output_directory
-        self.flac_file = flac_file
-        self.weight = os.stat(flac_file).st_size
+    @classmethod
+    def build_command(cls, comments, mode):
+        command_template = ["lame", "--quiet"]
+        command_template.extend(mode.to_args())
+        command_template.extend(cls.id3_args(comments))
+        command_template.append("-")
+        command_template.append(cls.OutFileToken)
+        return command_template
 
-    @abc.abstractclassmethod
-    def _get_encoder_handle_class(cls):
-        pass
+    def __init__(self, flac_file, comments, output_directory, mode,
+            skip_existing=False,
+            weight=0,
+            **kwargs):
+        command_template = self.build_command(comments, mode)
 
-    @abc.abstractclassmethod
-    def _get_encoder_mnemonic(cls):
-        pass
+        super().__init__(
+            flac_file, command_template, output_directory, self.suffix,
+            skip_existing=skip_existing, weight=weight, **kwargs)
 
-    def _get_metadata(self):
-        output = subprocess.check_output([
-            "metaflac",
-            "--list",
-            "--block-type", "VORBIS_COMMENT",
-            self.flac_file
-        ]).decode().split("\n")
-
-        comment_re = self.comment_re
-        comments = {}
-        for line in output:
-            m = comment_re.match(line)
-            if m:
-                g = m.groups()
-                comments[g[0]] = g[1]
-        return comments
+def _load_tee():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        tee = libc.tee
+    except (OSError, AttributeError):
+        return None
+    tee.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint]
+    tee.restype = ctypes.c_ssize_t
+    return tee
 
-    def __call__(self):
-        comments = self._get_metadata()
-        return self._get_encoder_handle_class()(
-            self.flac_file,
-            comments,
-            self.output_directory,
-            *self._args,
-            weight=self.weight,
-            **self._kwargs
-        )
+_tee = None
 
-    def __repr__(self):
-        return "<encode {!r} to {}>".format(
-            self.flac_file,
-            self._get_encoder_mnemonic())
+def _pipe_tee(fd_in, fd_out, length):
+    while True:
+        result = _tee(fd_in, fd_out, length, 0)
+        if result >= 0:
+            return result
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
 
-class OpusEncoder(Encoder):
-    class Mode:
-        __init__ = None
+def _read_exactly(fd, length):
+    parts = []
+    while length > 0:
+        data = os.read(fd, length)
+        if not data:
+            break
+        parts.append(data)
+        length -= len(data)
+    return b"".join(parts)
 
-        class _Bitrate:
-            def __init__(self, bitrate=None):
-                self._bitrate = bitrate
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
 
-            def _to_args(self):
-                if self._bitrate is not None:
-                    return ["--bitrate", "{:.1f}".format(self._bitrate)]
-                else:
-                    return []
+def fan_out(source, sinks, chunk_size=65536):
+    """
+    Copy everything from the file descriptor *source* to each of the file
+    descriptors in *sinks*, until *source* hits EOF.
 
-        class VBR(_Bitrate):
-            def to_args(self):
-                return super()._to_args() + ["--vbr"]
+    If all of them are pipes, the data is duplicated in the kernel with
+    :manpage:`tee(2)` and :manpage:`splice(2)`; otherwise it is copied through
+    userspace. Either way, the copy proceeds at the pace of the slowest sink.
 
-        class cVBR(_Bitrate):
-            def to_args(self):
-                return super()._to_args() + ["--cvbr"]
+    A sink whose reader has gone away is closed and dropped; copying
+    continues for the others. Return the set of indices of those sinks. The
+    other sinks are *not* closed.
+    """
+    global _tee
+    broken = set()
+    live = list(range(len(sinks)))
 
-    def __init__(self, flac_file, output_directory,
-            mode=Mode.VBR(128),
-            **kwargs):
-        super().__init__(flac_file, output_directory, mode, **kwargs)
+    def drop(i):
+        broken.add(i)
+        live.remove(i)
+        os.close(sinks[i])
 
-    @classmethod
-    def _get_encoder_handle_class(cls):
-        return OpusEncoderHandle
+    zero_copy = hasattr(os, "splice") and all(
+        stat.S_ISFIFO(os.fstat(fd).st_mode)
+        for fd in [source] + list(sinks))
+    if zero_copy and _tee is None:
+        _tee = _load_tee() or False
+    zero_copy = zero_copy and bool(_tee)
 
-    @classmethod
-    def _get_encoder_mnemonic(cls):
-        return "opus"
+    while live:
+        if not zero_copy:
+            data = os.read(source, chunk_size)
+            if not data:
+                break
+            for i in list(live):
+                try:
+                    _write_all(sinks[i], data)
+                except BrokenPipeError:
+                    drop(i)
+            continue
 
-class VorbisEncoder(Encoder):
-    class Mode:
-        __init__ = None
+        # duplicate the head of the source pipe into all but the last sink,
+        # then consume it by splicing it into the last one
+        length = None
+        teed = {}
+        for i in live[:-1]:
+            try:
+                copied = _pipe_tee(source, sinks[i],
+                                   chunk_size if length is None else length)
+            except BrokenPipeError:
+                drop(i)
+                continue
+            if length is None:
+                if copied == 0:
+                    return broken
+                length = copied
+            teed[i] = copied
 
-        class Bitrate:
-            def __init__(self, bitrate, managed=False):
-                self._bitrate = int(bitrate)
-                self._managed = managed
+        last = live[-1]
+        if length is None:
+            try:
+                if os.splice(source, sinks[last], chunk_size) == 0:
+                    break
+            except BrokenPipeError:
+                drop(last)
+            continue
 
-            def to_args(self):
-                result = ["--bitrate", "{:d}".format(self._bitrate)]
-                if self._managed:
-                    result.append("--managed")
-                return result
+        if all(copied == length for copied in teed.values()):
+            remaining = length
+            while remaining > 0:
+                try:
+                    remaining -= os.splice(source, sinks[last], remaining)
+                except BrokenPipeError:
+                    drop(last)
+                    _read_exactly(source, remaining)
+                    break
+            continue
 
-        class Quality:
-            def __init__(self, quality):
-                self._quality = quality
+        # tee(2) cannot resume a partial copy, so fall back to copying the
+        # rest of this chunk through userspace
+        data = _read_exactly(source, length)
+        for i, copied in teed.items():
+            if copied == length or i in broken:
+                continue
+            try:
+                _write_all(sinks[i], data[copied:])
+            except BrokenPipeError:
+                drop(i)
+        try:
+            _write_all(sinks[last], data)
+        except BrokenPipeError:
+            drop(last)
 
-            def to_args(self):
-                return ["-q", "{:.2f}".format(self._quality)]
+    return broken
 
-    def __init__(self, flac_file, output_directory,
-            mode=Mode.Quality(6),
-            **kwargs):
-        super().__init__(flac_file, output_directory, mode, **kwargs)
+class FanOutEncoderHandle(TaskHandle):
+    """
+    Decode a FLAC file once and feed the PCM stream to several encoders.
 
-    @classmethod
-    def _get_encoder_handle_class(cls):
-        return VorbisEncoderHandle
+    *branches* is a sequence of ``(command_template, output_directory,
+    suffix, sanitise_names, skip_existing)`` tuples, with the command
+    templates as built by :meth:`PipeEncoderHandle.build_command`. The
+    decoder output is fanned out by a pump thread (see :func:`fan_out`), so
+    a slow encoder throttles the decoder, and thus the other encoders,
+    instead of being buffered for.
 
-    @classmethod
-    def _get_encoder_mnemonic(cls):
-        return "oggvorbis"
+    If the decoder fails, all outputs are removed. If a single encoder fails,
+    only its output is removed and the other encoders carry on. Once the
+    handle has finished, :attr:`results` holds, for each branch, whether it
+    succeeded, or :data:`None` if it was skipped.
 
-encoders = {
-    "opus": OpusEncoder,
-    "vorbis": VorbisEncoder,
-    "ogg": VorbisEncoder,
-    "ogg+vorbis": VorbisEncoder
-}
+    If *analyze* is true, the decoder output is also fed to a
+    :class:`loudness.WaveMeter` in another thread, and :attr:`loudness`
+    holds the result once the handle has finished successfully.
+    """
 
-dir_filters = {
-#    "replay-gain", ReplayGain
-}
+    def __init__(self, flac_file, branches,
+            dry_run=False,
+            weight=0,
+            analyze=False):
+        super().__init__()
+        self.flac_file = flac_file
+        self.weight = 0
+        self.returncode = None
+        self.out_files = []
+        self.partial_files = []
+        self.encoders = []
+        self.in_pipe = None
+        self.loudness = None
+        self._pump = None
+        self._analysis = None
+        self._broken = set()
+        self._branches = []
+        self.results = []
 
-class Scheduler:
-    def __init__(self, parallel_tasks):
-        self.pending_tasks = []
-        self.running_tasks = []
-        self.max_tasks = parallel_tasks
-        self.started_at = time.time()
-        self.tasks_completed = 0
-        self.total_weight = 0
-        self.done_weight = 0
+        commands = []
+        for i, (command_template, output_directory, suffix, sanitise_names,
+                skip_existing) in enumerate(branches):
+            out_file = EncoderHandle._ensure_output_file(
+                flac_file, output_directory, suffix,
+                sanitise=sanitise_names)
+            if os.path.isfile(out_file) and skip_existing:
+                logging.info("skipping existing file: %s", out_file)
+                self.results.append(None)
+                continue
+            self.results.append(False)
+            self._branches.append(i)
+            partial_file = EncoderHandle._get_partial_file(out_file)
+            commands.append(list(map(
+                PipeEncoderHandle.replace_token(
+                    PipeEncoderHandle.OutFileToken,
+                    partial_file),
+                command_template)))
+            self.out_files.append(out_file)
+            self.partial_files.append(partial_file)
 
-    def graceful_termination(self):
-        logging.info("sending all tasks a termination signal")
-        for task in self.running_tasks:
-            task.term()
-        self.running_tasks = []
-        self.pending_tasks = []
-        logging.info("all tasks terminated -- work queue cleared")
+        if not commands:
+            self.spawned = False
+            self.returncode = 0
+            return
+        if dry_run:
+            for i in self._branches:
+                self.results[i] = True
+        self.weight = weight * len(commands) // len(branches)
 
-    def poll(self):
-        changed = False
-        for task in list(self.running_tasks):
-            returncode = task.poll()
-            if returncode is not None:
-                self.tasks_completed += 1
-                self.done_weight += task.weight
-                self.running_tasks.remove(task)
-                if returncode == 0:
-                    changed = True
-                else:
-                    logger.error("task %r returned a nonzero status code: %s", task, returncode)
+        if dry_run:
+            EncoderHandle._get_flac_decoder(flac_file, dry_run=True)
+            for command in commands:
+                SubprocessHandle(command, dry_run=True)
+            self.spawned = False
+            self.returncode = 0
+            return
 
-        while len(self.running_tasks) < self.max_tasks and \
-                len(self.pending_tasks) > 0:
+        self.in_pipe = EncoderHandle._get_flac_decoder(flac_file)
+        sinks = []
+        try:
+            for command in commands:
+                read_fd, write_fd = os.pipe()
+                try:
+                    self.encoders.append(SubprocessHandle(
+                        command,
+                        stdin=read_fd,
+                        stdout=devnull))
+                except:
+                    os.close(write_fd)
+                    raise
+                finally:
+                    os.close(read_fd)
+                sinks.append(write_fd)
+            if analyze:
+                read_fd, write_fd = os.pipe()
+                sinks.append(write_fd)
+                self._analysis = threading.Thread(
+                    target=self._run_analysis,
+                    args=(read_fd,),
+                    daemon=True)
+        except:
+            for fd in sinks:
+                os.close(fd)
+            self.in_pipe.kill()
+            for encoder in self.encoders:
+                encoder.kill()
+            raise
+
+        if self._analysis is not None:
+            self._analysis.start()
+        self._pump = threading.Thread(
+            target=self._run_pump,
+            args=(sinks,),
+            daemon=True)
+        self._pump.start()
+
+    def _run_pump(self, sinks):
+        try:
+            self._broken = fan_out(self.in_pipe.stdout.fileno(), sinks)
+        except OSError as exc:
+            logger.error("while feeding encoders for %s: %s",
+                         self.flac_file, exc)
+            self._broken = set(range(len(sinks)))
+        finally:
+            for i, fd in enumerate(sinks):
+                if i not in self._broken:
+                    os.close(fd)
+            self.in_pipe.stdout.close()
+
+    def _run_analysis(self, fd):
+        meter = loudness.WaveMeter()
+        try:
+            while True:
+                data = os.read(fd, 65536)
+                if not data:
+                    break
+                meter.feed(data)
+            result = meter.result()
+        except Exception as err:
+            # closing the pipe makes the pump drop it; the encoders carry on
+            logger.error("cannot measure loudness of %s: %s",
+                         self.flac_file, err)
+        else:
+            self.loudness = result
+        finally:
+            os.close(fd)
+
+    def _join(self):
+        self._pump.join()
+        if self._analysis is not None:
+            self._analysis.join()
+
+    def _finish(self, decoder_returncode, encoder_returncodes):
+        self._join()
+        failed = [
+            i for i, returncode in enumerate(encoder_returncodes)
+            if returncode != 0 or i in self._broken
+        ]
+        if decoder_returncode != 0:
+            logger.error("decoder for %s returned a nonzero status code: %s",
+                         self.flac_file, decoder_returncode)
+            failed = list(range(len(self.encoders)))
+            self.loudness = None
+        for i in range(len(self.encoders)):
+            try:
+                EncoderHandle._commit_output(
+                    self.partial_files[i],
+                    self.out_files[i],
+                    i not in failed)
+            except OSError as err:
+                logger.error("cannot move %s into place: %s",
+                             self.out_files[i], err)
+                failed.append(i)
+        for i, branch in enumerate(self._branches):
+            self.results[branch] = i not in failed
+
+        self.returncode = decoder_returncode or next(
+            (returncode for returncode in encoder_returncodes if returncode),
+            0)
+        if self.returncode == 0 and failed:
+            self.returncode = 1
+        return self.returncode
+
+    def poll(self):
+        if self.returncode is not None:
+            return self.returncode
+        decoder_returncode = self.in_pipe.poll()
+        encoder_returncodes = [encoder.poll() for encoder in self.encoders]
+        if decoder_returncode is None or None in encoder_returncodes:
+            return None
+        return self._finish(decoder_returncode, encoder_returncodes)
+
+    def wait(self):
+        if self.returncode is not None:
+            return self.returncode
+        encoder_returncodes = [encoder.wait() for encoder in self.encoders]
+        decoder_returncode = self.in_pipe.wait()
+        return self._finish(decoder_returncode, encoder_returncodes)
+
+    def _stop(self, how):
+        if self.returncode is not None:
+            return
+        logging.info("%s transcoders for %s", how, self.flac_file)
+        for process in [self.in_pipe] + self.encoders:
+            if process.poll() is None:
+                if how == "killing":
+                    process.kill()
+                else:
+                    process.terminate()
+        for process in [self.in_pipe] + self.encoders:
+            process.wait()
+        self._join()
+        for partial_file, out_file in zip(self.partial_files, self.out_files):
+            EncoderHandle._commit_output(partial_file, out_file, False)
+        self.returncode = -1
+
+    def term(self):
+        self._stop("terminating")
+
+    def kill(self):
+        self._stop("killing")
+
+    def processes(self):
+        if self.in_pipe is None:
+            return []
+        return [self.in_pipe] + self.encoders
+
+    def __repr__(self):
+        return "<decode {!r} for {} encoders>".format(
+            self.flac_file,
+            len(self.out_files))
+
+class Task(metaclass=abc.ABCMeta):
+    # large numbers of tasks may be queued at once
+    __slots__ = ("_args", "_kwargs", "_dependencies")
+
+    #: amount of work represented by the task; for encoders, this is the
+    #: duration of the audio in seconds
+    weight = 0
+
+    #: if true, the tasks depending on this one are started even if it fails;
+    #: otherwise, they are dropped
+    optional = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._args = args
+        self._kwargs = kwargs
+        self._dependencies = ()
+
+    @property
+    def dependencies(self):
+        """
+        Tasks which have to finish before this one is started; see
+        :meth:`depends_on`.
+        """
+        return self._dependencies
+
+    @dependencies.setter
+    def dependencies(self, value):
+        self._dependencies = value
+
+    def depends_on(self, task):
+        """
+        Declare that this task may only be started once *task* has finished.
+        """
+        self._dependencies += (task,)
+
+    def _set_option(self, key, value):
+        # the options may be shared with other tasks (see Encoder.for_file)
+        self._kwargs = dict(self._kwargs)
+        self._kwargs[key] = value
+
+    def ready(self):
+        """
+        Called by the scheduler once all :attr:`dependencies` have finished,
+        right before the task is queued for starting.
+        """
+
+    def prefetch(self, prefetcher):
+        """
+        Called by the scheduler when the task is among the next ones to be
+        started, to do blocking preparations in the threads of the
+        :class:`Prefetcher` *prefetcher*.
+        """
+
+    @property
+    def throughput_key(self):
+        """
+        Key under which the :class:`ThroughputModel` learns how fast tasks
+        like this one are processed.
+        """
+        return type(self).__name__
+
+    @abc.abstractmethod
+    def __call__(self):
+        """
+        Return a task handle executing the task represented by this instance.
+        """
+
+    def finished(self, handle, returncode):
+        """
+        Called by the scheduler once the *handle* returned by :meth:`__call__`
+        has finished with *returncode*.
+        """
+
+class DirectoryFilter(Task):
+    """
+    Task processing the FLAC files of a directory (usually an album) as a
+    whole, before they are encoded.
+
+    The encoding tasks for the *flac_files* in *directory* depend on the
+    filter task (see :func:`tasks_for_directory`), so they are started as
+    soon as it has finished, while the tasks of other directories keep the
+    remaining slots busy.
+    """
+
+    def __init__(self, directory, flac_files, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = directory
+        self.flac_files = list(flac_files)
+
+    def is_up_to_date(self):
+        """
+        Return whether the files need no processing. No task is scheduled
+        for the directory then.
+        """
+        return False
+
+    def __repr__(self):
+        return "<{} {!r}>".format(type(self).__name__, self.directory)
+
+class ReplayGain(DirectoryFilter):
+    """
+    Add track and album ReplayGain tags to the files with ``metaflac
+    --add-replay-gain``, so that the encoders copy them to the outputs.
+    If that fails, the files are not encoded, as their outputs would lack
+    the tags.
+
+    Directories in which all files have both tags already are left alone.
+    """
+
+    tags = frozenset(["REPLAYGAIN_TRACK_GAIN", "REPLAYGAIN_ALBUM_GAIN"])
+
+    def __init__(self, directory, flac_files, **kwargs):
+        super().__init__(directory, flac_files, **kwargs)
+        self._weight = None
+        self._tagged = None
+
+    def _read_files(self):
+        weight = 0
+        tagged = True
+        for flac_file in self.flac_files:
+            try:
+                with _phase("metadata"):
+                    metadata = flacmeta.read_metadata(
+                        flac_file,
+                        blocks={flacmeta.BLOCK_STREAMINFO,
+                                flacmeta.BLOCK_VORBIS_COMMENT})
+            except (OSError, flacmeta.FLACFormatError) as err:
+                logging.warning("cannot read metadata of %s: %s",
+                                flac_file, err)
+                tagged = False
+                continue
+            keys = {key.upper() for key, value in metadata.comments}
+            if not keys >= self.tags:
+                tagged = False
+            if metadata.streaminfo is not None:
+                weight += metadata.streaminfo.duration or 0
+        self._weight = weight
+        self._tagged = tagged
+
+    @property
+    def weight(self):
+        """
+        Total duration of the files, all of which are decoded for the
+        analysis.
+        """
+        if self._weight is None:
+            self._read_files()
+        return self._weight
+
+    def is_up_to_date(self):
+        if self._tagged is None:
+            self._read_files()
+        return self._tagged
+
+    def __call__(self):
+        return SubprocessHandle(
+            ["metaflac", "--add-replay-gain"] + self.flac_files,
+            stdin=None,
+            stdout=devnull,
+            dry_run=self._kwargs.get("dry_run", False))
+
+class Encoder(Task, metaclass=abc.ABCMeta):
+    """
+    Encode a FLAC file.
+
+    A queued encoder only holds the path of the source, split into the
+    (interned) directory and the file name, and its weight. The source is
+    stat'ed and its metadata read once the task is started.
+    """
+
+    # the tasks depending on encoders check whether the output has been built
+    optional = True
+
+    __slots__ = (
+        "output_directory",
+        "index",
+        "metadata",
+        "built",
+        "_directory",
+        "_filename",
+        "_size",
+        "_mtime_ns",
+        "_weight",
+        "_settings",
+        "_prefetched",
+    )
+
+    def __init__(self, flac_file, output_directory, *args, index=None,
+            **kwargs):
+        super().__init__(*args, **kwargs)
+        self.output_directory = output_directory
+        self.flac_file = flac_file
+        self.index = index
+        self.metadata = None
+        # whether the output has been built (or found up to date), once the
+        # task has finished
+        self.built = None
+        self._size = None
+        self._mtime_ns = None
+        self._weight = None
+        self._settings = None
+        self._prefetched = None
+
+    @property
+    def flac_file(self):
+        return os.path.join(self._directory, self._filename)
+
+    @flac_file.setter
+    def flac_file(self, value):
+        # the tasks of the other transcoders for the same file share the name
+        directory, filename = os.path.split(value)
+        self._directory = sys.intern(directory)
+        self._filename = sys.intern(filename)
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def for_file(self, flac_file):
+        """
+        Return a task encoding *flac_file* with the same encoder, settings
+        and options as this one. The task shares them with this one, so
+        creating many tasks this way needs little memory.
+        """
+        self._get_settings()
+        task = copy.copy(self)
+        task.flac_file = flac_file
+        task.metadata = None
+        task.built = None
+        task._size = None
+        task._mtime_ns = None
+        task._weight = None
+        task._prefetched = None
+        task._dependencies = ()
+        return task
+
+    def _stat(self):
+        if self._size is None:
+            st = os.stat(self.flac_file)
+            self._size = st.st_size
+            self._mtime_ns = st.st_mtime_ns
+
+    @property
+    def size(self):
+        self._stat()
+        return self._size
+
+    @property
+    def mtime_ns(self):
+        self._stat()
+        return self._mtime_ns
+
+    @abc.abstractclassmethod
+    def _get_encoder_handle_class(cls):
+        pass
+
+    @abc.abstractclassmethod
+    def _get_encoder_mnemonic(cls):
+        pass
+
+    @abc.abstractclassmethod
+    def _get_gain_tags(cls, track, album):
+        """
+        Return the tags expressing the track and album
+        :class:`loudness.Loudness` (the latter may be :data:`None`) in the
+        output format, as list of ``(key, value)`` pairs.
+        """
+
+    def _read_metadata(self):
+        return flacmeta.read_metadata(
+            self.flac_file,
+            blocks={flacmeta.BLOCK_STREAMINFO, flacmeta.BLOCK_VORBIS_COMMENT})
+
+    def _get_metadata(self):
+        if self.metadata is None:
+            with _phase("metadata"):
+                if self._prefetched is not None:
+                    prefetched, self._prefetched = self._prefetched, None
+                    self.metadata = prefetched.result()
+                else:
+                    self.metadata = self._read_metadata()
+        return self.metadata.comment_dict()
+
+    # used to guess the duration of files without a usable STREAMINFO block;
+    # roughly the bitrate of CD audio compressed with FLAC
+    fallback_bytes_per_second = 110000
+
+    def _get_duration(self):
+        # only the STREAMINFO block is read here; the comments are not needed
+        # before the task is started
+        try:
+            if self.metadata is not None:
+                streaminfo = self.metadata.streaminfo
+            else:
+                with _phase("metadata"):
+                    streaminfo = flacmeta.read_metadata(
+                        self.flac_file,
+                        blocks={flacmeta.BLOCK_STREAMINFO}).streaminfo
+        except (OSError, flacmeta.FLACFormatError) as err:
+            logging.warning("cannot read stream info of %s: %s",
+                            self.flac_file, err)
+            duration = None
+        else:
+            duration = streaminfo.duration if streaminfo is not None else None
+        if duration is None:
+            try:
+                duration = self.size / self.fallback_bytes_per_second
+            except OSError:
+                # the task will fail once it is started
+                duration = 0
+        return duration
+
+    @property
+    def weight(self):
+        """
+        Duration of the source in seconds, read from the STREAMINFO block on
+        first access.
+        """
+        if self._weight is None:
+            self._weight = self._get_duration()
+        return self._weight
+
+    @weight.setter
+    def weight(self, value):
+        self._weight = value
+
+    @property
+    def throughput_key(self):
+        return self._get_settings()
+
+    # options which are consumed by the handles themselves and not passed to
+    # the encoder command line
+    handle_options = frozenset(["dry_run", "skip_existing"])
+
+    def _get_command(self, comments):
+        options = {
+            key: value
+            for key, value in self._kwargs.items()
+            if key not in self.handle_options
+        }
+        return self._get_encoder_handle_class().build_command(
+            comments,
+            *self._args,
+            **options)
+
+    def _get_output_file(self):
+        handle_class = self._get_encoder_handle_class()
+        return EncoderHandle._get_output_file(
+            self.flac_file,
+            self.output_directory,
+            handle_class.suffix,
+            sanitise=handle_class.sanitise_names)
+
+    def _get_settings(self):
+        """
+        Return a string identifying the encoder and its settings.
+        """
+        if self._settings is None:
+            self._settings = " ".join(
+                "{}" if item is PipeEncoderHandle.OutFileToken else item
+                for item in self._get_command({}))
+        return self._settings
+
+    def _record(self, out_file):
+        if self.index is None or self._kwargs.get("dry_run", False):
+            return
+        if self.metadata is None:
+            self._get_metadata()
+        streaminfo = self.metadata.streaminfo
+        self.index.record(
+            self.flac_file,
+            self._get_settings(),
+            self.size,
+            self.mtime_ns,
+            streaminfo.md5 if streaminfo is not None else None,
+            out_file,
+            {key.upper() for key in self.metadata.comment_dict()})
+
+    def is_up_to_date(self):
+        """
+        Check the :class:`BuildIndex` to find out whether the output is
+        current with respect to the source file.
+
+        If the index says that the output is stale, ``skip_existing`` is
+        turned off for this task, so that the output gets rebuilt.
+        """
+        if self.index is None:
+            return False
+        out_file = self._get_output_file()
+        entry = self.index.lookup(self.flac_file, self._get_settings())
+        if entry is None:
+            if self._kwargs.get("skip_existing", False) and \
+                    os.path.isfile(out_file):
+                # adopt outputs which have been built without an index
+                self._record(out_file)
+                return True
+            return False
+
+        size, mtime_ns, audio_md5, output, comment_keys = entry
+        if size == self.size and mtime_ns == self.mtime_ns and \
+                output == out_file and os.path.isfile(out_file):
+            return True
+
+        logging.debug("source changed since last build: %s", self.flac_file)
+        self._set_option("skip_existing", False)
+        return False
+
+    def tag_update(self):
+        """
+        Return a :class:`TagUpdate` task if the source has changed since the
+        output was built according to the :class:`BuildIndex`, but its audio
+        has not, and the tags of the output can be rewritten in place.
+        Otherwise, return :data:`None`.
+        """
+        if self.index is None or \
+                not self._get_encoder_handle_class().retaggable:
+            return None
+        entry = self.index.lookup(self.flac_file, self._get_settings())
+        if entry is None:
+            return None
+        size, mtime_ns, audio_md5, output, comment_keys = entry
+        if not audio_md5 or not any(audio_md5) or comment_keys is None or \
+                output != self._get_output_file() or \
+                not os.path.isfile(output):
+            return None
+        try:
+            streaminfo = flacmeta.read_metadata(
+                self.flac_file,
+                blocks={flacmeta.BLOCK_STREAMINFO}).streaminfo
+        except (OSError, flacmeta.FLACFormatError):
+            return None
+        if streaminfo is None or streaminfo.md5 != audio_md5:
+            return None
+        logging.debug("only the tags changed since last build: %s",
+                      self.flac_file)
+        return TagUpdate(self, comment_keys)
+
+    def finished(self, handle, returncode):
+        self.built = returncode == 0
+        if self.built:
+            self._record(self._get_output_file())
+        # the task may be kept around by the tasks depending on it
+        self.metadata = None
+
+    def ready(self):
+        # a directory filter may have rewritten the source; forget what has
+        # been read from it before
+        self.metadata = None
+        self._prefetched = None
+        self._size = None
+        self._mtime_ns = None
+
+    def prefetch(self, prefetcher):
+        if self.metadata is None and self._prefetched is None:
+            self._prefetched = prefetcher.metadata(
+                self.flac_file,
+                self.size,
+                self.mtime_ns,
+                self._read_metadata)
+        prefetcher.makedirs(os.path.dirname(self._get_output_file()))
+
+    def __call__(self):
+        comments = self._get_metadata()
+        return self._get_encoder_handle_class()(
+            self.flac_file,
+            comments,
+            self.output_directory,
+            *self._args,
+            weight=self.weight,
+            **self._kwargs
+        )
+
+    def __repr__(self):
+        return "<encode {!r} to {}>".format(
+            self.flac_file,
+            self._get_encoder_mnemonic())
+
+class OpusEncoder(Encoder):
+    class Mode:
+        __init__ = None
+
+        class _Bitrate:
+            def __init__(self, bitrate=None, music=False):
+                self._bitrate = bitrate
+                # tune for music instead of speech (--music)
+                self._music = music
+
+            def _to_args(self):
+                result = []
+                if self._bitrate is not None:
+                    result.extend(
+                        ["--bitrate", "{:.1f}".format(self._bitrate)])
+                if self._music:
+                    result.append("--music")
+                return result
+
+        class VBR(_Bitrate):
+            def to_args(self):
+                return super()._to_args() + ["--vbr"]
+
+        class cVBR(_Bitrate):
+            def to_args(self):
+                return super()._to_args() + ["--cvbr"]
+
+    def __init__(self, flac_file, output_directory,
+            mode=Mode.VBR(128),
+            **kwargs):
+        super().__init__(flac_file, output_directory, mode, **kwargs)
+
+    @classmethod
+    def _get_encoder_handle_class(cls):
+        return OpusEncoderHandle
+
+    @classmethod
+    def _get_encoder_mnemonic(cls):
+        return "opus"
+
+    @classmethod
+    def _get_gain_tags(cls, track, album):
+        return loudness.r128_tags(track, album)
+
+class VorbisEncoder(Encoder):
+    class Mode:
+        __init__ = None
+
+        class Bitrate:
+            def __init__(self, bitrate, managed=False):
+                self._bitrate = int(bitrate)
+                self._managed = managed
+
+            def to_args(self):
+                result = ["--bitrate", "{:d}".format(self._bitrate)]
+                if self._managed:
+                    result.append("--managed")
+                return result
+
+        class Quality:
+            def __init__(self, quality):
+                self._quality = quality
+
+            def to_args(self):
+                return ["-q", "{:.2f}".format(self._quality)]
+
+    def __init__(self, flac_file, output_directory,
+            mode=Mode.Quality(6),
+            **kwargs):
+        super().__init__(flac_file, output_directory, mode, **kwargs)
+
+    @classmethod
+    def _get_encoder_handle_class(cls):
+        return VorbisEncoderHandle
+
+    @classmethod
+    def _get_encoder_mnemonic(cls):
+        return "oggvorbis"
+
+    @classmethod
+    def _get_gain_tags(cls, track, album):
+        return loudness.replaygain_tags(track, album)
+
+class LameEncoder(Encoder):
+    class Mode:
+        __init__ = None
+
+        class CBR:
+            def __init__(self, bitrate):
+                self._bitrate = int(bitrate)
+
+            def to_args(self):
+                return ["-b", "{:d}".format(self._bitrate), "-h"]
+
+        class VBR:
+            def __init__(self, quality):
+                self._quality = quality
+
+            def to_args(self):
+                return ["-V", "{:g}".format(self._quality)]
+
+    def __init__(self, flac_file, output_directory,
+            mode=Mode.CBR(256),
+            **kwargs):
+        super().__init__(flac_file, output_directory, mode, **kwargs)
+
+    @classmethod
+    def _get_encoder_handle_class(cls):
+        return LameEncoderHandle
+
+    @classmethod
+    def _get_encoder_mnemonic(cls):
+        return "mp3"
+
+    @classmethod
+    def _get_gain_tags(cls, track, album):
+        # oggtags cannot write ID3 tags
+        return []
+
+class MultiEncoder(Task):
+    """
+    Encode one FLAC file with several :class:`Encoder` tasks, decoding it and
+    reading its metadata only once.
+
+    If *analyze* is true, the loudness of the file is measured from the
+    decoded audio on the way (see :class:`FanOutEncoderHandle`). Once the
+    task has finished, :attr:`loudness` holds the result, and
+    :attr:`results` whether each output has been built.
+    """
+
+    __slots__ = ("encoders", "analyze", "loudness", "results")
+
+    def __init__(self, encoders, analyze=False):
+        super().__init__()
+        self.encoders = list(encoders)
+        self.analyze = analyze
+        self.loudness = None
+        self.results = None
+
+    # the tasks depending on it check the results themselves
+    optional = True
+
+    @property
+    def flac_file(self):
+        return self.encoders[0].flac_file
+
+    @property
+    def directory(self):
+        return self.encoders[0].directory
+
+    @property
+    def weight(self):
+        return self.encoders[0].weight
+
+    @property
+    def throughput_key(self):
+        return " + ".join(encoder.throughput_key for encoder in self.encoders)
+
+    def __call__(self):
+        comments = self.encoders[0]._get_metadata()
+        for encoder in self.encoders[1:]:
+            encoder.metadata = self.encoders[0].metadata
+        branches = [
+            (
+                encoder._get_command(comments),
+                encoder.output_directory,
+                encoder._get_encoder_handle_class().suffix,
+                encoder._get_encoder_handle_class().sanitise_names,
+                encoder._kwargs.get("skip_existing", False),
+            )
+            for encoder in self.encoders
+        ]
+        return FanOutEncoderHandle(
+            self.flac_file,
+            branches,
+            dry_run=self.encoders[0]._kwargs.get("dry_run", False),
+            weight=self.weight,
+            analyze=self.analyze)
+
+    def finished(self, handle, returncode):
+        self.results = handle.results
+        self.loudness = handle.loudness
+        for encoder, result in zip(self.encoders, handle.results):
+            encoder.built = result is not False
+            if encoder.built:
+                encoder._record(encoder._get_output_file())
+            encoder.metadata = None
+        if self.loudness is not None and \
+                not self.encoders[0]._kwargs.get("dry_run", False):
+            indices = {
+                id(encoder.index): encoder.index
+                for encoder in self.encoders
+                if encoder.index is not None
+            }
+            for index in indices.values():
+                index.record_loudness(
+                    self.flac_file,
+                    self.encoders[0].size,
+                    self.encoders[0].mtime_ns,
+                    self.loudness)
+
+    def ready(self):
+        for encoder in self.encoders:
+            encoder.ready()
+
+    def prefetch(self, prefetcher):
+        for encoder in self.encoders:
+            encoder.prefetch(prefetcher)
+
+    def __repr__(self):
+        return "<encode {!r} to {}>".format(
+            self.flac_file,
+            ", ".join(
+                encoder._get_encoder_mnemonic()
+                for encoder in self.encoders))
+
+class CachedLoudness(Task):
+    """
+    Stand in for a :class:`MultiEncoder` measuring the loudness of a FLAC
+    file whose outputs are up to date, with the loudness *measurement*
+    recorded in the :class:`BuildIndex` when they were built, so that the
+    album gain can be computed without encoding the file again.
+    *encoders* are the up to date :class:`Encoder` tasks of the file.
+    """
+
+    __slots__ = ("encoders", "loudness", "results")
+
+    optional = True
+
+    def __init__(self, encoders, measurement):
+        super().__init__()
+        self.encoders = list(encoders)
+        self.loudness = measurement
+        self.results = [True] * len(self.encoders)
+
+    @property
+    def flac_file(self):
+        return self.encoders[0].flac_file
+
+    @property
+    def directory(self):
+        return self.encoders[0].directory
+
+    @classmethod
+    def lookup(cls, encoders):
+        """
+        Return a :class:`CachedLoudness` for *encoders* if all of them are
+        up to date and the loudness of their source is recorded, otherwise
+        :data:`None`.
+        """
+        # up to date implies that the encoders have an index
+        if not all(encoder.is_up_to_date() for encoder in encoders):
+            return None
+        for encoder in encoders:
+            measurement = encoder.index.lookup_loudness(
+                encoder.flac_file,
+                encoder.size,
+                encoder.mtime_ns)
+            if measurement is not None:
+                return cls(encoders, measurement)
+        return None
+
+    def __call__(self):
+        return DummyTaskHandle()
+
+    def __repr__(self):
+        return "<recorded loudness of {!r}>".format(self.flac_file)
+
+class AlbumLoudness:
+    """
+    Collect the loudness of the tracks of an album, i.e. of the
+    *track_count* FLAC files in *directory*, as measured by their
+    :class:`MultiEncoder` tasks or recorded by :class:`CachedLoudness`.
+    """
+
+    def __init__(self, directory, track_count):
+        self.directory = directory
+        self.track_count = track_count
+        self.tracks = []
+        self._album = None
+
+    def add(self, task):
+        self.tracks.append(task)
+
+    def album(self):
+        """
+        Return the :class:`loudness.Loudness` of the album, or :data:`None`
+        if not all tracks have been measured in this run.
+        """
+        if self._album is None:
+            measured = [
+                task.loudness
+                for task in self.tracks
+                if task.loudness is not None
+            ]
+            if len(measured) == self.track_count:
+                self._album = loudness.Loudness.combine(measured)
+            else:
+                logging.warning(
+                    "only %d of %d tracks in %s have been measured; "
+                    "writing track gains only",
+                    len(measured), self.track_count, self.directory)
+                self._album = False
+        return self._album or None
+
+class LoudnessTagger(Task):
+    """
+    Write the gain tags for the loudness of *track* (a :class:`MultiEncoder`
+    or :class:`CachedLoudness` task of the :class:`AlbumLoudness` *album*)
+    into the output of its *encoder*, with :mod:`oggtags` in a thread (see
+    :class:`ThreadTaskHandle`).
+
+    The task has to depend on all tracks of the album, so that the album
+    gain is known when it runs.
+    """
+
+    def __init__(self, album, track, encoder):
+        super().__init__(dry_run=encoder._kwargs.get("dry_run", False))
+        self.album = album
+        self.track = track
+        self.encoder = encoder
+
+    @property
+    def directory(self):
+        return self.album.directory
+
+    def __call__(self):
+        built = self.track.results is not None and \
+            self.track.results[self.track.encoders.index(self.encoder)]
+        if not built or self.track.loudness is None:
+            return DummyTaskHandle()
+        tags = self.encoder._get_gain_tags(
+            self.track.loudness,
+            self.album.album())
+        if not tags:
+            # silence
+            return DummyTaskHandle()
+        return ThreadTaskHandle(
+            repr(self),
+            oggtags.set_comments,
+            self.encoder._get_output_file(),
+            tags,
+            dry_run=self._kwargs["dry_run"])
+
+    def __repr__(self):
+        return "<tag {!r} with its loudness>".format(
+            self.encoder._get_output_file())
+
+def _retag_changes(comments, old_keys):
+    """
+    Return the ``(values, delete)`` arguments of :func:`oggtags.set_comments`
+    replacing the comments with the keys *old_keys* in an output by
+    *comments*.
+    """
+    keys = {key.upper() for key in comments}
+    delete = sorted({key.upper() for key in old_keys} - keys)
+    return list(comments.items()), delete
+
+class TagUpdate(Task):
+    """
+    Replace the tags of the existing output of *encoder* by the current tags
+    of its source, whose audio is unchanged, with :mod:`oggtags` in a thread
+    (see :class:`ThreadTaskHandle`), instead of encoding it again (see
+    :meth:`Encoder.tag_update`). *old_keys* are the keys of the comments
+    written to the output when it was built; those which are no longer in
+    the source are removed, the others written by the encoder or by
+    :class:`LoudnessTagger` are kept.
+
+    If the tags cannot be rewritten, the entry of the output is removed
+    from the :class:`BuildIndex`, so that it is encoded by the next run.
+    """
+
+    __slots__ = ("encoder", "old_keys")
+
+    def __init__(self, encoder, old_keys):
+        super().__init__(dry_run=encoder._kwargs.get("dry_run", False))
+        self.encoder = encoder
+        self.old_keys = old_keys
+
+    @property
+    def encoders(self):
+        return (self.encoder,)
+
+    @property
+    def flac_file(self):
+        return self.encoder.flac_file
+
+    @property
+    def directory(self):
+        return self.encoder.directory
+
+    def ready(self):
+        self.encoder.ready()
+
+    def prefetch(self, prefetcher):
+        self.encoder.prefetch(prefetcher)
+
+    def __call__(self):
+        values, delete = _retag_changes(
+            self.encoder._get_metadata(),
+            self.old_keys)
+        return ThreadTaskHandle(
+            repr(self),
+            oggtags.set_comments,
+            self.encoder._get_output_file(),
+            values,
+            delete,
+            dry_run=self._kwargs["dry_run"])
+
+    def finished(self, handle, returncode):
+        if returncode == 0:
+            self.encoder.finished(handle, returncode)
+            return
+        logging.warning("could not update the tags of %s; it will be "
+                        "encoded again by the next run",
+                        self.encoder._get_output_file())
+        self.encoder.built = False
+        self.encoder.metadata = None
+        self.encoder.index.forget(
+            self.encoder.flac_file,
+            self.encoder._get_settings())
+
+    def __repr__(self):
+        return "<retag {!r} from {!r}>".format(
+            self.encoder._get_output_file(),
+            self.encoder.flac_file)
+
+class DuplicateOutput(Task):
+    """
+    Build the output of *encoder* from the output of *original*, an encoder
+    with the same settings for a source with the same audio, by copying it
+    and rewriting its tags with :mod:`oggtags` in a thread (see
+    :class:`Deduplicator` and :class:`ThreadTaskHandle`). *method* is the
+    copy method of :func:`oggtags.clone_file`.
+
+    The task has to depend on the task building the original output, if it
+    is built in this run. If that fails, or if the tags differ and cannot be
+    rewritten in the output format, *encoder* is run instead.
+    """
+
+    __slots__ = ("encoder", "original", "method")
+
+    def __init__(self, encoder, original, method="reflink"):
+        super().__init__(dry_run=encoder._kwargs.get("dry_run", False))
+        self.encoder = encoder
+        self.original = original
+        self.method = method
+
+    @property
+    def encoders(self):
+        return (self.encoder,)
+
+    @property
+    def flac_file(self):
+        return self.encoder.flac_file
+
+    @property
+    def directory(self):
+        return self.encoder.directory
+
+    def ready(self):
+        self.encoder.ready()
+
+    def prefetch(self, prefetcher):
+        self.encoder.prefetch(prefetcher)
+        self.original.prefetch(prefetcher)
+
+    def __call__(self):
+        encoder = self.encoder
+        handle_class = encoder._get_encoder_handle_class()
+        out_file = EncoderHandle._ensure_output_file(
+            encoder.flac_file,
+            encoder.output_directory,
+            handle_class.suffix,
+            sanitise=handle_class.sanitise_names)
+        if encoder._kwargs.get("skip_existing", False) and \
+                os.path.isfile(out_file):
+            logging.info("skipping existing file: %s", out_file)
+            return DummyTaskHandle()
+        if not self.original.built:
+            logging.info("%s has not been built; encoding %s after all",
+                         self.original._get_output_file(), encoder.flac_file)
+            return encoder()
+
+        comments = encoder._get_metadata()
+        try:
+            original_comments = self.original._get_metadata()
+        except (OSError, flacmeta.FLACFormatError) as err:
+            logging.info("cannot read %s (%s); encoding %s after all",
+                         self.original.flac_file, err, encoder.flac_file)
+            return encoder()
+
+        original_output = self.original._get_output_file()
+        if encoder._get_command(comments) == \
+                self.original._get_command(original_comments):
+            return ThreadTaskHandle(
+                repr(self),
+                oggtags.clone_file,
+                original_output,
+                out_file,
+                self.method,
+                dry_run=self._kwargs["dry_run"])
+        if not handle_class.retaggable:
+            logging.info("cannot rewrite the tags of %s; encoding %s after "
+                         "all", original_output, encoder.flac_file)
+            return encoder()
+        values, delete = _retag_changes(comments, original_comments)
+        return ThreadTaskHandle(
+            repr(self),
+            oggtags.set_comments,
+            out_file,
+            values,
+            delete,
+            original_output,
+            self.method,
+            dry_run=self._kwargs["dry_run"])
+
+    def finished(self, handle, returncode):
+        self.encoder.finished(handle, returncode)
+
+    def __repr__(self):
+        return "<copy {!r} to {} for {!r}>".format(
+            self.original._get_output_file(),
+            self.encoder._get_encoder_mnemonic(),
+            self.encoder.flac_file)
+
+class Deduplicator:
+    """
+    Find sources whose audio is encoded with the same settings for another
+    source, by the MD5 sum of the audio in their STREAMINFO block, so that
+    their outputs can be copied instead (see :class:`DuplicateOutput`).
+
+    The source and output of the originals encoded in this run are
+    remembered; the encoders and the tasks building their outputs only
+    until they have finished. Outputs built in earlier runs are found
+    through the :class:`BuildIndex` of the encoders, if any. *method* is
+    passed to :class:`DuplicateOutput`.
+    """
+
+    def __init__(self, method="reflink"):
+        self.method = method
+        # by audio MD5 and settings, the original encoder if it has not
+        # finished yet, otherwise the paths of its source and output
+        self._originals = {}
+        # the unfinished original encoders, with their key and the task
+        # building their output
+        self._running = {}
+        self._sweep_at = 64
+
+    @staticmethod
+    def _find_built(task, audio_md5):
+        if task.index is None:
+            return None
+        for source, output in task.index.find_audio(
+                audio_md5, task._get_settings()):
+            if source == task.flac_file or not os.path.isfile(output):
+                continue
+            original = task.for_file(source)
+            if original._get_output_file() != output:
+                continue
+            original.built = True
+            return original
+        return None
+
+    def _settle(self, encoder):
+        key, container = self._running.pop(encoder)
+        if self._originals.get(key) is not encoder:
+            return
+        if encoder.built:
+            self._originals[key] = (
+                encoder.flac_file,
+                encoder._get_output_file())
+        else:
+            del self._originals[key]
+
+    def _find_original(self, task, key):
+        original = self._originals.get(key)
+        if isinstance(original, Encoder):
+            if original.built is None:
+                return original
+            self._settle(original)
+            original = self._originals.get(key)
+        if original is not None:
+            source, output = original
+            original = task.for_file(source)
+            if original._get_output_file() == output and \
+                    os.path.isfile(output):
+                original.built = True
+                return original
+        original = self._find_built(task, key[0])
+        if original is not None:
+            self._originals[key] = (
+                original.flac_file,
+                original._get_output_file())
+        return original
+
+    def split(self, tasks):
+        """
+        Split the encoders *tasks* for one source into the encoders which
+        have to run and ``(encoder, original)`` pairs for those whose output
+        can be copied from the output of the encoder *original*.
+        """
+        try:
+            streaminfo = flacmeta.read_metadata(
+                tasks[0].flac_file,
+                blocks={flacmeta.BLOCK_STREAMINFO}).streaminfo
+        except (OSError, flacmeta.FLACFormatError):
+            return tasks, []
+        if streaminfo is None or not any(streaminfo.md5):
+            # the encoder did not compute the MD5 sum
+            return tasks, []
+        if streaminfo.duration is not None:
+            for task in tasks:
+                task.weight = streaminfo.duration
+
+        originals = []
+        duplicates = []
+        for task in tasks:
+            key = (streaminfo.md5, task._get_settings())
+            original = self._find_original(task, key)
+            if original is None:
+                originals.append(task)
+                self._originals[key] = task
+                self._running[task] = (key, None)
+            else:
+                duplicates.append((task, original))
+        return originals, duplicates
+
+    def add(self, container):
+        """
+        Record that the task *container* builds the outputs of the original
+        encoders returned by :meth:`split`.
+        """
+        if len(self._running) >= self._sweep_at:
+            for encoder in list(self._running):
+                if encoder.built is not None:
+                    self._settle(encoder)
+            self._sweep_at = max(64, 2 * len(self._running))
+        for encoder in getattr(container, "encoders", (container,)):
+            if encoder in self._running:
+                key, _ = self._running[encoder]
+                self._running[encoder] = (key, container)
+
+    def duplicate(self, encoder, original):
+        """
+        Return a :class:`DuplicateOutput` task for a pair returned by
+        :meth:`split`.
+        """
+        task = DuplicateOutput(encoder, original, self.method)
+        key, container = self._running.get(original, (None, None))
+        if container is not None:
+            task.depends_on(container)
+        return task
+
+encoders = {
+    "opus": OpusEncoder,
+    "vorbis": VorbisEncoder,
+    "ogg": VorbisEncoder,
+    "ogg+vorbis": VorbisEncoder,
+    "mp3": LameEncoder,
+}
+
+dir_filters = {
+    "replay-gain": ReplayGain,
+}
+
+class BuildIndex:
+    """
+    Persistent record of which output was built from which source file.
+
+    The index is an SQLite database in the output directory. For each source
+    file and encoder settings string, it stores the size, modification time
+    and audio MD5 of the source at the time the output was built, so that a
+    re-run can tell unchanged sources from new or modified ones with a single
+    :func:`os.stat`. The keys of the comments written to the output are
+    stored as well, so that the tags of the output can be updated when only
+    the tags of the source have changed (see :class:`TagUpdate`).
+
+    The loudness measured for a source is kept too, so that the album gain
+    can be computed without measuring the tracks of the album which have
+    not changed (see :class:`CachedLoudness`).
+    """
+
+    filename = ".transcoder-index.sqlite"
+
+    # commit after this many records; losing the last few records on a crash
+    # only means that those files are encoded again
+    commit_interval = 256
+
+    def __init__(self, output_directory):
+        os.makedirs(output_directory, exist_ok=True)
+        self.path = os.path.join(output_directory, self.filename)
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            " source TEXT NOT NULL,"
+            " settings TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " audio_md5 BLOB,"
+            " output TEXT NOT NULL,"
+            " comment_keys TEXT,"
+            " PRIMARY KEY (source, settings))")
+        columns = [
+            row[1]
+            for row in self._db.execute("PRAGMA table_info(outputs)")
+        ]
+        if "comment_keys" not in columns:
+            # indices written before the comment keys were recorded
+            self._db.execute(
+                "ALTER TABLE outputs ADD COLUMN comment_keys TEXT")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS outputs_by_audio"
+            " ON outputs (audio_md5, settings)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS loudness ("
+            " source TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " blocks BLOB NOT NULL,"
+            " peak REAL NOT NULL)")
+        self._db.commit()
+
+    def lookup(self, source, settings):
+        """
+        Return ``(size, mtime_ns, audio_md5, output, comment_keys)`` as
+        recorded for *source* and *settings*, or :data:`None`.
+        *comment_keys* is a list of upper case keys, or :data:`None` if they
+        have not been recorded.
+        """
+        with self._lock:
+            entry = self._db.execute(
+                "SELECT size, mtime_ns, audio_md5, output, comment_keys"
+                " FROM outputs WHERE source = ? AND settings = ?",
+                (source, settings)).fetchone()
+        if entry is None:
+            return None
+        comment_keys = entry[4]
+        if comment_keys is not None:
+            comment_keys = json.loads(comment_keys)
+        return entry[:4] + (comment_keys,)
+
+    def find_audio(self, audio_md5, settings):
+        """
+        Return the ``(source, output)`` pairs recorded for sources with the
+        audio MD5 *audio_md5* and *settings*.
+        """
+        with self._lock:
+            return self._db.execute(
+                "SELECT source, output FROM outputs"
+                " WHERE audio_md5 = ? AND settings = ?",
+                (audio_md5, settings)).fetchall()
+
+    def record(self, source, settings, size, mtime_ns, audio_md5, output,
+            comment_keys=None):
+        if comment_keys is not None:
+            comment_keys = json.dumps(sorted(comment_keys))
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO outputs"
+                " (source, settings, size, mtime_ns, audio_md5, output,"
+                "  comment_keys)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (source, settings, size, mtime_ns, audio_md5, output,
+                 comment_keys))
+            self._count_change()
+
+    def lookup_loudness(self, source, size, mtime_ns):
+        """
+        Return the :class:`loudness.Loudness` recorded for *source* with
+        *size* and *mtime_ns*, or :data:`None`.
+        """
+        with self._lock:
+            entry = self._db.execute(
+                "SELECT blocks, peak FROM loudness"
+                " WHERE source = ? AND size = ? AND mtime_ns = ?",
+                (source, size, mtime_ns)).fetchone()
+        if entry is None:
+            return None
+        import numpy
+        return loudness.Loudness(numpy.frombuffer(entry[0], "<f8"), entry[1])
+
+    def record_loudness(self, source, size, mtime_ns, measurement):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO loudness"
+                " (source, size, mtime_ns, blocks, peak)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (source, size, mtime_ns,
+                 measurement.blocks.astype("<f8").tobytes(),
+                 measurement.peak))
+            self._count_change()
+
+    def forget(self, source, settings):
+        """
+        Remove the entry for *source* and *settings*, so that the output is
+        built again by the next run.
+        """
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM outputs WHERE source = ? AND settings = ?",
+                (source, settings))
+            self._count_change()
+
+    def _count_change(self):
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_interval:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def commit(self):
+        """
+        Commit the records which have not been committed yet, e.g. when there
+        is nothing else to do.
+        """
+        with self._lock:
+            if self._uncommitted:
+                self._db.commit()
+                self._uncommitted = 0
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+class ChildWatcher:
+    """
+    Wake up a waiting :class:`Scheduler` as soon as a child process exits.
+
+    A no-op handler is installed for :data:`signal.SIGCHLD` and the signal is
+    routed through :func:`signal.set_wakeup_fd` into a non-blocking self-pipe,
+    on which :meth:`wait` blocks. The pipe is written from the C-level signal
+    handler, so a child exiting between reaping and waiting is never missed.
+
+    The child processes of the task handles passed to :meth:`watch` are
+    reaped with :func:`os.wait4` whenever :meth:`wait` returns, and their
+    status is handed to them (see :meth:`SubprocessHandle.reaped`).
+
+    Signal handlers can only be installed from the main thread; use
+    :meth:`create` to get :data:`None` instead of an exception elsewhere.
+    """
+
+    def __init__(self):
+        self._rfd, self._wfd = os.pipe()
+        os.set_blocking(self._rfd, False)
+        os.set_blocking(self._wfd, False)
+        try:
+            self._old_handler = signal.signal(signal.SIGCHLD, self._on_sigchld)
+            try:
+                self._old_wakeup_fd = signal.set_wakeup_fd(
+                    self._wfd,
+                    warn_on_full_buffer=False)
+            except:
+                signal.signal(signal.SIGCHLD, self._old_handler)
+                raise
+        except:
+            os.close(self._rfd)
+            os.close(self._wfd)
+            raise
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._rfd, selectors.EVENT_READ)
+        # the unreaped child processes of the watched handles by PID
+        self._children = {}
+
+    @classmethod
+    def create(cls):
+        try:
+            return cls()
+        except ValueError:
+            logging.debug("cannot watch SIGCHLD outside the main thread, "
+                          "falling back to polling")
+            return None
+
+    @staticmethod
+    def _on_sigchld(signum, frame):
+        pass
+
+    def _drain(self):
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def fileno(self):
+        """
+        Return a file descriptor which becomes readable when a signal
+        arrives, to wait for it in another selector; call :meth:`wait` with
+        a timeout of 0 afterwards.
+        """
+        return self._rfd
+
+    def wake(self):
+        """
+        Wake up :meth:`wait`; may be called from any thread.
+        """
+        try:
+            os.write(self._wfd, b"\0")
+        except BlockingIOError:
+            # a wake-up is pending anyway
+            pass
+
+    def register(self, fileobj):
+        """
+        Also wake up :meth:`wait` when *fileobj* becomes readable. It is up
+        to the caller to read from it.
+        """
+        self._selector.register(fileobj, selectors.EVENT_READ)
+
+    def unregister(self, fileobj):
+        self._selector.unregister(fileobj)
+
+    def watch(self, handle):
+        """
+        Reap the child processes of the task handle *handle* from now on.
+        """
+        for process in handle.processes():
+            if process.returncode is None:
+                self._children[process.pid] = process
+
+    def reap(self):
+        """
+        Reap the watched child processes which have exited.
+        """
+        for pid, process in list(self._children.items()):
+            if process.returncode is None:
+                try:
+                    reaped, status, rusage = os.wait4(pid, os.WNOHANG)
+                except ChildProcessError:
+                    # reaped elsewhere; the handle finds out itself
+                    reaped = pid
+                    status = rusage = None
+                if not reaped:
+                    continue
+                if status is not None:
+                    process.reaped(status, rusage)
+            del self._children[pid]
+
+    def wait(self, timeout=None):
+        """
+        Block until a signal arrives, a registered file becomes readable or
+        *timeout* seconds have passed, and reap the watched children which
+        have exited.
+
+        Return :data:`True` if woken by a signal or a registered file.
+        """
+        events = self._selector.select(timeout)
+        self._drain()
+        self.reap()
+        return bool(events)
+
+    def close(self):
+        signal.set_wakeup_fd(self._old_wakeup_fd)
+        signal.signal(signal.SIGCHLD, self._old_handler)
+        self._selector.close()
+        os.close(self._rfd)
+        os.close(self._wfd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _load_inotify():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        init1 = libc.inotify_init1
+        add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    init1.argtypes = [ctypes.c_int]
+    init1.restype = ctypes.c_int
+    add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    add_watch.restype = ctypes.c_int
+    return init1, add_watch
+
+class DirectoryWatcher:
+    """
+    Watch directory trees with inotify for FLAC files which are written or
+    moved into them, and report them by directory (album) once no event has
+    arrived for that directory for *debounce* seconds.
+
+    Directories created or moved into a watched tree are watched as well,
+    and all FLAC files in them are reported. If the kernel drops events,
+    all FLAC files in all watched directories are reported.
+
+    The watcher has a :meth:`fileno` to wait for with :mod:`selectors`;
+    call :meth:`read` when it is readable and :meth:`due` to collect the
+    directories to process.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = os.O_CLOEXEC
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+    event_header = struct.Struct("iIII")
+
+    def __init__(self, debounce=2.0):
+        functions = _load_inotify()
+        if functions is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        init1, self._add_watch = functions
+        self._fd = init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.debounce = debounce
+        # watched directories by watch descriptor
+        self._directories = {}
+        # the changed FLAC files and the time they are due at, by directory
+        self._changed = {}
+        self._deadlines = {}
+
+    def fileno(self):
+        return self._fd
+
+    def add(self, directory):
+        """
+        Watch *directory*, but not its subdirectories.
+        """
+        wd = self._add_watch(self._fd, os.fsencode(directory), self.mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            logging.error("cannot watch %s: %s", directory, os.strerror(err))
+            return
+        # a directory which has been moved keeps its watch descriptor
+        self._directories[wd] = directory
+
+    def add_tree(self, directory, changed=False):
+        """
+        Watch *directory* and all directories below it. If *changed* is
+        true, report all FLAC files in them.
+        """
+        for dirpath, dirnames, filenames in os.walk(directory):
+            self.add(dirpath)
+            if changed:
+                self._changed_files(dirpath, filter(is_flac, filenames))
+
+    def _changed_files(self, dirpath, filenames):
+        changed = self._changed.setdefault(dirpath, set())
+        changed.update(filenames)
+        if not changed:
+            del self._changed[dirpath]
+            return
+        self._deadlines[dirpath] = time.monotonic() + self.debounce
+
+    def read(self):
+        """
+        Process the pending events, without blocking.
+        """
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.event_header.unpack_from(
+                    data, offset)
+                offset += self.event_header.size
+                name = data[offset:offset+length].rstrip(b"\0")
+                offset += length
+                self._process(wd, mask, os.fsdecode(name))
+
+    def _process(self, wd, mask, name):
+        if mask & self.IN_Q_OVERFLOW:
+            logging.warning("inotify events have been lost; checking all "
+                            "watched directories")
+            for directory in list(self._directories.values()):
+                try:
+                    filenames = os.listdir(directory)
+                except OSError:
+                    continue
+                self._changed_files(directory, filter(is_flac, filenames))
+            return
+        if mask & self.IN_IGNORED:
+            # the directory has been removed
+            self._directories.pop(wd, None)
+            return
+        directory = self._directories.get(wd)
+        if directory is None:
+            return
+        path = os.path.join(directory, name)
+        if mask & self.IN_ISDIR:
+            if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                # files may have been added before the watch
+                self.add_tree(path, changed=True)
+        elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO) and \
+                is_flac(name):
+            logging.debug("changed: %s", path)
+            self._changed_files(directory, [name])
+
+    def timeout(self):
+        """
+        Return the number of seconds until the next directory is due, or
+        :data:`None` if no directory has changed.
+        """
+        if not self._deadlines:
+            return None
+        return max(min(self._deadlines.values()) - time.monotonic(), 0)
+
+    def due(self, busy=None):
+        """
+        Return ``(dirpath, filenames)`` for the directories whose changes
+        are due, with the names of the changed FLAC files which still exist,
+        and forget about them.
+
+        *busy* may be a callable taking a directory, which returns whether
+        earlier work on it is still going on; those directories are
+        postponed until it has finished, so that their files are not
+        processed twice at the same time.
+        """
+        now = time.monotonic()
+        result = []
+        for dirpath, deadline in list(self._deadlines.items()):
+            if deadline > now:
+                continue
+            if busy is not None and busy(dirpath):
+                self._deadlines[dirpath] = now + self.debounce
+                continue
+            del self._deadlines[dirpath]
+            filenames = sorted(
+                filename
+                for filename in self._changed.pop(dirpath)
+                if os.path.isfile(os.path.join(dirpath, filename)))
+            if filenames:
+                result.append((dirpath, filenames))
+        return result
+
+    def close(self):
+        os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class Prefetcher:
+    """
+    Do the blocking preparations for the next tasks of a :class:`Scheduler`
+    (reading the metadata of their sources, creating their output
+    directories) in a pool of *workers* threads, so that starting a task
+    only means spawning its processes.
+
+    The results are cached, so that the tasks of several transcoders for the
+    same file share one read. The metadata is keyed by the path, size and
+    modification time of the file, so that a file changed in the meantime is
+    read again. The cache holds at most *cache_size* entries; the oldest are
+    dropped first, and finished ones are not used after *max_age* seconds,
+    as a long running process may see the same file or directory again
+    after it has been changed or removed.
+    """
+
+    def __init__(self, workers=2, cache_size=256, max_age=60.0):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="prefetch")
+        # key -> (future, submission time)
+        self._cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.max_age = max_age
+
+    def _submit(self, key, fn, *args, **kwargs):
+        entry = self._cache.get(key)
+        now = time.monotonic()
+        if entry is not None:
+            future, submitted_at = entry
+            if not future.done() or now - submitted_at < self.max_age:
+                self._cache.move_to_end(key)
+                return future
+            del self._cache[key]
+        future = self._executor.submit(fn, *args, **kwargs)
+        self._cache[key] = (future, now)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return future
+
+    def metadata(self, path, size, mtime_ns, read):
+        """
+        Return a :class:`concurrent.futures.Future` for the metadata of the
+        file at *path*, which is read by calling *read* unless it is cached
+        for the same *size* and *mtime_ns*.
+        """
+        return self._submit(("metadata", path, size, mtime_ns), read)
+
+    def forget(self, path):
+        """
+        Drop the cached metadata of the file at *path*, which has changed.
+        """
+        for key in [key for key in self._cache
+                    if key[0] == "metadata" and key[1] == path]:
+            del self._cache[key]
+
+    def makedirs(self, path):
+        """
+        Create the directory *path* and its parents, unless that has been
+        done recently.
+        """
+        return self._submit(("makedirs", path), os.makedirs, path,
+                            exist_ok=True)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class ScanEstimate:
+    """
+    Count the FLAC files below *directories* in a background thread.
+
+    While tasks are streamed into the :class:`Scheduler` as the scan
+    progresses, the total amount of work is not known. :func:`scan_dir`
+    reports the number of files it has scanned, and the ratio to the number
+    of files counted here is used to extrapolate the remaining work.
+    """
+
+    def __init__(self, directories):
+        self.files_total = 0
+        self.files_scanned = 0
+        self.complete = False
+        self._thread = threading.Thread(
+            target=self._count,
+            args=(list(directories),),
+            daemon=True)
+        self._thread.start()
+
+    def _count(self, directories):
+        for directory in directories:
+            for dirpath, dirnames, filenames in os.walk(directory):
+                self.files_total += sum(map(is_flac, filenames))
+        self.complete = True
+
+    def scanned(self, count):
+        self.files_scanned += count
+
+    def fraction(self):
+        """
+        Return the fraction of files scanned so far, or :data:`None` if
+        nothing has been scanned yet.
+        """
+        if not self.files_scanned:
+            return None
+        return self.files_scanned / max(self.files_total, self.files_scanned)
+
+class DispatchPolicy(metaclass=abc.ABCMeta):
+    """
+    Container for the pending tasks of a :class:`Scheduler`, which decides the
+    order in which they are started.
+
+    Tasks are kept in a heap ordered by :meth:`_key`; ties are broken in the
+    order in which the tasks were added. When tasks are fed from a scan, the
+    policy can only order the tasks within the look-ahead window of the
+    scheduler (see :attr:`Scheduler.high_watermark`).
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+
+    @abc.abstractmethod
+    def _key(self, task):
+        """
+        Return the sort key for *task*; lower keys are started first.
+        """
+
+    def append(self, task):
+        heapq.heappush(
+            self._heap, (self._key(task), next(self._counter), task))
+
+    def pop(self):
+        return heapq.heappop(self._heap)[-1]
+
+    def peek(self, count):
+        """
+        Return the next *count* tasks, in the order in which they would be
+        popped, without removing them.
+        """
+        return [entry[-1] for entry in heapq.nsmallest(count, self._heap)]
+
+    def clear(self):
+        self._heap.clear()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __iter__(self):
+        return (entry[-1] for entry in self._heap)
+
+class FIFODispatch(DispatchPolicy):
+    """
+    Start tasks in the order in which they were scheduled.
+    """
+
+    def _key(self, task):
+        return 0
+
+class LongestFirstDispatch(DispatchPolicy):
+    """
+    Start the heaviest tasks first (longest processing time first), so that
+    no long task is left running on its own at the end of the run.
+    """
+
+    def _key(self, task):
+        return -task.weight
+
+def _task_directory(task):
+    directory = getattr(task, "directory", None)
+    if directory is None:
+        directory = os.path.dirname(getattr(task, "flac_file", ""))
+    return directory
+
+def _task_source(task):
+    """
+    Return the source of *task*: the directory of a :class:`DirectoryFilter`,
+    the FLAC file of the other tasks.
+    """
+    if isinstance(task, DirectoryFilter):
+        return task.directory
+    return getattr(task, "flac_file", None)
+
+class DirectoryDispatch(DispatchPolicy):
+    """
+    Start the tasks directory by directory, in the order in which the
+    directories were first seen, and longest first within a directory.
+
+    This keeps reads from the source local to one album at a time.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._directories = {}
+
+    def _key(self, task):
+        directory = _task_directory(task)
+        order = self._directories.setdefault(directory, len(self._directories))
+        return order, -task.weight
+
+    def pop(self):
+        task = super().pop()
+        if not self._heap:
+            self._directories.clear()
+        return task
+
+    def clear(self):
+        super().clear()
+        self._directories.clear()
+
+class FairShareDispatch:
+    """
+    Share the slots of a :class:`Scheduler` between groups of tasks, such as
+    the jobs of a :class:`jobservice.Service`. It has the same interface as
+    :class:`DispatchPolicy`.
+
+    *group* returns the group of a task and *running* a
+    :class:`collections.Counter` of the running tasks by group. The next
+    task is taken from the group with the fewest running tasks; ties go to
+    the group which has been served longest ago. Within a group, the tasks
+    are ordered by an instance of the :class:`DispatchPolicy` subclass
+    *policy*.
+    """
+
+    def __init__(self, group, running, policy=LongestFirstDispatch):
+        self.group = group
+        self.running = running
+        self.policy = policy
+        # the pending tasks by group, and when each group was last served
+        self._groups = {}
+        self._last_served = {}
+        self._counter = itertools.count()
+
+    def _choose(self, groups, counts, last_served):
+        return min(
+            groups,
+            key=lambda key: (counts[key], last_served.get(key, -1)))
+
+    def append(self, task):
+        key = self.group(task)
+        queue = self._groups.get(key)
+        if queue is None:
+            queue = self._groups[key] = self.policy()
+        queue.append(task)
+
+    def pop(self):
+        key = self._choose(self._groups, self.running(), self._last_served)
+        queue = self._groups[key]
+        task = queue.pop()
+        if queue:
+            self._last_served[key] = next(self._counter)
+        else:
+            del self._groups[key]
+            self._last_served.pop(key, None)
+        return task
+
+    def peek(self, count):
+        """
+        Return the next *count* tasks, in the order in which they would be
+        popped if no running task finished meanwhile, without removing them.
+        """
+        candidates = {
+            key: collections.deque(queue.peek(count))
+            for key, queue in self._groups.items()
+        }
+        counts = self.running()
+        last_served = dict(self._last_served)
+        tasks = []
+        while candidates and len(tasks) < count:
+            key = self._choose(candidates, counts, last_served)
+            tasks.append(candidates[key].popleft())
+            if not candidates[key]:
+                del candidates[key]
+            counts[key] += 1
+            last_served[key] = next(self._counter)
+        return tasks
+
+    def clear(self):
+        self._groups.clear()
+        self._last_served.clear()
+
+    def __len__(self):
+        return sum(map(len, self._groups.values()))
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._groups.values())
+
+dispatch_policies = {
+    "longest-first": LongestFirstDispatch,
+    "fifo": FIFODispatch,
+    "directory": DirectoryDispatch,
+}
+
+class ThroughputModel:
+    """
+    Learn how fast the tasks of each kind are processed and estimate the time
+    needed for the remaining work from that.
+
+    Throughput is measured as realtime factor per slot: seconds of audio
+    (the task :attr:`~Task.weight`) processed per second of wall-clock time.
+    It is tracked separately for each :attr:`~Task.throughput_key` (i.e. for
+    each encoder and its settings) as exponentially weighted moving average,
+    so that it follows changes in the load of the machine.
+
+    *factors* may be a mapping of previously learnt realtime factors, as
+    returned by :meth:`load`.
+    """
+
+    #: weight of a new sample in the moving average
+    smoothing = 0.1
+
+    def __init__(self, factors=None):
+        self.factors = dict(factors or {})
+
+    @classmethod
+    def load(cls, path):
+        """
+        Create a model with the realtime factors saved at *path*. A missing
+        or unreadable file is not an error; the model then starts from
+        scratch.
+        """
+        try:
+            with open(path, "r") as f:
+                factors = json.load(f)
+        except FileNotFoundError:
+            factors = {}
+        except (OSError, ValueError) as err:
+            logging.warning("ignoring throughput file %s: %s", path, err)
+            factors = {}
+        if not isinstance(factors, dict):
+            logging.warning("ignoring throughput file %s: not a mapping", path)
+            factors = {}
+        return cls({
+            key: float(value)
+            for key, value in factors.items()
+            if isinstance(value, (int, float)) and value > 0
+        })
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.factors, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def learn(self, key, duration, elapsed):
+        """
+        Record that a task with *key* processed *duration* seconds of audio
+        in *elapsed* seconds.
+        """
+        if duration <= 0 or elapsed <= 0:
+            return
+        sample = duration / elapsed
+        factor = self.factors.get(key)
+        if factor is None:
+            self.factors[key] = sample
+        else:
+            self.factors[key] = factor + self.smoothing * (sample - factor)
+
+    def factor(self, key):
+        """
+        Return the realtime factor for *key*. If nothing has been learnt
+        about *key* yet, the average over all keys is used; if nothing has
+        been learnt at all, return :data:`None`.
+        """
+        try:
+            return self.factors[key]
+        except KeyError:
+            pass
+        if not self.factors:
+            return None
+        return sum(self.factors.values()) / len(self.factors)
+
+    def estimate(self, pending, running, slots):
+        """
+        Return the estimated wall-clock time in seconds to finish the work,
+        or :data:`None` if nothing has been learnt yet.
+
+        *pending* is an iterable of ``(key, duration)`` pairs with the total
+        duration of the tasks not started yet for each key, *running* an
+        iterable of ``(key, duration, elapsed)`` tuples for the tasks which
+        are running, and *slots* the number of tasks running in parallel.
+        """
+        remaining = 0.0
+        for key, duration in pending:
+            if duration <= 0:
+                continue
+            factor = self.factor(key)
+            if factor is None:
+                return None
+            remaining += duration / factor
+        for key, duration, elapsed in running:
+            factor = self.factor(key)
+            if factor is None:
+                return None
+            remaining += max(duration / factor - elapsed, 0.0)
+        return remaining / max(slots, 1)
+
+class SchedulerListener:
+    """
+    Base class for objects which are told by :class:`Scheduler` and
+    :class:`AsyncScheduler` about the tasks they run. Add instances to
+    :attr:`Scheduler.listeners` to use them.
+    """
+
+    def task_started(self, task):
+        """
+        Called when a child process has been started for *task*.
+        """
+
+    def task_skipped(self, task):
+        """
+        Called when *task* finished without starting a child process (e.g.
+        because its output exists or because of a dry run).
+        """
+
+    def task_finished(self, task, handle, returncode, wall_time):
+        """
+        Called when *task* has finished with *returncode* after *wall_time*
+        seconds. *handle* is the task handle, or :data:`None` if the
+        scheduler does not use task handles.
+        """
+
+    def task_dropped(self, task):
+        """
+        Called when *task* is not going to run: it could not be started, a
+        task it depends on has failed, or it has been cancelled.
+        """
+
+    def snapshot(self, estimate, slots):
+        """
+        Called periodically with the result of :meth:`Scheduler.guesstimate`
+        and the number of tasks which may run in parallel.
+        """
+
+    def close(self):
+        """
+        Called at the end of the run, after the last :meth:`snapshot`.
+        """
+
+class RunReport(SchedulerListener):
+    """
+    Collect the resources used by the child processes of each finished task,
+    and aggregate them per program (``flac``, ``opusenc``, ...) and per
+    encoder setting (the :attr:`~Task.throughput_key` of the tasks).
+    """
+
+    csv_fields = [
+        "record",
+        "source",
+        "task",
+        "program",
+        "returncode",
+        "audio_seconds",
+        "wall_time",
+        "user_time",
+        "system_time",
+        "max_rss_kib",
+        "realtime_factor",
+        "cpu_seconds_per_audio_hour",
+    ]
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.tasks = []
+
+    def task_finished(self, task, handle, returncode, wall_time):
+        processes = []
+        if handle is not None:
+            for process in handle.processes():
+                usage = process.usage
+                if usage is None:
+                    continue
+                processes.append({
+                    "program": process.program,
+                    "wall_time": usage.wall_time,
+                    "user_time": usage.user_time,
+                    "system_time": usage.system_time,
+                    "max_rss_kib": usage.max_rss,
+                })
+        self.tasks.append({
+            "source": _task_source(task),
+            "task": task.throughput_key,
+            "returncode": returncode,
+            "audio_seconds": task.weight,
+            "wall_time": wall_time,
+            "processes": processes,
+        })
+
+    @staticmethod
+    def _rates(entry):
+        audio = entry["audio_seconds"]
+        wall = entry["wall_time"]
+        cpu = entry["user_time"] + entry["system_time"]
+        entry["realtime_factor"] = audio / wall if wall > 0 else None
+        entry["cpu_seconds_per_audio_hour"] = \
+            cpu / audio * 3600 if audio > 0 else None
+        return entry
+
+    @staticmethod
+    def _empty():
+        return {
+            "count": 0,
+            "audio_seconds": 0.0,
+            "wall_time": 0.0,
+            "user_time": 0.0,
+            "system_time": 0.0,
+            "max_rss_kib": 0,
+        }
+
+    def aggregates(self):
+        """
+        Return ``(programs, encoders)``, two dictionaries mapping program
+        names and encoder settings respectively to the totals of the
+        successful tasks.
+        """
+        programs = {}
+        encoders = {}
+        for row in self.tasks:
+            if row["returncode"] != 0:
+                continue
+            encoder = encoders.setdefault(row["task"], self._empty())
+            encoder["count"] += 1
+            encoder["audio_seconds"] += row["audio_seconds"]
+            encoder["wall_time"] += row["wall_time"]
+            for process in row["processes"]:
+                program = programs.setdefault(
+                    process["program"], self._empty())
+                program["count"] += 1
+                program["audio_seconds"] += row["audio_seconds"]
+                for entry in (program, encoder):
+                    entry["user_time"] += process["user_time"]
+                    entry["system_time"] += process["system_time"]
+                    entry["max_rss_kib"] = max(entry["max_rss_kib"],
+                                               process["max_rss_kib"])
+                program["wall_time"] += process["wall_time"]
+        for entry in itertools.chain(programs.values(), encoders.values()):
+            self._rates(entry)
+        return programs, encoders
+
+    def _write_json(self, f):
+        programs, encoders = self.aggregates()
+        json.dump(
+            {
+                "started_at": self.started_at,
+                "finished_at": time.time(),
+                "tasks": self.tasks,
+                "programs": programs,
+                "encoders": encoders,
+            },
+            f,
+            indent=2)
+        f.write("\n")
+
+    def _write_csv(self, f):
+        writer = csv.DictWriter(f, self.csv_fields, extrasaction="ignore")
+        writer.writeheader()
+        for row in self.tasks:
+            for process in row["processes"] or [{}]:
+                record = dict(row, record="process")
+                record.update(process)
+                writer.writerow(record)
+        programs, encoders = self.aggregates()
+        for record, entries, column in (("program", programs, "program"),
+                                        ("encoder", encoders, "task")):
+            for name, entry in sorted(entries.items()):
+                writer.writerow(dict(entry, record=record, **{column: name}))
+
+    def write(self, path):
+        """
+        Write the report to *path*, as CSV if the name ends in ``.csv`` and as
+        JSON otherwise.
+        """
+        with open(path, "w", newline="") as f:
+            if path.endswith(".csv"):
+                self._write_csv(f)
+            else:
+                self._write_json(f)
+
+class ProgressStream(SchedulerListener):
+    """
+    Write one JSON object per line to the text file *f* for each task which
+    is started, skipped, finished successfully or failed, and for each
+    progress snapshot.
+
+    Every object has an ``event`` (``start``, ``skip``, ``finish``, ``fail``
+    or ``progress``) and a ``time`` (seconds since the epoch). If writing
+    fails, e.g. because the reading end of a pipe has gone away, the stream
+    is switched off.
+    """
+
+    def __init__(self, f):
+        self._file = f
+
+    def _emit(self, event, **fields):
+        if self._file is None:
+            return
+        fields["event"] = event
+        fields["time"] = time.time()
+        try:
+            self._file.write(json.dumps(fields, sort_keys=True) + "\n")
+            self._file.flush()
+        except OSError as err:
+            logging.error("cannot write progress stream: %s", err)
+            self._file = None
+
+    @staticmethod
+    def _task_fields(task):
+        return {
+            "source": _task_source(task),
+            "encoder": task.throughput_key,
+        }
+
+    def task_started(self, task):
+        self._emit("start", **self._task_fields(task))
+
+    def task_skipped(self, task):
+        self._emit("skip", **self._task_fields(task))
+
+    def task_finished(self, task, handle, returncode, wall_time):
+        self._emit(
+            "finish" if returncode == 0 else "fail",
+            returncode=returncode,
+            wall_time=wall_time,
+            audio_seconds=task.weight,
+            **self._task_fields(task))
+
+    def snapshot(self, estimate, slots):
+        done, pending, running, eta = estimate
+        self._emit(
+            "progress",
+            done=done,
+            pending=pending,
+            running=running,
+            slots=slots,
+            eta=eta)
+
+    def close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+class TextfileExporter(SchedulerListener):
+    """
+    Keep the file at *path* up to date with metrics in the Prometheus text
+    format, for the textfile collector of the node_exporter.
+
+    The file is rewritten at most every :attr:`interval` seconds, by writing
+    a temporary file next to it and renaming it, so that the collector never
+    sees a partial file.
+    """
+
+    interval = 5
+    prefix = "transcoder"
+
+    def __init__(self, path):
+        self.path = path
+        self.started_at = time.time()
+        self.tasks_finished = 0
+        self.tasks_failed = 0
+        self.tasks_skipped = 0
+        self.audio_seconds = 0.0
+        self._estimate = None
+        self._slots = 0
+        self._next_write = 0
+
+    def task_skipped(self, task):
+        self.tasks_skipped += 1
+
+    def task_finished(self, task, handle, returncode, wall_time):
+        if returncode == 0:
+            self.tasks_finished += 1
+            self.audio_seconds += task.weight
+        else:
+            self.tasks_failed += 1
+
+    def snapshot(self, estimate, slots):
+        self._estimate = estimate
+        self._slots = slots
+        now = time.monotonic()
+        if now >= self._next_write:
+            self._next_write = now + self.interval
+            self._write()
+
+    def close(self):
+        if self._estimate is not None:
+            self._write()
+
+    def _metrics(self):
+        done, pending, running, eta = self._estimate
+        elapsed = time.time() - self.started_at
+        yield ("tasks_finished_total", "counter",
+               "Tasks which finished successfully", self.tasks_finished)
+        yield ("tasks_failed_total", "counter",
+               "Tasks which failed", self.tasks_failed)
+        yield ("tasks_skipped_total", "counter",
+               "Tasks which were skipped", self.tasks_skipped)
+        yield ("audio_seconds_total", "counter",
+               "Seconds of audio encoded", self.audio_seconds)
+        yield ("throughput_ratio", "gauge",
+               "Seconds of audio encoded per second since the start",
+               self.audio_seconds / elapsed if elapsed > 0 else 0)
+        yield ("tasks_pending", "gauge",
+               "Tasks waiting to be started, including the estimated "
+               "number of tasks not scanned yet", pending)
+        yield ("tasks_running", "gauge", "Tasks running", running)
+        yield ("slots", "gauge", "Tasks which may run in parallel",
+               self._slots)
+        if eta is not None:
+            yield ("eta_seconds", "gauge",
+                   "Estimated time until all tasks are finished", eta)
+        yield ("last_update_timestamp_seconds", "gauge",
+               "Time of the last update of this file", time.time())
+
+    def _write(self):
+        lines = []
+        for name, kind, help, value in self._metrics():
+            name = "{}_{}".format(self.prefix, name)
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            lines.append("{} {}".format(name, value))
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp_path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp_path, self.path)
+        except OSError as err:
+            logging.error("cannot write metrics to %s: %s", self.path, err)
+
+class RunJournal(SchedulerListener):
+    """
+    Append-only record of the progress of a run, from which an interrupted
+    run can be resumed.
+
+    The journal at *path* is a file with one JSON object per line: a header
+    with the *transcoders* and *directories* of the run, one ``queued``
+    entry per source file as it is scanned, a ``scanned`` entry once the
+    scan is complete, a ``done`` or ``failed`` entry per output file, and a
+    ``completed`` entry once the run has ended without being interrupted
+    (see :meth:`completed`).
+
+    If the file exists, it is read first; it must have been written for the
+    same transcoders and directories, otherwise :class:`ValueError` is
+    raised. If its run has been completed, it is started over, so that the
+    journal never keeps a later run from building the outputs of changed
+    sources. Otherwise, the partial files which the interrupted run may have
+    left behind for the outputs of the queued sources are removed. Outputs
+    recorded as done are not built again (:meth:`is_done`), and if the scan
+    had been completed, the queued sources can be replayed with
+    :meth:`resume` instead of scanning again; only the sources which are
+    not in the journal need to be looked at then. Failed outputs are
+    retried.
+
+    Entries are flushed as they are written and synced to disk at most
+    every :attr:`sync_interval` seconds. An output is only recorded as done
+    after it has been moved into place, so a crash in between only means
+    that the output is built again.
+    """
+
+    sync_interval = 1
+
+    def __init__(self, path, transcoders, directories):
+        self.path = path
+        self.transcoders = list(transcoders)
+        self.header = {
+            "type": "run",
+            "transcoders": [
+                [transcoder_cls.__name__, output_dir]
+                for transcoder_cls, output_dir in transcoders
+            ],
+            "directories": list(directories),
+        }
+        self.sources = {}
+        self.done = set()
+        self.failed = 0
+        self.scan_complete = False
+        self._lock = threading.Lock()
+        self._next_sync = 0
+
+        resume = os.path.exists(path)
+        if resume:
+            resume = not self._load()
+        if resume:
+            self._remove_partial_files()
+            self._file = open(path, "a")
+        else:
+            self.sources.clear()
+            self.done.clear()
+            self.failed = 0
+            self.scan_complete = False
+            self._file = open(path, "w")
+            self._write(self.header)
+
+    def _load(self):
+        """
+        Read the journal and return whether its run has been completed.
+        """
+        with open(self.path, "r") as f:
+            lines = f.readlines()
+        header = None
+        completed = False
+        for lineno, line in enumerate(lines, 1):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line may have been cut short by a crash
+                if lineno != len(lines):
+                    logging.warning("%s:%d: ignoring malformed entry",
+                                    self.path, lineno)
+                continue
+            kind = entry.get("type")
+            if header is None:
+                if kind != "run":
+                    raise ValueError("{} is not a run journal".format(
+                        self.path))
+                header = entry
+                if header["transcoders"] != self.header["transcoders"] or \
+                        header["directories"] != self.header["directories"]:
+                    raise ValueError(
+                        "{} belongs to a run with other transcoders or "
+                        "directories; remove it to start over".format(
+                            self.path))
+            elif kind == "queued":
+                self.sources[entry["source"]] = None
+            elif kind == "scanned":
+                self.scan_complete = True
+            elif kind == "done":
+                self.done.add(entry["output"])
+            elif kind == "failed":
+                self.failed += 1
+            elif kind == "completed":
+                completed = True
+        if completed:
+            logging.info("journal %s: the run has been completed, starting "
+                         "a new one", self.path)
+        else:
+            logging.info("journal %s: %d sources queued, %d outputs done",
+                         self.path, len(self.sources), len(self.done))
+        return completed
+
+    def _remove_partial_files(self):
+        for source in self.sources:
+            for transcoder_cls, output_dir in self.transcoders:
+                handle_class = transcoder_cls._get_encoder_handle_class()
+                output = EncoderHandle._get_output_file(
+                    source,
+                    output_dir,
+                    handle_class.suffix,
+                    sanitise=handle_class.sanitise_names)
+                if output in self.done:
+                    continue
+                partial_file = EncoderHandle._get_partial_file(output)
+                try:
+                    os.unlink(partial_file)
+                except FileNotFoundError:
+                    continue
+                except OSError as err:
+                    logging.warning("cannot remove %s: %s", partial_file, err)
+                    continue
+                logging.info("removed partial output %s", partial_file)
+
+    def _write(self, entry):
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            now = time.monotonic()
+            if now >= self._next_sync:
+                os.fsync(self._file.fileno())
+                self._next_sync = now + self.sync_interval
+
+    def is_done(self, output):
+        return output in self.done
+
+    def queued(self, source):
+        """
+        Record that tasks have been created for *source*.
+        """
+        if source in self.sources:
+            return
+        self.sources[source] = None
+        self._write({"type": "queued", "source": source})
+
+    def scanned(self):
+        """
+        Record that the scan is complete.
+        """
+        self.scan_complete = True
+        self._write({"type": "scanned"})
+
+    def completed(self):
+        """
+        Record that all tasks of the run have been processed, so that the
+        next run with this journal starts over instead of resuming.
+        """
+        self._write({"type": "completed"})
+
+    def resume(self, task_generator, dir_filters=(), measure_loudness=False):
+        """
+        Create the tasks for the sources queued in the journal, in the order
+        in which they were scanned, directory by directory as
+        :func:`tasks_for_directory` does.
+        """
+        sources = []
+        for source in list(self.sources):
+            if not os.path.isfile(source):
+                logging.warning("source has vanished: %s", source)
+                continue
+            sources.append(source)
+        for dirpath, group in itertools.groupby(sources, os.path.dirname):
+            yield from tasks_for_directory(
+                dirpath,
+                [os.path.basename(source) for source in group],
+                task_generator,
+                dir_filters=dir_filters,
+                measure_loudness=measure_loudness)
+
+    def _record(self, task, results):
+        for encoder, result in zip(getattr(task, "encoders", [task]), results):
+            if result is None:
+                continue
+            output = encoder._get_output_file()
+            if result:
+                self.done.add(output)
+            self._write({
+                "type": "done" if result else "failed",
+                "source": encoder.flac_file,
+                "output": output,
+            })
+
+    @staticmethod
+    def _builds_outputs(task):
+        # directory filters and taggers are run again as needed
+        return isinstance(
+            task,
+            (Encoder, MultiEncoder, DuplicateOutput, TagUpdate))
+
+    def task_skipped(self, task):
+        if not self._builds_outputs(task):
+            return
+        # outputs are only skipped because they exist
+        self._record(task, itertools.repeat(True))
+
+    def task_finished(self, task, handle, returncode, wall_time):
+        if not self._builds_outputs(task):
+            return
+        results = getattr(handle, "results", None)
+        if results is None:
+            results = itertools.repeat(returncode == 0)
+        self._record(task, results)
+
+    def close(self):
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+class Scheduler:
+    # used if no ChildWatcher is available
+    poll_interval = 0.01
+
+    # when tasks are fed from an iterable, pulling more tasks from it starts
+    # once fewer than low_watermark tasks are pending and goes on until
+    # high_watermark tasks are pending
+    low_watermark = 256
+    high_watermark = 1024
+
+    # maximum time spent pulling tasks from the feed in one call to poll(), so
+    # that finished children are reaped in a timely manner
+    feed_time_slice = 0.02
+
+    # number of pending tasks handed to the prefetcher ahead of starting
+    # them; None for as many as there are slots
+    prefetch_depth = None
+
+    def __init__(self, parallel_tasks,
+            child_watcher=None,
+            scan_estimate=None,
+            dispatch_policy=None,
+            throughput=None,
+            prefetcher=None):
+        if dispatch_policy is None:
+            dispatch_policy = LongestFirstDispatch()
+        if throughput is None:
+            throughput = ThroughputModel()
+        self.pending_tasks = dispatch_policy
+        self.running_tasks = []
+        self.max_tasks = parallel_tasks
+        self.child_watcher = child_watcher
+        self.scan_estimate = scan_estimate
+        self.throughput = throughput
+        # if set, called with a task instead of calling the task itself
+        self.launcher = None
+        # Prefetcher preparing the next tasks, and the pending tasks which
+        # have been handed to it
+        self.prefetcher = prefetcher
+        self._prefetched = set()
+        # SchedulerListener instances
+        self.listeners = []
+        self.started_at = time.time()
+        self.tasks_completed = 0
+        self.tasks_scheduled = 0
+        self.total_weight = 0
+        self.done_weight = 0
+        # weight of the scheduled and of the pending tasks by throughput key
+        self._scheduled_work = collections.Counter()
+        self._pending_work = collections.Counter()
+        # the scheduled tasks which have not finished yet, the number of
+        # unfinished dependencies of each blocked task, and the blocked tasks
+        # by the tasks they are waiting for
+        self._unfinished = set()
+        self._blocked = {}
+        self._dependents = {}
+        # the number of unfinished tasks by directory
+        self._unfinished_directories = collections.Counter()
+        self._feeds = collections.deque()
+        self._refilling = False
+
+    def graceful_termination(self):
+        logging.info("sending all tasks a termination signal")
+        for task in self.running_tasks:
+            task.term()
+        self.running_tasks = []
+        self.pending_tasks.clear()
+        self._pending_work.clear()
+        self._unfinished.clear()
+        self._blocked.clear()
+        self._dependents.clear()
+        self._unfinished_directories.clear()
+        self._feeds.clear()
+        self._prefetched.clear()
+        logging.info("all tasks terminated -- work queue cleared")
+
+    @staticmethod
+    def _finished(task, handle, returncode):
+        try:
+            task.finished(handle, returncode)
+        except Exception as err:
+            logger.error("while finishing task %r:", task)
+            logger.exception(err)
+
+    @staticmethod
+    def _notify(listeners, method, *args):
+        for listener in listeners:
+            try:
+                getattr(listener, method)(*args)
+            except Exception as err:
+                logger.error("while notifying %r:", listener)
+                logger.exception(err)
+
+    def _forget(self, task):
+        """
+        Remove the weight of *task* from the work to be done.
+        """
+        self.total_weight -= task.weight
+        self._scheduled_work[task.throughput_key] -= task.weight
+
+    def _resolve(self, task, success):
+        """
+        Mark *task* as finished and queue the tasks which were only waiting
+        for it.
+
+        If *task* has failed and is not :attr:`~Task.optional`, the tasks
+        depending on it are dropped instead, and so on down the line.
+        """
+        if task in self._unfinished:
+            self._unfinished.remove(task)
+            directory = _task_directory(task)
+            self._unfinished_directories[directory] -= 1
+            if not self._unfinished_directories[directory]:
+                del self._unfinished_directories[directory]
+        for dependent in self._dependents.pop(task, ()):
+            if dependent not in self._blocked:
+                # already dropped because another dependency has failed
+                continue
+            if not success and not task.optional:
+                logger.error("not running %r: %r has failed", dependent, task)
+                del self._blocked[dependent]
+                self._pending_work[dependent.throughput_key] -= \
+                    dependent.weight
+                self._forget(dependent)
+                self._notify(self.listeners, "task_dropped", dependent)
+                self._resolve(dependent, False)
+                continue
+            self._blocked[dependent] -= 1
+            if self._blocked[dependent] == 0:
+                del self._blocked[dependent]
+                dependent.ready()
+                self.pending_tasks.append(dependent)
+
+    def _reap(self):
+        changed = False
+        still_running = []
+        now = time.monotonic()
+        for task in self.running_tasks:
+            returncode = task.poll()
+            if returncode is None:
+                still_running.append(task)
+                continue
+            if task.requeue:
+                logging.info("requeueing task %r", task.task)
+                self._forget(task.task)
+                self.schedule(task.task)
+                continue
+            self._finished(task.task, task, returncode)
+            self.tasks_completed += 1
+            if not task.spawned:
+                # skipped tasks did not do any of the work they were
+                # accounted for
+                self._forget(task.task)
+                self._notify(self.listeners, "task_skipped", task.task)
+            else:
+                self.done_weight += task.task.weight
+                if returncode == 0:
+                    self.throughput.learn(
+                        task.task.throughput_key,
+                        task.task.weight,
+                        now - task.started_at)
+                self._notify(
+                    self.listeners, "task_finished",
+                    task.task, task, returncode, now - task.started_at)
+            self._resolve(task.task, returncode == 0)
+            if returncode == 0:
+                changed = True
+            else:
+                logger.error("task %r returned a nonzero status code: %s", task, returncode)
+        self.running_tasks = still_running
+        return changed
+
+    def _fill(self):
+        """
+        Start pending tasks until all slots are in use.
+
+        Return a list of the newly started handles.
+        """
+        started = []
+        while len(self.running_tasks) < self.max_tasks:
+            # tasks pulled from a feed may be blocked by their dependencies
+            while not self.pending_tasks:
+                if not self._pull():
+                    break
+            if not self.pending_tasks:
+                break
             new_task = self.pending_tasks.pop()
+            self._prefetched.discard(new_task)
+            self._pending_work[new_task.throughput_key] -= new_task.weight
+            try:
+                if self.launcher is not None:
+                    handle = self.launcher(new_task)
+                else:
+                    handle = new_task()
+            except Exception as err:
+                logger.error("while trying to start next task:")
+                logger.exception(err)
+                self._forget(new_task)
+                self._notify(self.listeners, "task_dropped", new_task)
+                self._resolve(new_task, False)
+                continue
+            handle.task = new_task
+            handle.started_at = time.monotonic()
+            if self.child_watcher is not None:
+                self.child_watcher.watch(handle)
+                handle.add_wakeup(self.child_watcher.wake)
+            if handle.spawned:
+                self._notify(self.listeners, "task_started", new_task)
+            del new_task
+            self.running_tasks.append(handle)
+            started.append(handle)
+        return started
+
+    def _pull(self):
+        """
+        Move one task from the feeds to the pending tasks. The feeds take
+        turns, so that none of them is starved by a long one.
+
+        Return :data:`False` if all feeds are exhausted.
+        """
+        while self._feeds:
+            try:
+                task = next(self._feeds[0])
+            except StopIteration:
+                self._feeds.popleft()
+                continue
+            self._feeds.rotate(-1)
+            self.schedule(task)
+            return True
+        return False
+
+    def _prefetch(self):
+        """
+        Hand the tasks which are started next to the prefetcher.
+        """
+        for task in self.pending_tasks.peek(
+                self.prefetch_depth or self.max_tasks):
+            if task in self._prefetched:
+                continue
+            self._prefetched.add(task)
+            try:
+                task.prefetch(self.prefetcher)
+            except Exception as err:
+                # the task runs into the same problem once it is started
+                logging.debug("cannot prefetch for %r: %s", task, err)
+
+    def _refill(self):
+        if len(self.pending_tasks) + len(self._blocked) < self.low_watermark:
+            self._refilling = True
+        if not self._refilling:
+            return
+        deadline = time.monotonic() + self.feed_time_slice
+        while len(self.pending_tasks) + len(self._blocked) < \
+                self.high_watermark:
+            if not self._pull():
+                break
+            if time.monotonic() >= deadline:
+                return
+        self._refilling = False
+
+    def poll(self):
+        changed = False
+        while True:
+            with _phase("poll.reap"):
+                changed = self._reap() or changed
+            with _phase("poll.fill"):
+                started = self._fill()
+            if not started:
+                break
+            changed = True
+            # skipped and dry-run tasks finish without ever spawning a child,
+            # so no SIGCHLD will arrive for them; reap them right away
+            if all(handle.spawned for handle in started):
+                break
+
+        if self._feeds:
+            with _phase("poll.refill"):
+                self._refill()
+
+        if self.prefetcher is not None:
+            with _phase("poll.prefetch"):
+                self._prefetch()
+
+        if changed:
+            logger.info("%d tasks pending (%d waiting for others); "
+                        "%d tasks running",
+                        len(self.pending_tasks) + len(self._blocked),
+                        len(self._blocked),
+                        len(self.running_tasks))
+
+        return len(self.running_tasks) > 0 or len(self.pending_tasks) > 0 or \
+            len(self._blocked) > 0 or len(self._feeds) > 0
+
+    def wait(self, timeout=None):
+        """
+        Block until a child process exits or *timeout* seconds have passed.
+
+        Call :meth:`poll` afterwards to reap finished tasks and refill the free
+        slots.
+
+        While tasks are being pulled from a feed, this does not block at all,
+        so that the next call to :meth:`poll` can continue pulling.
+        """
+        if self.refilling:
+            timeout = 0
+        if self.child_watcher is None:
+            if timeout is None or timeout > self.poll_interval:
+                timeout = self.poll_interval
+            time.sleep(timeout)
+            return
+        self.child_watcher.wait(timeout)
+
+    def schedule(self, task):
+        """
+        Add *task* to the work to be done.
+
+        The task is started once all its :attr:`~Task.dependencies` have
+        finished. Dependencies have to be scheduled before the tasks which
+        depend on them; those the scheduler does not know about are taken as
+        finished.
+        """
+        logging.debug("enqueued task %r", task)
+        self.tasks_scheduled += 1
+        key = task.throughput_key
+        self.total_weight += task.weight
+        self._scheduled_work[key] += task.weight
+        self._pending_work[key] += task.weight
+        logging.debug("new weight %.1f", self.total_weight)
+        self._unfinished.add(task)
+        self._unfinished_directories[_task_directory(task)] += 1
+        waiting_for = 0
+        for dependency in task.dependencies:
+            if dependency in self._unfinished:
+                self._dependents.setdefault(dependency, []).append(task)
+                waiting_for += 1
+        if waiting_for:
+            self._blocked[task] = waiting_for
+        else:
+            self.pending_tasks.append(task)
+
+    def schedule_tasks(self, iterable):
+        for task in iterable:
+            self.schedule(task)
+
+    @property
+    def refilling(self):
+        """
+        Whether tasks are being pulled from a feed, in which case the caller
+        of :meth:`poll` should not block before calling it again.
+        """
+        return self._refilling and bool(self._feeds)
+
+    def cancel(self, predicate):
+        """
+        Drop the pending and blocked tasks for which *predicate* returns true
+        and terminate the running ones. Tasks which have not been pulled from
+        a feed yet are not affected.
+
+        Return the number of dropped tasks.
+        """
+        dropped = []
+        for task in list(self._blocked):
+            if predicate(task):
+                del self._blocked[task]
+                dropped.append(task)
+        pending = list(self.pending_tasks)
+        self.pending_tasks.clear()
+        for task in pending:
+            if predicate(task):
+                self._prefetched.discard(task)
+                dropped.append(task)
+            else:
+                self.pending_tasks.append(task)
+        for task in dropped:
+            self._pending_work[task.throughput_key] -= task.weight
+            self._forget(task)
+            self._notify(self.listeners, "task_dropped", task)
+            self._resolve(task, False)
+        for handle in self.running_tasks:
+            if predicate(handle.task):
+                handle.term()
+        return len(dropped)
+
+    def is_busy(self, directory):
+        """
+        Return whether tasks for *directory* have been scheduled and have not
+        finished yet. Tasks which have not been pulled from a feed yet are not
+        taken into account.
+        """
+        return directory in self._unfinished_directories
+
+    def has_pending(self):
+        """
+        Return whether there are tasks which have not been started yet,
+        including those which have not been pulled from a feed yet.
+        """
+        return len(self.pending_tasks) > 0 or len(self._feeds) > 0
+
+    def feed(self, iterable):
+        """
+        Pull tasks from *iterable* as slots become free, keeping at most
+        :attr:`high_watermark` tasks pending at any time.
+
+        In contrast to :meth:`schedule_tasks`, this does not consume the
+        iterable up front, so a directory scan can be passed without walking
+        the whole tree before encoding starts.
+        """
+        self._feeds.append(iter(iterable))
+
+    def guesstimate(self):
+        done = self.tasks_completed
+        pending = len(self.pending_tasks) + len(self._blocked)
+        running = len(self.running_tasks)
+        pending_work = list(self._pending_work.items())
+
+        fraction = None
+        if self._feeds and self.scan_estimate is not None:
+            fraction = self.scan_estimate.fraction()
+        if fraction:
+            # extrapolate from what has been scanned so far
+            unscanned = 1 / fraction - 1
+            pending += round(self.tasks_scheduled * unscanned)
+            pending_work.extend(
+                (key, duration * unscanned)
+                for key, duration in self._scheduled_work.items())
+
+        now = time.monotonic()
+        eta = self.throughput.estimate(
+            pending_work,
+            (
+                (handle.task.throughput_key,
+                 handle.task.weight,
+                 now - handle.started_at)
+                for handle in self.running_tasks
+            ),
+            min(self.max_tasks, pending + running))
+        return done, pending, running, eta
+
+class DummyTaskHandle(TaskHandle):
+    """
+    Handle for a task which had nothing to do.
+    """
+    spawned = False
+    weight = 0
+
+    def poll(self):
+        return 0
+
+    def wait(self):
+        return 0
+
+    def term(self):
+        pass
+
+    kill = term
+
+# runs the tasks which are done in this process (see ThreadTaskHandle)
+_task_executor = None
+
+def _get_task_executor():
+    global _task_executor
+    if _task_executor is None:
+        _task_executor = concurrent.futures.ThreadPoolExecutor(
+            thread_name_prefix="task")
+    return _task_executor
+
+class ThreadTaskHandle(TaskHandle):
+    """
+    Handle for a task which is done by calling *function* with *args* in a
+    thread of this process rather than in a child process, as spawning one
+    would take longer than the work itself (such as rewriting the tags of
+    a file).
+
+    The task succeeds if *function* returns. Exceptions are logged as the
+    failure of the task described by *description*.
+    """
+    weight = 0
+
+    def __init__(self, description, function, *args, dry_run=False):
+        self.description = description
+        self._returncode = None
+        if dry_run:
+            logging.debug("would run %s in-process", description)
+            self.spawned = False
+            self._future = concurrent.futures.Future()
+            self._future.set_result(None)
+        else:
+            self._future = _get_task_executor().submit(function, *args)
+
+    def poll(self):
+        if self._returncode is None and self._future.done():
             try:
-                handle = new_task()
+                self._future.result()
+            except concurrent.futures.CancelledError:
+                self._returncode = -signal.SIGTERM
             except Exception as err:
-                logger.error("while trying to start next task:")
-                logger.exception(err)
+                logger.error("%s failed: %s", self.description, err)
+                self._returncode = 1
+            else:
+                self._returncode = 0
+        return self._returncode
+
+    def wait(self):
+        concurrent.futures.wait([self._future])
+        return self.poll()
+
+    def term(self):
+        # a running function cannot be interrupted, but it only replaces
+        # its outputs once done
+        self._future.cancel()
+
+    kill = term
+
+    def add_wakeup(self, callback):
+        self._future.add_done_callback(lambda future: callback())
+
+def _cgroup_cpu_quota():
+    """
+    Return the CPU bandwidth limit of the cgroup of this process, in CPUs, or
+    :data:`None` if there is none.
+    """
+    try:
+        with open("/proc/self/cgroup") as f:
+            cgroups = [line.rstrip("\n").split(":", 2) for line in f]
+    except OSError:
+        return None
+
+    for hierarchy_id, controllers, path in cgroups:
+        if hierarchy_id == "0" and not controllers:
+            # cgroup v2
+            try:
+                with open(os.path.join("/sys/fs/cgroup", path.lstrip("/"),
+                                       "cpu.max")) as f:
+                    quota, period = f.read().split()
+            except (OSError, ValueError):
                 continue
-            self.total_weight -= new_task.weight
-            del new_task
-            self.total_weight += handle.weight
-            self.running_tasks.append(handle)
-            changed = True
+            if quota == "max":
+                return None
+            return int(quota) / int(period)
 
-        if changed:
-            logger.info("%d tasks pending; %d tasks running", len(self.pending_tasks), len(self.running_tasks))
+        if "cpu" in controllers.split(","):
+            # cgroup v1
+            for mount in ("cpu", "cpu,cpuacct", "cpuacct,cpu"):
+                base = os.path.join("/sys/fs/cgroup", mount, path.lstrip("/"))
+                try:
+                    with open(os.path.join(base, "cpu.cfs_quota_us")) as f:
+                        quota = int(f.read())
+                    with open(os.path.join(base, "cpu.cfs_period_us")) as f:
+                        period = int(f.read())
+                except (OSError, ValueError):
+                    continue
+                if quota <= 0:
+                    return None
+                return quota / period
+    return None
 
-        return len(self.running_tasks) > 0 or len(self.pending_tasks) > 0
+def usable_cpus():
+    """
+    Return the number of CPUs this process may use, respecting the CPU
+    affinity mask and the cgroup CPU quota.
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        count = min(count, max(math.ceil(quota), 1))
+    return count
 
-    def schedule(self, task):
-        logging.debug("enqueued task %r", task)
-        self.pending_tasks.append(task)
-        self.total_weight += task.weight
-        logging.debug("new weight %d", self.total_weight)
+def read_pressure(resource):
+    """
+    Return the ``some avg10`` value (in percent) from
+    ``/proc/pressure/<resource>``, or :data:`None` if PSI is not available.
+    """
+    try:
+        with open(os.path.join("/proc/pressure", resource)) as f:
+            for line in f:
+                kind, *fields = line.split()
+                if kind != "some":
+                    continue
+                for field in fields:
+                    key, _, value = field.partition("=")
+                    if key == "avg10":
+                        return float(value)
+    except (OSError, ValueError):
+        pass
+    return None
 
-    def schedule_tasks(self, iterable):
-        for task in iterable:
-            self.schedule(task)
+class ConcurrencyController:
+    """
+    Adjust :attr:`Scheduler.max_tasks` at runtime.
 
-    def guesstimate(self):
-        curr_time = time.time()
-        delta = curr_time - self.started_at
-        done = self.tasks_completed
-        pending = len(self.pending_tasks)
-        running = len(self.running_tasks)
-        if self.tasks_completed < 10 or self.done_weight == 0:
-            eta = None
+    Every :attr:`interval` seconds, the CPU and I/O pressure stall information
+    of the kernel is sampled (falling back to the load average if PSI is not
+    available). The number of slots is reduced by one if the CPU is
+    contended or the source storage cannot keep up, and increased by one if
+    all slots are busy while neither is the case. Running tasks are never
+    killed; reducing the number of slots only delays the start of new
+    tasks.
+    """
+
+    interval = 5.0
+
+    # thresholds for the share of time (percent) in which tasks stall on the
+    # respective resource
+    cpu_high = 20.0
+    cpu_low = 5.0
+    io_high = 30.0
+    io_low = 10.0
+
+    # thresholds for the one minute load average per usable CPU, if PSI is
+    # not available
+    load_high = 1.25
+    load_low = 0.75
+
+    def __init__(self, scheduler, minimum=1, maximum=None):
+        self.scheduler = scheduler
+        self.cpus = usable_cpus()
+        self.minimum = minimum
+        self.maximum = maximum if maximum is not None else 2 * self.cpus
+        self._next_update = time.monotonic() + self.interval
+
+    def _decide(self):
+        """
+        Return -1 to remove a slot, 1 to add a slot or 0 to keep things as
+        they are.
+        """
+        cpu = read_pressure("cpu")
+        io = read_pressure("io")
+        if cpu is not None:
+            if cpu > self.cpu_high or (io is not None and io > self.io_high):
+                return -1
+            if cpu < self.cpu_low and (io is None or io < self.io_low):
+                return 1
+            return 0
+
+        try:
+            load = os.getloadavg()[0] / self.cpus
+        except OSError:
+            return 0
+        if load > self.load_high:
+            return -1
+        if load < self.load_low:
+            return 1
+        return 0
+
+    def update(self):
+        """
+        Adjust the number of slots if :attr:`interval` has passed.
+
+        Return the number of seconds until the next adjustment is due.
+        """
+        now = time.monotonic()
+        if now < self._next_update:
+            return self._next_update - now
+        self._next_update = now + self.interval
+
+        scheduler = self.scheduler
+        direction = self._decide()
+        if direction > 0 and \
+                len(scheduler.running_tasks) < scheduler.max_tasks:
+            # not all slots are in use, adding more would not help
+            direction = 0
+        new_max = min(max(scheduler.max_tasks + direction, self.minimum),
+                      self.maximum)
+        if new_max != scheduler.max_tasks:
+            logger.info("adjusting parallel tasks from %d to %d",
+                        scheduler.max_tasks, new_max)
+            scheduler.max_tasks = new_max
+        return self.interval
+
+class AsyncScheduler:
+    """
+    asyncio-based alternative to :class:`Scheduler`.
+
+    Directory scanning, metadata reads, progress reporting and the
+    ``flac -dc | encoder`` pipelines all run as cooperating tasks in one event
+    loop. Blocking calls (:func:`os.walk`, :meth:`Encoder._get_metadata`,
+    creating output directories) are pushed into the default executor, so
+    they never hold up the pipelines which are already running. At most
+    *parallel_tasks* pipelines run at the same time.
+
+    Only :class:`Encoder` tasks are supported.
+    """
+
+    # bound on scanned but not yet started tasks, so that a huge library does
+    # not have to be walked completely before encoding starts
+    queue_size = 1024
+
+    def __init__(self, parallel_tasks, throughput=None):
+        if throughput is None:
+            throughput = ThroughputModel()
+        self.max_tasks = parallel_tasks
+        self.throughput = throughput
+        # SchedulerListener instances; the child processes are reaped by
+        # asyncio, so their resource usage is not available to them
+        self.listeners = []
+        self.started_at = time.time()
+        self.tasks_completed = 0
+        self.total_weight = 0
+        self.done_weight = 0
+        self.pending = 0
+        self.running = 0
+        self._pending_work = collections.Counter()
+        # start times of the tasks whose pipelines are running
+        self._started = {}
+        self._queue = None
+        self._slots = None
+        self._workers = set()
+
+    @staticmethod
+    def _scan_step(walker, task_generator):
+        for dirpath, dirnames, filenames in walker:
+            # the weight is read from the file header; do that here instead
+            # of in the event loop
+            return [
+                (task, task.weight)
+                for task in tasks_for_directory(
+                    dirpath, filenames, task_generator)
+            ]
+        return None
+
+    async def _scan(self, directory, task_generator):
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, os.path.isdir, directory):
+            logging.error("Not a directory: %s", directory)
+            return
+        walker = os.walk(directory)
+        while True:
+            tasks = await loop.run_in_executor(
+                None,
+                self._scan_step, walker, task_generator)
+            if tasks is None:
+                return
+            for task, weight in tasks:
+                logging.debug("enqueued task %r", task)
+                self.pending += 1
+                self.total_weight += weight
+                self._pending_work[task.throughput_key] += weight
+                await self._queue.put(task)
+
+    async def _dispatch(self):
+        while True:
+            task = await self._queue.get()
+            if task is None:
+                return
+            await self._slots.acquire()
+            self.pending -= 1
+            self._pending_work[task.throughput_key] -= task.weight
+            self.running += 1
+            worker = asyncio.ensure_future(self._execute(task))
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+
+    async def _execute(self, task):
+        try:
+            returncode = await self._run_encoder(task)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.error("while trying to start next task:")
+            logger.exception(err)
+            self.total_weight -= task.weight
+            self._started.pop(task, None)
+            return
+        finally:
+            self.running -= 1
+            self._slots.release()
+
+        Scheduler._finished(task, None, returncode)
+        self.tasks_completed += 1
+        started_at = self._started.pop(task, None)
+        if started_at is None:
+            # skipped or dry run
+            self.total_weight -= task.weight
+            Scheduler._notify(self.listeners, "task_skipped", task)
         else:
-            rate = self.done_weight / delta
-            eta = (self.total_weight - self.done_weight) / rate
-        return done, pending, running, eta
+            self.done_weight += task.weight
+            elapsed = time.monotonic() - started_at
+            if returncode == 0:
+                self.throughput.learn(
+                    task.throughput_key, task.weight, elapsed)
+            Scheduler._notify(
+                self.listeners, "task_finished",
+                task, None, returncode, elapsed)
+        if returncode != 0:
+            logger.error("task %r returned a nonzero status code: %s", task, returncode)
+
+    async def _run_encoder(self, task):
+        loop = asyncio.get_running_loop()
+        handle_cls = task._get_encoder_handle_class()
+        dry_run = task._kwargs.get("dry_run", False)
+        skip_existing = task._kwargs.get("skip_existing", False)
+
+        out_file = await loop.run_in_executor(
+            None,
+            functools.partial(
+                EncoderHandle._ensure_output_file,
+                sanitise=handle_cls.sanitise_names),
+            task.flac_file, task.output_directory, handle_cls.suffix)
+        if skip_existing and \
+                await loop.run_in_executor(None, os.path.isfile, out_file):
+            logging.info("skipping existing file: %s", out_file)
+            return 0
+
+        comments = await loop.run_in_executor(None, task._get_metadata)
+        partial_file = EncoderHandle._get_partial_file(out_file)
+        command = list(map(
+            PipeEncoderHandle.replace_token(
+                PipeEncoderHandle.OutFileToken,
+                partial_file),
+            task._get_command(comments)))
+        decoder_command = ["flac", "-dc", task.flac_file]
+
+        logging.debug("$ %s", decoder_command)
+        logging.debug("$ %s", command)
+        if dry_run:
+            return 0
+
+        self._started[task] = time.monotonic()
+        read_fd, write_fd = os.pipe()
+        try:
+            decoder = await asyncio.create_subprocess_exec(
+                *decoder_command,
+                stdin=None,
+                stdout=write_fd,
+                stderr=subprocess.DEVNULL)
+            try:
+                encoder = await asyncio.create_subprocess_exec(
+                    *command,
+                    stdin=read_fd,
+                    stdout=subprocess.DEVNULL)
+            except:
+                decoder.kill()
+                raise
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+        Scheduler._notify(self.listeners, "task_started", task)
+
+        try:
+            encoder_returncode, decoder_returncode = await asyncio.gather(
+                encoder.wait(),
+                decoder.wait())
+        except asyncio.CancelledError:
+            logging.info("terminating transcoder for %s", out_file)
+            try:
+                for process in (decoder, encoder):
+                    if process.returncode is None:
+                        try:
+                            process.terminate()
+                        except ProcessLookupError:
+                            pass
+            finally:
+                EncoderHandle._commit_output(partial_file, out_file, False)
+            raise
+
+        returncode = encoder_returncode or decoder_returncode
+        await loop.run_in_executor(
+            None,
+            EncoderHandle._commit_output,
+            partial_file, out_file, returncode == 0)
+        return returncode
+
+    async def _report(self, callback, interval):
+        while True:
+            callback()
+            await asyncio.sleep(interval)
+
+    async def run(self, directories, task_generator,
+            progress=None,
+            progress_interval=0.2):
+        """
+        Scan *directories* and run all tasks created for them by
+        *task_generator*.
+
+        If *progress* is given, it is called every *progress_interval* seconds
+        while the scheduler is running.
+        """
+        self._queue = asyncio.Queue(self.queue_size)
+        self._slots = asyncio.Semaphore(self.max_tasks)
+        helpers = [asyncio.ensure_future(self._dispatch())]
+        if progress is not None:
+            helpers.append(asyncio.ensure_future(
+                self._report(progress, progress_interval)))
+
+        try:
+            for directory in directories:
+                await self._scan(directory, task_generator)
+            await self._queue.put(None)
+            await helpers[0]
+            while self._workers:
+                await asyncio.wait(list(self._workers))
+        finally:
+            pending = helpers + list(self._workers)
+            for future in pending:
+                future.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def guesstimate(self):
+        now = time.monotonic()
+        eta = self.throughput.estimate(
+            self._pending_work.items(),
+            (
+                (task.throughput_key, task.weight, now - started_at)
+                for task, started_at in list(self._started.items())
+            ),
+            min(self.max_tasks, self.pending + self.running))
+        return self.tasks_completed, self.pending, self.running, eta
 
-def task_generator(transcoders, **kwargs):
-    def generator(filepath):
-        for transcoder_cls, output_dir in transcoders:
-            yield transcoder_cls(filepath, output_dir, **kwargs)
+def task_generator(transcoders, shared_decoder=False, indices=None,
+        journal=None,
+        measure_loudness=False,
+        dedupe=None,
+        tag_updates=False,
+        **kwargs):
+    """
+    Return a function creating the tasks for a FLAC file.
+
+    If *shared_decoder* is true and more than one transcoder is given, a
+    single :class:`MultiEncoder` task is created per file instead of one task
+    per transcoder.
+
+    *indices* may map output directories to :class:`BuildIndex` instances. No
+    tasks are created for outputs which are up to date according to them.
+
+    If a :class:`RunJournal` is given as *journal*, the files are recorded
+    in it, and no tasks are created for outputs which it records as done.
+
+    If *measure_loudness* is true, a :class:`MultiEncoder` measuring the
+    loudness is created for every file, even with a single transcoder.
+
+    If a :class:`Deduplicator` is given as *dedupe*, outputs whose audio has
+    been encoded for another file are copied from there.
+
+    If *tag_updates* is true, :class:`TagUpdate` tasks are created for
+    outputs whose source has only changed in its tags according to
+    *indices* (see :meth:`Encoder.tag_update`). This is not done together
+    with *measure_loudness*, which needs all outputs to be encoded.
+
+    The returned function takes the path of the file and *rebuild*, which is
+    true if the file is going to be changed by a :class:`DirectoryFilter`
+    before it is encoded, or if its album is measured, so that its outputs
+    have to be built in any case. If *loudness_only* is true as well, the
+    file itself is unchanged but its album is measured: if its outputs are
+    up to date and its loudness is recorded in *indices*, a
+    :class:`CachedLoudness` is returned instead of encoding it again.
+    """
+    if indices is None:
+        indices = {}
+    # one encoder per transcoder, never queued itself, whose settings and
+    # options are shared by the tasks (see Encoder.for_file)
+    prototypes = []
+
+    def generator(filepath, rebuild=False, loudness_only=False):
+        if not prototypes:
+            prototypes.extend(
+                transcoder_cls(
+                    filepath, output_dir,
+                    index=indices.get(output_dir),
+                    **kwargs)
+                for transcoder_cls, output_dir in transcoders)
+        if loudness_only:
+            cached = CachedLoudness.lookup([
+                prototype.for_file(filepath)
+                for prototype in prototypes
+            ])
+            if cached is not None:
+                logging.debug("loudness recorded: %s", filepath)
+                yield cached
+                return
+        tasks = []
+        retags = []
+        for prototype in prototypes:
+            task = prototype.for_file(filepath)
+            if journal is not None and \
+                    journal.is_done(task._get_output_file()):
+                logging.debug("done according to journal: %r", task)
+                continue
+            if rebuild:
+                task._set_option("skip_existing", False)
+            elif task.is_up_to_date():
+                logging.debug("up to date: %r", task)
+                continue
+            elif tag_updates and not measure_loudness:
+                retag = task.tag_update()
+                if retag is not None:
+                    retags.append(retag)
+                    continue
+            tasks.append(task)
+        if journal is not None and (tasks or retags):
+            journal.queued(filepath)
+        yield from retags
+        duplicates = []
+        if dedupe is not None and tasks:
+            tasks, duplicates = dedupe.split(tasks)
+        if measure_loudness and tasks:
+            containers = [MultiEncoder(tasks, analyze=True)]
+        elif shared_decoder and len(tasks) > 1:
+            containers = [MultiEncoder(tasks)]
+        else:
+            containers = tasks
+        for container in containers:
+            if dedupe is not None:
+                dedupe.add(container)
+            yield container
+        for encoder, original in duplicates:
+            yield dedupe.duplicate(encoder, original)
     return generator
 
-def scan_dir(directory, heartbeat, task_generator):
+def is_flac(filename):
+    return os.path.splitext(filename)[1] == ".flac"
+
+def scan_dir(directory, heartbeat, task_generator, scan_estimate=None,
+        dir_filters=(),
+        measure_loudness=False,
+        skip=None):
+    """
+    Walk *directory* and yield the tasks for its FLAC files, directory by
+    directory (see :func:`tasks_for_directory`).
+
+    The files whose paths are in *skip* are left out. If *measure_loudness*
+    is true, so are the other files of their directories, whose album gain
+    could not be computed without them.
+    """
     if not os.path.isdir(directory):
         logging.error("Not a directory: %s", directory)
         heartbeat()
         return
-    for dirpath, dirnames, filenames in os.walk(directory):
-        for filename in filenames:
-            if os.path.splitext(filename)[1] != ".flac":
-                logging.debug("skipping non-flac file: %s", filename)
+    walker = os.walk(directory)
+    while True:
+        # only the walk itself is timed here; the time spent in the loop
+        # body includes the consumer of the generator
+        with _phase("scan"):
+            entry = next(walker, None)
+        if entry is None:
+            break
+        dirpath, dirnames, filenames = entry
+        if skip:
+            kept = [
+                filename for filename in filenames
+                if os.path.join(dirpath, filename) not in skip
+            ]
+            if measure_loudness and len(kept) < len(filenames) and \
+                    any(map(is_flac, kept)):
+                logging.warning("not adding the new files in %s, as the "
+                                "album gain of the others is not measured "
+                                "again", dirpath)
+                kept = []
+            filenames = kept
+        yield from tasks_for_directory(
+            dirpath, filenames, task_generator,
+            dir_filters=dir_filters,
+            measure_loudness=measure_loudness)
+        if scan_estimate is not None:
+            scan_estimate.scanned(sum(map(is_flac, filenames)))
+        heartbeat()
+
+def tasks_for_directory(dirpath, filenames, task_generator, dir_filters=(),
+        measure_loudness=False):
+    """
+    Yield the tasks for the FLAC files among *filenames* in *dirpath*.
+
+    *dir_filters* may be a sequence of callables taking the directory and the
+    list of its FLAC files and returning a :class:`DirectoryFilter`. The
+    filters which are not up to date are yielded first, each depending on
+    the ones before it, and the encoding tasks depend on all of them.
+
+    If *measure_loudness* is true, *task_generator* must create
+    :class:`MultiEncoder` tasks measuring the loudness. The files are taken
+    as album: if any of them needs to be encoded, all of them are, unless
+    their loudness is recorded (see :class:`CachedLoudness`), and a
+    :class:`LoudnessTagger` depending on all of them is yielded for each
+    output.
+    """
+    flac_files = []
+    for filename in filenames:
+        if not is_flac(filename):
+            logging.debug("skipping non-flac file: %s", filename)
+            continue
+        flac_files.append(os.path.join(dirpath, filename))
+
+    filters = []
+    if flac_files:
+        for dir_filter in dir_filters:
+            task = dir_filter(dirpath, flac_files)
+            if task.is_up_to_date():
+                logging.debug("up to date: %r", task)
                 continue
+            for dependency in filters:
+                task.depends_on(dependency)
+            filters.append(task)
+            yield task
 
-            logging.debug("adding tasks for: %s", filename)
-            filepath = os.path.join(dirpath, filename)
-            for task in task_generator(filepath):
-                yield task
-        heartbeat()
+    def generate(filepath, rebuild, loudness_only=False):
+        logging.debug("adding tasks for: %s", filepath)
+        for task in task_generator(
+                filepath, rebuild=rebuild, loudness_only=loudness_only):
+            for dependency in filters:
+                task.depends_on(dependency)
+            yield task
+
+    if not measure_loudness:
+        for filepath in flac_files:
+            yield from generate(filepath, bool(filters))
+        return
+
+    tasks = [
+        list(generate(filepath, bool(filters)))
+        for filepath in flac_files
+    ]
+    if not any(tasks):
+        return
+    # the album gain needs all tracks
+    tasks = [
+        file_tasks or list(generate(filepath, True, loudness_only=True))
+        for filepath, file_tasks in zip(flac_files, tasks)
+    ]
+    album = AlbumLoudness(dirpath, len(flac_files))
+    for file_tasks in tasks:
+        for task in file_tasks:
+            album.add(task)
+            yield task
+    # all taggers of the album share one tuple of dependencies
+    dependencies = tuple(album.tracks)
+    for track in album.tracks:
+        for encoder in track.encoders:
+            tagger = LoudnessTagger(album, track, encoder)
+            tagger.dependencies = dependencies
+            yield tagger
 
 def format_time(dt):
     if dt > 120:
@@ -515,6 +4738,11 @@ def format_time(dt):
 if __name__ == "__main__":
     import argparse
     import sys
+    # the modules building on this one import it as transcoder, which must
+    # not load this script a second time
+    sys.modules.setdefault("transcoder", sys.modules[__name__])
+    import distributed
+    import jobservice
 
     def positive_integer(x):
         x = int(x)
@@ -522,6 +4750,21 @@ if __name__ == "__main__":
             raise ValueError("Must be a positive integer number.")
         return x
 
+    def parallel_count(x):
+        if x == "auto":
+            return x
+        return positive_integer(x)
+
+    def output_target(x):
+        if x == "-":
+            return sys.stdout.fileno()
+        if x.startswith("fd:"):
+            fd = int(x[3:])
+            if fd < 0:
+                raise ValueError("Must be a file descriptor number.")
+            return fd
+        return x
+
     class ValidateTranscoders(argparse.Action):
         def __call__(self, parser, namespace, values, option_string=None):
             transcoder, output_dir = values
@@ -546,11 +4789,53 @@ if __name__ == "__main__":
         help="Encoder to apply to the flac files. Can be specified multiple times to apply multiple encoders. At least one transcoder must be given.",
         dest="transcoders"
     )
+    parser.add_argument(
+        "-f", "--filter",
+        choices=sorted(dir_filters),
+        action="append",
+        default=[],
+        help="Process the flac files of each directory with this filter "
+             "before encoding them; the encoding of a directory starts as "
+             "soon as its filters have finished. Can be specified multiple "
+             "times; the filters are applied in order. replay-gain adds "
+             "album and track ReplayGain tags using metaflac.",
+        dest="filters"
+    )
+    parser.add_argument(
+        "-g", "--gain-tags",
+        default=False,
+        action="store_true",
+        help="Measure the loudness (EBU R 128) of the decoded audio while "
+             "encoding and write track and album gain tags to the outputs: "
+             "R128_TRACK_GAIN and R128_ALBUM_GAIN for Opus, REPLAYGAIN_* "
+             "(ReplayGain 2.0) for Vorbis. Each directory is taken as an "
+             "album. Needs NumPy.",
+    )
+    parser.add_argument(
+        "--dedupe",
+        default=False,
+        action="store_true",
+        help="Encode audio which occurs in several files (by the MD5 sum in "
+             "the STREAMINFO block) only once per encoder and copy the "
+             "output for the other files, rewriting the tags if needed. "
+             "Outputs whose tags differ are only copied for Opus and "
+             "Vorbis. With --incremental, outputs from earlier runs are "
+             "reused as well.",
+    )
+    parser.add_argument(
+        "--copy-method",
+        choices=["reflink", "hardlink", "copy"],
+        default="reflink",
+        help="How --dedupe copies outputs; reflink and hardlink fall back to "
+             "copy (default reflink)",
+    )
     parser.add_argument(
         "-j", "--parallel",
         metavar="COUNT",
-        type=positive_integer,
-        help="Maximum number of tasks to run in parallel (default 1)",
+        type=parallel_count,
+        help="Maximum number of tasks to run in parallel, or 'auto' to start "
+             "with the number of usable CPUs and adapt to CPU and I/O "
+             "pressure at runtime (default 1)",
         default=1,
         dest="parallel_tasks"
     )
@@ -574,6 +4859,25 @@ if __name__ == "__main__":
         action="store_true",
         help="If set, existing destination files will cause a skip",
     )
+    parser.add_argument(
+        "-i", "--incremental",
+        default=False,
+        action="store_true",
+        help="Keep an index of built files in each output directory ({}) "
+             "and only encode sources which are new or have changed since "
+             "the last run. With -s, existing outputs which are not in the "
+             "index yet are taken as up to date.".format(BuildIndex.filename),
+    )
+    parser.add_argument(
+        "--no-tag-update",
+        default=True,
+        action="store_false",
+        dest="tag_update",
+        help="With --incremental, encode sources whose tags have changed "
+             "again. By default, if the audio of a source is unchanged "
+             "(by the MD5 sum in the STREAMINFO block), only the tags of "
+             "its Opus and Vorbis outputs are rewritten.",
+    )
     parser.add_argument(
         "-p", "--progress",
         default=0,
@@ -581,19 +4885,357 @@ if __name__ == "__main__":
         const=1,
         help="Show progress on terminal"
     )
+    parser.add_argument(
+        "--progress-format",
+        choices=["bar", "jsonl"],
+        default="bar",
+        help="Show progress as a line on the terminal which is updated in "
+             "place (bar, needs -p), or write one JSON object per line for "
+             "each started, skipped, finished and failed task and for each "
+             "progress update (jsonl, implies -p) (default bar)",
+    )
+    parser.add_argument(
+        "--progress-output",
+        metavar="TARGET",
+        type=output_target,
+        default="-",
+        help="Where to write the jsonl progress stream: a file name, fd:N "
+             "for an inherited file descriptor, or - for stdout (default -)",
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        metavar="FILE",
+        default=None,
+        help="Keep FILE updated with throughput, queue depth, running tasks "
+             "and ETA in the Prometheus text format, for the textfile "
+             "collector of the node_exporter",
+    )
+    parser.add_argument(
+        "--progress-interval",
+        metavar="SECONDS",
+        type=float,
+        default=None,
+        help="Interval between progress updates (default 0.2 for the bar, "
+             "1 for the jsonl stream and the textfile)",
+    )
+    parser.add_argument(
+        "--journal",
+        metavar="FILE",
+        default=None,
+        help="Record queued, finished and failed tasks in FILE. If FILE "
+             "exists and the run recorded in it has been interrupted, resume "
+             "it: finished outputs are not built again and, if the scan had "
+             "been completed, only the sources which are not in FILE are "
+             "looked at when the directories are walked again (with "
+             "--engine scheduler)",
+    )
+    parser.add_argument(
+        "--watch",
+        default=False,
+        action="store_true",
+        help="After the initial scan, keep running and watch the "
+             "directories with inotify for FLAC files which are written or "
+             "moved into them; the files are processed once their directory "
+             "has been quiet for --watch-delay seconds. Needs --incremental "
+             "or --skip-existing.",
+    )
+    parser.add_argument(
+        "--watch-delay",
+        metavar="SECONDS",
+        type=float,
+        default=2.0,
+        help="Time without changes after which a watched directory is "
+             "processed (default 2)",
+    )
+    parser.add_argument(
+        "--throughput-file",
+        metavar="FILE",
+        default=None,
+        help="Load the encoder throughput used for the ETA from FILE and "
+             "save what has been learnt during the run back to it, so that "
+             "the ETA is available right from the start of the next run",
+    )
+    parser.add_argument(
+        "--report",
+        metavar="FILE",
+        default=None,
+        help="Write the wall-clock time, CPU time and peak memory of the "
+             "decoder and encoder of each task, and totals per program and "
+             "per encoder setting, to FILE at the end of the run; CSV if "
+             "FILE ends in .csv, JSON otherwise",
+    )
+    parser.add_argument(
+        "--profile",
+        default=False,
+        action="store_true",
+        help="Time the phases of the run (directory scan, metadata reads, "
+             "directory creation, process startup, waiting for children, "
+             "and the steps of the scheduler loop) and print their "
+             "percentiles to stderr at exit",
+    )
+    parser.add_argument(
+        "--profile-dump",
+        metavar="FILE",
+        default=None,
+        help="Run the coordinating process under cProfile and dump the "
+             "statistics to FILE (readable with the pstats module)",
+    )
+    parser.add_argument(
+        "--no-shared-decoder",
+        dest="shared_decoder",
+        action="store_false",
+        default=True,
+        help="Run a separate flac decoder for each encoder instead of "
+             "decoding each file once and feeding all encoders from it",
+    )
+    parser.add_argument(
+        "--dispatch",
+        choices=sorted(dispatch_policies),
+        default="longest-first",
+        help="Order in which pending tasks are started (default "
+             "longest-first)",
+    )
+    parser.add_argument(
+        "--lookahead",
+        metavar="COUNT",
+        type=positive_integer,
+        default=Scheduler.high_watermark,
+        help="Number of scanned tasks to keep pending, among which the "
+             "dispatch order is chosen (default {})".format(
+                 Scheduler.high_watermark),
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["scheduler", "asyncio"],
+        default="scheduler",
+        help="Task execution engine to use (default scheduler)",
+    )
+    parser.add_argument(
+        "--listen",
+        metavar="ADDRESS",
+        default=None,
+        help="Run as coordinator: do not encode locally, but hand the tasks "
+             "to workers connecting to ADDRESS (HOST:PORT or unix:PATH)",
+    )
+    parser.add_argument(
+        "--worker",
+        metavar="ADDRESS",
+        default=None,
+        help="Run as worker for the coordinator at ADDRESS, with -j slots. "
+             "No transcoders or directories are needed in this mode.",
+    )
+    parser.add_argument(
+        "--shared-storage",
+        default=False,
+        action="store_true",
+        help="In worker mode: read sources and write outputs at the paths "
+             "used by the coordinator, instead of transferring them over the "
+             "connection",
+    )
+    parser.add_argument(
+        "--secret-file",
+        metavar="FILE",
+        default=None,
+        help="With --listen or --worker: authenticate workers with the "
+             "secret stored in FILE, which must be the same on both sides. "
+             "Required for --listen on an address other than localhost, as "
+             "anyone who can connect can run commands on the workers and "
+             "read the sources.",
+    )
+    parser.add_argument(
+        "--prefetch-threads",
+        metavar="COUNT",
+        type=int,
+        default=2,
+        help="Number of threads reading the metadata of the next tasks and "
+             "creating their output directories ahead of starting them, "
+             "0 to do that when starting them (default 2; ignored with "
+             "--engine asyncio)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        metavar="COUNT",
+        type=int,
+        default=None,
+        help="In worker mode: number of tasks to queue in addition to the "
+             "running ones (default: same as -j)",
+    )
+    parser.add_argument(
+        "--serve",
+        metavar="SOCKET",
+        default=None,
+        help="Run as service: keep running and accept jobs (directories "
+             "and transcoders) submitted with --submit on the Unix socket "
+             "SOCKET. The tasks of all jobs share the -j slots, which are "
+             "divided fairly between the jobs. The paths and output "
+             "directories of the jobs must be below the working directory "
+             "of the service; anyone who can connect to SOCKET can have "
+             "files written there. No transcoders or directories are needed "
+             "in this mode.",
+    )
+    parser.add_argument(
+        "--submit",
+        metavar="SOCKET",
+        default=None,
+        help="Submit the directories with the -x transcoders as a job to "
+             "the service at SOCKET and print its id, instead of encoding "
+             "them",
+    )
+    parser.add_argument(
+        "--wait",
+        default=False,
+        action="store_true",
+        help="With --submit: wait until the job has finished, and exit "
+             "with a non-zero status if not all of its tasks succeeded",
+    )
+    parser.add_argument(
+        "--status",
+        metavar="SOCKET",
+        default=None,
+        help="Print the state of the jobs of the service at SOCKET",
+    )
+    parser.add_argument(
+        "--cancel",
+        metavar=("SOCKET", "JOB"),
+        nargs=2,
+        default=None,
+        help="Cancel the job JOB of the service at SOCKET",
+    )
     parser.add_argument(
         "dir",
-        nargs="+",
+        nargs="*",
         help="Directory to scan for flac files. Note that paths are relevant."
     )
 
     args = parser.parse_args()
 
-    if len(args.transcoders) == 0:
+    secret = None
+    if args.secret_file is not None:
+        try:
+            with open(args.secret_file, "rb") as f:
+                secret = f.read().strip()
+        except OSError as exc:
+            parser.error("cannot read {}: {}".format(args.secret_file, exc))
+        if not secret:
+            parser.error("{} is empty".format(args.secret_file))
+    if args.listen is not None and secret is None:
+        try:
+            loopback = distributed.is_loopback_address(args.listen)
+        except ValueError as exc:
+            parser.error(str(exc))
+        if not loopback:
+            parser.error("--listen on a network address needs --secret-file")
+
+    if args.worker is not None:
+        logging.basicConfig(level=logging.ERROR, format='{0}:%(levelname)-8s %(message)s'.format(os.path.basename(sys.argv[0])))
+        logger.setLevel(
+            [logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG][
+                min(args.verbosity, 3)])
+        slots = args.parallel_tasks
+        if slots == "auto":
+            slots = usable_cpus()
+        worker = distributed.Worker(
+            args.worker,
+            slots,
+            prefetch=args.prefetch,
+            shared_storage=args.shared_storage,
+            secret=secret)
+        try:
+            worker.run()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if args.submit is not None or args.status is not None or \
+            args.cancel is not None:
+        if args.submit is not None and (not args.dir or not args.transcoders):
+            parser.error("--submit needs transcoders and directories")
+        logging.basicConfig(level=logging.ERROR, format='{0}:%(levelname)-8s %(message)s'.format(os.path.basename(sys.argv[0])))
+
+        def describe(job):
+            return "job {}: {}, {} of {} tasks done ({} failed, {} not " \
+                "run), {} running: {}".format(
+                    job["job"], job["state"],
+                    job["succeeded"] + job["skipped"], job["tasks"],
+                    job["failed"], job["dropped"], job["running"],
+                    " ".join(job["paths"]))
+
+        try:
+            if args.submit is not None:
+                with jobservice.ServiceClient(args.submit) as client:
+                    names = {cls: name for name, cls in reversed(
+                        list(encoders.items()))}
+                    job = client.submit(
+                        [(names[transcoder_class], output_dir)
+                         for transcoder_class, output_dir in args.transcoders],
+                        args.dir,
+                        wait=args.wait)
+                    print(job)
+                    if args.wait:
+                        status = client.wait(job, submitted=True)
+                        print(describe(status))
+                        if status["state"] != "done" or status["failed"] or \
+                                status["dropped"]:
+                            sys.exit(1)
+            if args.status is not None:
+                with jobservice.ServiceClient(args.status) as client:
+                    status = client.status()
+                print("{} running, {} pending, {} slots".format(
+                    status["running"], status["pending"], status["slots"]))
+                for job in status["jobs"]:
+                    print(describe(job))
+            if args.cancel is not None:
+                socket_path, job = args.cancel
+                with jobservice.ServiceClient(socket_path) as client:
+                    client.cancel(int(job))
+        except (OSError, ValueError) as err:
+            logging.error("%s", err)
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.serve is not None:
+        if args.dir or args.transcoders:
+            parser.error("jobs are submitted to --serve with --submit")
+        if args.engine == "asyncio" or args.listen is not None or \
+                args.watch or args.journal is not None:
+            parser.error("--serve is only supported by the local scheduler "
+                         "engine, without --watch and --journal")
+    elif not args.dir:
+        parser.error("at least one directory is required")
+    elif len(args.transcoders) == 0:
         parser.print_help()
         print("It's not reasonable to run this script without a single transcoder enabled.")
         sys.exit(1)
 
+    if args.filters and args.engine == "asyncio":
+        parser.error("--filter is not supported with --engine asyncio")
+
+    if args.watch:
+        if args.engine == "asyncio" or args.listen is not None:
+            parser.error("--watch is only supported by the local scheduler "
+                         "engine")
+        if args.journal is not None:
+            parser.error("--watch cannot be combined with --journal")
+        if not args.incremental and not args.skip_existing:
+            # otherwise, every write to a source, including those of
+            # --filter, would encode the whole album again
+            parser.error("--watch needs --incremental or --skip-existing")
+
+    if args.dedupe and \
+            (args.engine == "asyncio" or args.listen is not None):
+        parser.error("--dedupe is only supported by the local scheduler "
+                     "engine")
+
+    if args.gain_tags:
+        if args.engine == "asyncio" or args.listen is not None or \
+                not args.shared_decoder:
+            parser.error("--gain-tags needs the shared decoder of the "
+                         "scheduler engine")
+        if args.dedupe:
+            parser.error("--gain-tags cannot be combined with --dedupe")
+        if not loudness.available():
+            parser.error("--gain-tags needs NumPy")
+
     logging.basicConfig(level=logging.ERROR, format='{0}:%(levelname)-8s %(message)s'.format(os.path.basename(sys.argv[0])))
     if args.verbosity >= 3:
         logger.setLevel(logging.DEBUG)
@@ -602,37 +5244,320 @@ if __name__ == "__main__":
     elif args.verbosity >= 1:
         logger.setLevel(logging.WARNING)
 
-    task_generator = task_generator(
-        args.transcoders,
-        dry_run=args.dry_run,
-        skip_existing=args.skip_existing
-    )
-    scheduler = Scheduler(args.parallel_tasks)
+    journal = None
+    if args.journal is not None and not args.dry_run:
+        try:
+            journal = RunJournal(args.journal, args.transcoders, args.dir)
+        except (OSError, ValueError) as err:
+            logging.error("cannot use journal: %s", err)
+            sys.exit(1)
+
+    indices = {}
+
+    def make_task_generator(transcoders, task_generator=task_generator):
+        if args.incremental and not args.dry_run:
+            for transcoder_class, output_dir in transcoders:
+                if output_dir not in indices:
+                    indices[output_dir] = BuildIndex(output_dir)
+        return task_generator(
+            transcoders,
+            indices=indices,
+            journal=journal,
+            # AsyncScheduler and remote workers only support plain Encoder
+            # tasks
+            shared_decoder=args.shared_decoder and
+                args.engine != "asyncio" and args.listen is None,
+            measure_loudness=args.gain_tags,
+            dedupe=Deduplicator(args.copy_method) if args.dedupe else None,
+            tag_updates=args.tag_update and args.engine != "asyncio" and
+                args.listen is None,
+            dry_run=args.dry_run,
+            skip_existing=args.skip_existing
+        )
+
+    # the jobs of --serve get their own generators
+    task_generator = make_task_generator(args.transcoders)
+    filters = [
+        functools.partial(dir_filters[name], dry_run=args.dry_run)
+        for name in args.filters
+    ]
+
+    def print_progress(estimate):
+        done, pending, running, eta = estimate
+        etastr = "guessing" if eta is None else format_time(eta)
+        print(
+            "{:6.2f}% {:6d} done, {:6d} pending, {:2d} running, ETA {}{:20s}".format(
+                100*done / max(done+pending, 1), done, pending, running, etastr, ""
+            ),
+            end="\r"
+        )
+
+    if args.throughput_file is not None:
+        throughput = ThroughputModel.load(args.throughput_file)
+    else:
+        throughput = ThroughputModel()
+
+    run_report = RunReport() if args.report is not None else None
+
+    listeners = []
+    if run_report is not None:
+        listeners.append(run_report)
+    if journal is not None:
+        listeners.append(journal)
+    if args.progress_format == "jsonl":
+        if isinstance(args.progress_output, int):
+            progress_file = open(args.progress_output, "w", closefd=False)
+        else:
+            progress_file = open(args.progress_output, "a")
+        listeners.append(ProgressStream(progress_file))
+    if args.metrics_textfile is not None:
+        listeners.append(TextfileExporter(args.metrics_textfile))
+
+    show_bar = args.progress and args.progress_format == "bar"
+    streams = any(
+        isinstance(listener, (ProgressStream, TextfileExporter))
+        for listener in listeners)
+    # whether the state of the scheduler is reported periodically
+    args.progress = show_bar or streams
+
+    if args.progress_interval is None:
+        # the bar is cheap to update, the streams are read by other programs
+        args.progress_interval = 1.0 if streams else 0.2
+
+    # keep messages off stdout if the jsonl stream goes there
+    message_file = sys.stdout
+    if args.progress_format == "jsonl" and \
+            args.progress_output == sys.stdout.fileno():
+        message_file = sys.stderr
+
+    def report_progress():
+        estimate = scheduler.guesstimate()
+        if show_bar:
+            print_progress(estimate)
+        for listener in listeners:
+            listener.snapshot(estimate, scheduler.max_tasks)
+
+    auto_parallel = args.parallel_tasks == "auto"
+    if auto_parallel:
+        args.parallel_tasks = usable_cpus()
+        logging.info("starting with %d parallel tasks", args.parallel_tasks)
+
+    # assigned by run_async and run_scheduler
+    scheduler = None
+
+    def run_async():
+        global scheduler
+        scheduler = AsyncScheduler(args.parallel_tasks, throughput=throughput)
+        scheduler.listeners = listeners
+        try:
+            asyncio.run(scheduler.run(
+                args.dir,
+                task_generator,
+                progress=report_progress if args.progress else None,
+                progress_interval=args.progress_interval))
+        except KeyboardInterrupt:
+            if show_bar:
+                print()
+            print("SIGINT received -- terminating", file=message_file)
+
+    def run_scheduler():
+        global scheduler
+        child_watcher = ChildWatcher.create()
+        scan_estimate = ScanEstimate(args.dir) if args.progress else None
+        prefetcher = None
+        if args.prefetch_threads > 0:
+            prefetcher = Prefetcher(args.prefetch_threads)
+        scheduler = Scheduler(
+            args.parallel_tasks,
+            child_watcher=child_watcher,
+            scan_estimate=scan_estimate,
+            dispatch_policy=dispatch_policies[args.dispatch](),
+            throughput=throughput,
+            prefetcher=prefetcher)
+        scheduler.listeners = listeners
+        scheduler.high_watermark = args.lookahead
+        scheduler.low_watermark = max(args.lookahead // 4, 1)
+        controller = None
+        coordinator = None
+        service = None
+        wait = scheduler.wait
+        if args.listen is not None:
+            coordinator = distributed.Coordinator(
+                scheduler,
+                args.listen,
+                secret=secret,
+                child_watcher=child_watcher)
+            wait = coordinator.process
+        elif auto_parallel:
+            controller = ConcurrencyController(scheduler)
+        if args.serve is not None:
+            try:
+                service = jobservice.Service(
+                    scheduler,
+                    args.serve,
+                    make_task_generator,
+                    child_watcher=child_watcher,
+                    dir_filters=filters,
+                    measure_loudness=args.gain_tags)
+            except OSError as err:
+                logging.error("cannot listen on %s: %s", args.serve, err)
+                sys.exit(1)
+            wait = service.process
+        watcher = None
+        if args.watch:
+            try:
+                watcher = DirectoryWatcher(args.watch_delay)
+            except OSError as err:
+                logging.error("cannot watch directories: %s", err)
+                sys.exit(1)
+            # before the scan, so that no file added meanwhile is missed
+            for directory in args.dir:
+                watcher.add_tree(directory)
+            if child_watcher is not None:
+                child_watcher.register(watcher)
+        if service is not None or watcher is not None:
+            def on_sigterm(signum, frame):
+                # daemons are stopped with SIGTERM: terminate the tasks,
+                # remove the socket and commit the indices on the way out
+                raise SystemExit(128 + signum)
+            signal.signal(signal.SIGTERM, on_sigterm)
+
+        def schedule_changes():
+            for dirpath, filenames in watcher.due(scheduler.is_busy):
+                if filters or args.gain_tags:
+                    # the filters and the album gain need the whole album
+                    try:
+                        filenames = os.listdir(dirpath)
+                    except OSError as err:
+                        logging.error("cannot list %s: %s", dirpath, err)
+                        continue
+                logging.info("processing changes in %s", dirpath)
+                if prefetcher is not None:
+                    # a file may change again within the same second, with
+                    # the same size
+                    for filename in filenames:
+                        prefetcher.forget(os.path.join(dirpath, filename))
+                scheduler.schedule_tasks(tasks_for_directory(
+                    dirpath, filenames, task_generator,
+                    dir_filters=filters,
+                    measure_loudness=args.gain_tags))
+
+        def scan(skip=None):
+            for directory in args.dir:
+                yield from scan_dir(
+                    directory,
+                    lambda: None,
+                    task_generator,
+                    scan_estimate=scan_estimate,
+                    dir_filters=filters,
+                    measure_loudness=args.gain_tags,
+                    skip=skip)
+            if journal is not None and not journal.scan_complete:
+                journal.scanned()
+
+        try:
+            if journal is not None and journal.scan_complete:
+                logging.info("resuming from journal without scanning")
+                scheduler.scan_estimate = None
+                scheduler.feed(journal.resume(
+                    task_generator,
+                    dir_filters=filters,
+                    measure_loudness=args.gain_tags))
+                # sources added since the scan; journal.sources grows as
+                # they are queued, so each is only looked at once
+                scheduler.feed(scan(skip=journal.sources))
+            else:
+                scheduler.feed(scan())
+
+            next_progress = time.monotonic()
+            while True:
+                if not scheduler.poll():
+                    if watcher is None and service is None:
+                        break
+                    # idle in a long-running mode, which is stopped with a
+                    # signal at any time
+                    for index in indices.values():
+                        index.commit()
+                timeout = None
+                if args.progress:
+                    now = time.monotonic()
+                    if now >= next_progress:
+                        report_progress()
+                        next_progress = now + args.progress_interval
+                    timeout = next_progress - now
+                if controller is not None:
+                    until_update = controller.update()
+                    if timeout is None or until_update < timeout:
+                        timeout = until_update
+                if watcher is not None:
+                    until_due = watcher.timeout()
+                    if until_due is not None and \
+                            (timeout is None or until_due < timeout):
+                        timeout = until_due
+                with _phase("wait"):
+                    wait(timeout)
+                if watcher is not None:
+                    watcher.read()
+                    schedule_changes()
+            if journal is not None:
+                journal.completed()
+        except KeyboardInterrupt:
+            if show_bar:
+                print()
+            print("SIGINT received -- terminating", file=message_file)
+            scheduler.graceful_termination()
+        except:
+            scheduler.graceful_termination()
+            raise
+        finally:
+            if coordinator is not None:
+                coordinator.close()
+            if service is not None:
+                service.close()
+            if prefetcher is not None:
+                prefetcher.close()
+            if watcher is not None:
+                watcher.close()
+            if child_watcher is not None:
+                child_watcher.close()
+
+    if args.profile:
+        profiler = PhaseProfiler()
+    cprofile = None
+    if args.profile_dump is not None:
+        import cProfile
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+
     try:
-        for directory in args.dir:
-            scheduler.schedule_tasks(scan_dir(directory, scheduler.poll, task_generator))
-
-        i = 0
-        incr = args.progress
-        while scheduler.poll():
-            i += incr
-            time.sleep(0.01)
-            if i >= 20:
-                i = 0
+        if args.engine == "asyncio":
+            run_async()
+        else:
+            run_scheduler()
+    finally:
+        if cprofile is not None:
+            cprofile.disable()
+            cprofile.dump_stats(args.profile_dump)
+        if profiler is not None:
+            print(profiler.format(), file=sys.stderr)
+        for index in indices.values():
+            index.close()
+        if listeners:
+            # the scheduler is missing if the run failed to start
+            if scheduler is not None:
                 estimate = scheduler.guesstimate()
-                done, pending, running, eta = estimate
-                etastr = "guessing" if eta is None else format_time(eta)
-                print(
-                    "{:6.2f}% {:6d} done, {:6d} pending, {:2d} running, ETA {}{:20s}".format(
-                        100*done / (done+pending), done, pending, running, etastr, ""
-                    ),
-                    end="\r"
-                )
-    except KeyboardInterrupt:
-        if args.progress:
-            print()
-        print("SIGINT received -- terminating")
-        scheduler.graceful_termination()
-    except:
-        scheduler.graceful_termination()
-        raise
+                for listener in listeners:
+                    listener.snapshot(estimate, scheduler.max_tasks)
+            for listener in listeners:
+                listener.close()
+        if args.throughput_file is not None and not args.dry_run:
+            try:
+                throughput.save(args.throughput_file)
+            except OSError as err:
+                logging.error("cannot save throughput file %s: %s",
+                              args.throughput_file, err)
+        if run_report is not None:
+            try:
+                run_report.write(args.report)
+            except OSError as err:
+                logging.error("cannot write report %s: %s", args.report, err)